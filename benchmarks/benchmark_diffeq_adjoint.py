@@ -0,0 +1,58 @@
+# Memory kept for the backward pass and wall-clock time of a training step of the 'diffeq' solver with direct
+# backpropagation through the solver steps vs the adjoint method, in 1D and 2D.
+# The memory is the size of the tensors saved by autograd for the backward pass (and the peak allocated memory on GPU).
+#
+#   python -m benchmarks.benchmark_diffeq_adjoint
+
+import torch
+from timeit import default_timer
+from torchspde.neural_spde import NeuralSPDE
+
+
+def saved_bytes(f):
+    # total size of the distinct storages saved by autograd while running f
+    storages = {}
+    def pack(t):
+        if t.device.type != 'meta':
+            storages[t.untyped_storage().data_ptr()] = t.untyped_storage().nbytes()
+        return t
+    with torch.autograd.graph.saved_tensors_hooks(pack, lambda t: t):
+        out = f()
+    return out, sum(storages.values())
+
+
+def benchmark(dim, adjoint, batch=10, size=(64, 50), modes=(16, 16), hidden_channels=16, step_size=0.25, times=None,
+              checkpoint_every=1, n_runs=3, device='cpu'):
+    torch.manual_seed(0)
+    u0 = torch.rand(batch, 1, *[size[0]]*dim, device=device)
+    xi = torch.rand(batch, 1, *[size[0]]*dim, size[1], device=device)
+    model = NeuralSPDE(dim=dim, in_channels=1, noise_channels=1, hidden_channels=hidden_channels, modes1=modes[0],
+                       modes2=modes[1] if dim == 2 else None, solver='diffeq', method='rk4', options={'step_size': step_size},
+                       adjoint=adjoint, checkpoint_every=checkpoint_every).to(device)
+
+    run_times = []
+    for _ in range(n_runs):
+        if device == 'cuda':
+            torch.cuda.synchronize()
+            torch.cuda.reset_peak_memory_stats()
+        t = default_timer()
+        out, n_bytes = saved_bytes(lambda: model(u0, xi, times=times))
+        out.square().mean().backward()
+        if device == 'cuda':
+            torch.cuda.synchronize()
+        run_times.append(default_timer() - t)
+        model.zero_grad()
+
+    peak = ' | peak {:.1f} MB'.format(torch.cuda.max_memory_allocated()/2**20) if device == 'cuda' else ''
+    print('dim {} {:>8} times {:>10} | saved {:8.1f} MB{} | {:.3f} s/step'.format(dim, 'adjoint' if adjoint else 'direct',
+          'all' if times is None else str(len(times)), n_bytes/2**20, peak, min(run_times)))
+
+
+if __name__ == '__main__':
+    device = 'cuda' if torch.cuda.is_available() else 'cpu'
+    for dim, size in ((1, (64, 50)), (2, (32, 20))):
+        for adjoint in (False, True):
+            benchmark(dim, adjoint, size=size, device=device)
+        # loss on the final time only, with checkpoints every 5 time steps
+        for adjoint in (False, True):
+            benchmark(dim, adjoint, size=size, times=[-1], checkpoint_every=5, device=device)
@@ -0,0 +1,36 @@
+# Time to fill the missing values of partially observed noise fields with the vectorized linear interpolation
+# coefficients vs the scalar path by scalar path implementation of torchcde.
+#
+#   python -m benchmarks.benchmark_linear_interpolation
+
+import torch
+from timeit import default_timer
+from torchcde.interpolation_linear import _linear_interpolation_coeffs_with_missing_values as loop_coeffs
+from torchspde.linear_interpolation import _linear_interpolation_coeffs_with_missing_values
+
+
+def timed(f, *args):
+    t = default_timer()
+    out = f(*args)
+    return out, default_timer() - t
+
+
+def benchmark(size, dim_t=50, p_missing=0.3, batch=1):
+    torch.manual_seed(0)
+    x = torch.randn(batch, *size, dim_t)
+    x[torch.rand_like(x) < p_missing] = float('nan')
+    t = torch.arange(dim_t, dtype=x.dtype)
+
+    _linear_interpolation_coeffs_with_missing_values(t, x[:1])    # warm-up
+    out, time_vectorized = timed(_linear_interpolation_coeffs_with_missing_values, t, x)
+    out_loop, time_loop = timed(loop_coeffs, t, x)
+    assert torch.equal(out, out_loop)
+
+    print('{} x {} | loop {:.2f} s | vectorized {:.4f} s | speedup {:.0f}x'.format(
+          'x'.join(map(str, size)), dim_t, time_loop, time_vectorized, time_loop/time_vectorized))
+
+
+if __name__ == '__main__':
+    benchmark((128,))
+    benchmark((32, 32))
+    benchmark((128, 128))
@@ -0,0 +1,57 @@
+# Wall-clock time per epoch and final relative L2 loss of the root find solver trained with the exact implicit 
+# gradient, the Jacobian-free gradient and the phantom gradient, on synthetic data.
+#
+#   python -m benchmarks.benchmark_root_find_gradients
+
+import torch
+from timeit import default_timer
+from torchspde.neural_spde import NeuralSPDE
+from torchspde.root_finding_algorithms import broyden
+from utilities import LpLoss
+
+
+def synthetic_data(n, dim_x, dim_t, device):
+    # solutions of the heat equation with additive forcing, u_t = 0.002 u_xx + xi, by explicit finite differences
+    u0 = torch.sin(2*torch.pi*torch.rand(n, 1, 1)*torch.arange(dim_x)/dim_x)
+    xi = 0.1*torch.randn(n, 1, dim_x, dim_t)
+    xi[..., 0] = 0.
+    u = [u0]
+    for t in range(1, dim_t):
+        u.append(u[-1] + 0.002*(torch.roll(u[-1], 1, -1) - 2*u[-1] + torch.roll(u[-1], -1, -1))*dim_x**2/dim_t + xi[..., t])
+    return u0.to(device), xi.to(device), torch.stack(u, -1)[:, 0].to(device)
+
+
+def benchmark(grad_mode, data, epochs=20, batch_size=20, device='cpu', **kwargs):
+    torch.manual_seed(0)
+    u0, xi, u = data
+    model = NeuralSPDE(dim=1, in_channels=1, noise_channels=1, hidden_channels=16, n_iter=8, modes1=16, modes2=10, solver='root_find', 
+                       root_finder=broyden, forward_eps=1e-4, grad_mode=grad_mode, **kwargs).to(device)
+    optimizer = torch.optim.Adam(model.parameters(), lr=1e-3)
+    myloss = LpLoss(size_average=False)
+
+    times = []
+    for ep in range(epochs):
+        model.train()
+        t = default_timer()
+        for i in range(0, u0.size(0), batch_size):
+            u_pred = model(u0[i:i+batch_size], xi[i:i+batch_size])
+            loss = myloss(u_pred[..., 1:].reshape(u_pred.size(0), -1), u[i:i+batch_size, ..., 1:].reshape(u_pred.size(0), -1))
+            loss.backward()
+            optimizer.step()
+            optimizer.zero_grad()
+        times.append(default_timer() - t)
+
+    model.eval()
+    with torch.no_grad():
+        u_pred = model(u0, xi)
+        loss = myloss(u_pred[..., 1:].reshape(u0.size(0), -1), u[..., 1:].reshape(u0.size(0), -1)).item() / u0.size(0)
+
+    print('{:>8} | {:.3f} s/epoch | final loss {:.5f}'.format(grad_mode, sum(times)/len(times), loss))
+
+
+if __name__ == '__main__':
+    device = 'cuda' if torch.cuda.is_available() else 'cpu'
+    data = synthetic_data(200, 64, 20, device)
+    benchmark('implicit', data, device=device)
+    benchmark('jfb', data, device=device, grad_steps=1)
+    benchmark('phantom', data, device=device, grad_steps=5, grad_damping=0.5)
@@ -0,0 +1,46 @@
+# Steady-state inference latency of NeuralSPDE in eager mode vs its shape-specialised graph 
+# (StaticNeuralSPDE) in eager mode, under torch.jit.script and under torch.compile.
+#
+#   python -m benchmarks.benchmark_static_inference
+
+import torch
+from timeit import default_timer
+from torchspde.neural_spde import NeuralSPDE
+from torchspde.static_inference import StaticNeuralSPDE
+
+
+def latency(f, u0, xi, n_warmup=5, n_runs=20):
+    with torch.no_grad():
+        for _ in range(n_warmup):
+            f(u0, xi)
+        t = default_timer()
+        for _ in range(n_runs):
+            f(u0, xi)
+    return (default_timer() - t) / n_runs
+
+
+def benchmark(dim, batch=20, hidden_channels=16, size=(64, 50), modes=(16, 20), real_fft=False):
+    if dim == 1:
+        u0 = torch.rand(batch, 1, size[0])
+    else:
+        u0 = torch.rand(batch, 1, *size[:-1])
+    xi = torch.rand(batch, 1, *size)
+
+    model = NeuralSPDE(dim=dim, in_channels=1, noise_channels=1, hidden_channels=hidden_channels, 
+                       modes1=modes[0], modes2=modes[1], modes3=modes[2] if dim == 2 else None, real_fft=real_fft).eval()
+    static = StaticNeuralSPDE(model, size)
+
+    results = {'eager': latency(model, u0, xi), 'static': latency(static, u0, xi), 
+               'script': latency(torch.jit.script(static), u0, xi)}
+    try:
+        results['compile'] = latency(torch.compile(static), u0, xi)
+    except Exception as e:  # torch.compile needs a working compiler toolchain
+        print('torch.compile unavailable: {}'.format(e))
+
+    print('dim {} real_fft {} | '.format(dim, real_fft) + ' | '.join('{} {:.2f} ms'.format(k, 1e3*v) for k, v in results.items()))
+
+
+if __name__ == '__main__':
+    for real_fft in [False, True]:
+        benchmark(1, size=(128, 50), modes=(32, 24), real_fft=real_fft)
+        benchmark(2, size=(32, 32, 20), modes=(16, 16, 10), real_fft=real_fft)
@@ -119,3 +119,69 @@ def test_NSPDE_inverseDFT2D():
     torch.testing.assert_allclose(out_physicsinformed, out, rtol=1e-03, atol=1e-08)
 
 
+
+
+@pytest.mark.parametrize("dim, real_fft", ((1, False), (1, True), (2, False), (2, True)))
+def test_NSPDE_query_points(dim, real_fft):
+    batch, dim_x, dim_t = 2, 16, 12
+    if dim==1:
+        u0 = torch.rand(batch, 1, dim_x, dtype=torch.float32)
+        xi = torch.rand(batch, 1, dim_x, dim_t, dtype=torch.float32)
+        model = NeuralSPDE(dim=1, in_channels=1, noise_channels=1, hidden_channels=8, n_iter=3, modes1=8, modes2=8, real_fft=real_fft).eval()
+    else:
+        u0 = torch.rand(batch, 1, dim_x, dim_x, dtype=torch.float32)
+        xi = torch.rand(batch, 1, dim_x, dim_x, dim_t, dtype=torch.float32)
+        model = NeuralSPDE(dim=2, in_channels=1, noise_channels=1, hidden_channels=8, n_iter=3, modes1=8, modes2=8, modes3=8, real_fft=real_fft).eval()
+
+    # evaluating at the grid points gives back the solution on the grid
+    axes = [torch.arange(n, dtype=torch.float32) for n in xi.shape[2:]]
+    points = torch.stack(torch.meshgrid(*axes, indexing='ij'), dim=-1).reshape(-1, len(axes))
+
+    with torch.no_grad():
+        out = model(u0, xi)
+        out_points = model.evaluate(u0, xi, points, chunk_size=100)
+
+    torch.testing.assert_close(out_points, out.reshape(batch, 1, -1), rtol=1e-03, atol=1e-04)
+
+
+@pytest.mark.parametrize("requires_grad, max_elements", ((False, 2**24), (True, 2**24), (True, 64)))
+def test_inverseDFT2D_tiled(requires_grad, max_elements):
+
+    dim_x, dim_y, dim_t = 14, 12, 10
+    gridt = torch.tensor(np.linspace(0, 1, dim_t), dtype=torch.float).reshape(1, 1, dim_t).repeat(dim_x, dim_y, 1)
+    gridx = torch.tensor(np.linspace(0, 1, dim_x+1)[:-1], dtype=torch.float).reshape(dim_x, 1, 1).repeat(1, dim_y, dim_t)
+    gridy = torch.tensor(np.linspace(0, 1, dim_y+1)[:-1], dtype=torch.float).reshape(1, dim_y, 1).repeat(dim_x, 1, dim_t)
+    grid = torch.stack([gridx, gridy, gridt], dim=-1).requires_grad_(requires_grad)
+
+    u_ft = torch.rand(2, 4, 8, 6, 6, dtype=torch.complex64)
+
+    ans_torch = torch.fft.ifftn(u_ft, dim=[2, 3, 4], s=[dim_x, dim_y, dim_t])
+    ans_ours = inverseDFTn(u_ft, grid, dim=[2, 3, 4], s=[dim_x, dim_y, dim_t], max_elements=max_elements)
+
+    torch.testing.assert_close(ans_ours, ans_torch, rtol=1e-03, atol=1e-05)
+
+    # the output remains differentiable with respect to the grid
+    if requires_grad:
+        g = torch.autograd.grad(ans_ours.real.sum(), grid)[0]
+        assert g.shape == grid.shape
+
+
+def test_inverseDFT_basis_cache():
+
+    dim_x, dim_t = 16, 12
+    gridt = torch.tensor(np.linspace(0, 1, dim_t), dtype=torch.float).reshape(1, dim_t).repeat(dim_x, 1)
+    gridx = torch.tensor(np.linspace(0, 1, dim_x+1)[:-1], dtype=torch.float).reshape(dim_x, 1).repeat(1, dim_t)
+    grid = torch.stack([gridx, gridt], dim=-1)
+
+    u_ft = torch.rand(2, 4, dim_x, dim_t, dtype=torch.complex64)
+    ans_torch = torch.fft.ifftn(u_ft, dim=[2, 3])
+
+    # the basis matrices of the grid are cached, and recomputed when the grid is updated in place
+    torch.testing.assert_close(inverseDFTn(u_ft, grid, dim=[2, 3]), ans_torch, rtol=1e-03, atol=1e-05)
+    torch.testing.assert_close(inverseDFTn(u_ft, grid, dim=[2, 3]), ans_torch, rtol=1e-03, atol=1e-05)
+
+    # a grid which is not a tensor-product grid goes through the basis of all the grid coordinates
+    grid[0, 1, 1] += 0.01
+    ans_points = inverseDFTn(u_ft, grid.clone().requires_grad_(True), dim=[2, 3]).detach()
+    torch.testing.assert_close(inverseDFTn(u_ft, grid, dim=[2, 3]), ans_points)
+    assert not torch.allclose(ans_points, ans_torch, rtol=1e-03, atol=1e-05)
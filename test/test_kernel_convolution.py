@@ -0,0 +1,137 @@
+import pytest
+import torch
+import numpy as np
+from torchspde.fixed_point_solver import KernelConvolution
+from torchspde.neural_spde import NeuralSPDE
+
+
+@pytest.mark.parametrize("dim_phys, modes", (([32, 20], [16, 10]),
+                                             ([32, 21], [16, 10]),
+                                             ([16, 12, 20], [8, 8, 10])))
+def test_real_fft_conversion(dim_phys, modes):
+
+    batch, channels = 2, 4
+    z = torch.rand(batch, channels, *dim_phys, dtype=torch.float32)
+
+    conv_full = KernelConvolution(channels, *modes)
+
+    # the highest space frequency has no Hermitian partner in the half spectrum
+    with torch.no_grad():
+        conv_full.weights[:, :, 0] = 0.
+        if len(modes)==3:
+            conv_full.weights[:, :, :, 0] = 0.
+
+    # convert a full-spectrum checkpoint into the half-spectrum kernel
+    conv_half = KernelConvolution(channels, *modes, real_fft=True)
+    conv_half.load_state_dict(conv_full.state_dict())
+    assert conv_half.weights.size(-1) == modes[-1]//2 + 1
+
+    torch.testing.assert_close(conv_half(z), conv_full(z), rtol=1e-03, atol=1e-05)
+
+
+@pytest.mark.parametrize("dim, dim_phys, modes", ((1, [32, 20], [16, 10]),
+                                                  (2, [16, 12, 20], [8, 8, 10])))
+def test_real_fft_conversion_neural_spde(dim, dim_phys, modes):
+
+    batch = 2
+    u0 = torch.rand(batch, 1, *dim_phys[:-1], dtype=torch.float32)
+    xi = torch.rand(batch, 1, *dim_phys, dtype=torch.float32)
+
+    model_full = NeuralSPDE(dim, 1, 1, 8, *modes, n_iter=3).eval()
+    with torch.no_grad():
+        model_full.solver.convolution.weights[:, :, 0] = 0.
+        if dim==2:
+            model_full.solver.convolution.weights[:, :, :, 0] = 0.
+
+    # S_t*u_0 keeps the full-spectrum kernel
+    model_half = NeuralSPDE(dim, 1, 1, 8, *modes, n_iter=3, real_fft=True).eval()
+    model_half.load_state_dict(model_full.state_dict())
+    torch.testing.assert_close(model_half(u0, xi), model_full(u0, xi), rtol=1e-03, atol=1e-05)
+
+    # the converted state dict loads into a new half-spectrum model
+    model_half_copy = NeuralSPDE(dim, 1, 1, 8, *modes, n_iter=3, real_fft=True).eval()
+    model_half_copy.load_state_dict(model_half.state_dict())
+    torch.testing.assert_close(model_half_copy(u0, xi), model_half(u0, xi))
+
+
+def test_real_fft_grid():
+
+    batch, channels, dim_x, dim_t = 2, 4, 16, 12
+    z = torch.rand(batch, channels, dim_x, dim_t, dtype=torch.float32)
+
+    # create space-time grid of points
+    gridt = torch.tensor(np.linspace(0, 1, dim_t), dtype=torch.float).reshape(1, dim_t).repeat(dim_x, 1)
+    gridx = torch.tensor(np.linspace(0, 1, dim_x+1)[:-1], dtype=torch.float).reshape(dim_x, 1).repeat(1, dim_t)
+    grid = torch.stack([gridx, gridt], dim=-1)
+
+    conv = KernelConvolution(channels, 8, 8, real_fft=True)
+
+    torch.testing.assert_close(conv(z, grid=grid), conv(z), rtol=1e-03, atol=1e-05)
+    torch.testing.assert_close(conv(z, grid=grid, init=True), conv(z, init=True), rtol=1e-03, atol=1e-05)
+
+
+@pytest.mark.parametrize("dim_phys, modes", (([32, 20], [16, 10]),
+                                             ([15, 21], [8, 10]),
+                                             ([16, 12, 20], [8, 8, 10])))
+def test_spectral_plan(dim_phys, modes):
+
+    batch, channels = 2, 4
+    z = torch.rand(batch, channels, *dim_phys, dtype=torch.float32)
+    conv = KernelConvolution(channels, *modes)
+    dims = conv.dims
+
+    # reference implementation selecting the modes in the shifted spectrum
+    freqs = [ (z.size(2+i)//2 - modes[i]//2, z.size(2+i)//2 + modes[i]//2) for i in range(len(modes)) ]
+    window = (slice(None), slice(None)) + tuple(slice(*f) for f in freqs)
+    z_ft = torch.fft.fftshift(torch.fft.fftn(z, dim=dims), dim=dims)
+    out_ft = torch.zeros(z.size(), dtype=torch.cfloat)
+    out_ft[window] = torch.einsum("bi..., ij... -> bj...", z_ft[window], conv.weights)
+    ans = torch.fft.ifftn(torch.fft.ifftshift(out_ft, dim=dims), dim=dims).real
+
+    torch.testing.assert_close(conv(z), ans, rtol=1e-03, atol=1e-05)
+
+    # the workspace is reused when no gradient is needed
+    with torch.no_grad():
+        torch.testing.assert_close(conv(z), ans, rtol=1e-03, atol=1e-05)
+        torch.testing.assert_close(conv(2*z), 2*ans, rtol=1e-03, atol=1e-05)
+
+        # one plan and one workspace are shared across batch sizes
+        torch.testing.assert_close(conv(z[:1]), ans[:1], rtol=1e-03, atol=1e-05)
+        assert len(conv.plans) == 1
+
+
+@pytest.mark.parametrize("dim_phys, init, real_fft", (([16, 3], False, False),
+                                                    ([16, 3], True, False),
+                                                    ([16, 3], False, True),
+                                                    ([6, 12], False, False)))
+def test_spectral_plan_too_many_modes(dim_phys, init, real_fft):
+
+    # more retained modes than grid points along an axis
+    z = torch.rand(2, 4, *dim_phys, dtype=torch.float32)
+    conv = KernelConvolution(4, 8, 6, real_fft=real_fft)
+    with pytest.raises(ValueError):
+        conv(z, init=init)
+
+
+def test_kernel_t_cache():
+
+    batch, channels, dim_x, dim_t = 2, 4, 16, 12
+    z = torch.rand(batch, channels, dim_x, dim_t, dtype=torch.float32)
+    conv = KernelConvolution(channels, 8, 8).eval()
+
+    with torch.no_grad():
+        out = conv(z, init=True)
+        kernel_t = conv.kernel_t_cache[-1]
+        torch.testing.assert_close(conv(z, init=True), out)
+        assert conv.kernel_t_cache[-1] is kernel_t
+
+        # a new number of time steps or an update of the weights invalidates the cache
+        conv(z[..., :8], init=True)
+        assert conv.kernel_t_cache[-1].size(-1) == 8
+        conv.weights.mul_(2.)
+        torch.testing.assert_close(conv(z, init=True), 2*out)
+
+    # no caching in training mode
+    conv.kernel_t_cache = None
+    conv.train()(z, init=True)
+    assert conv.kernel_t_cache is None
@@ -0,0 +1,41 @@
+import pytest
+import torch
+from torchcde.interpolation_linear import _linear_interpolation_coeffs_with_missing_values as loop_coeffs
+from torchspde.linear_interpolation import _linear_interpolation_coeffs_with_missing_values, linear_interpolation_coeffs
+
+
+@pytest.mark.parametrize("dtype", (torch.float32, torch.float64))
+@pytest.mark.parametrize("p_missing", (0.1, 0.5, 0.95))
+def test_missing_values(dtype, p_missing):
+
+    x = torch.randn(4, 3, 5, 20, dtype=dtype)
+    x[torch.rand_like(x) < p_missing] = float('nan')
+
+    # missing at the start, everywhere but the first time, everywhere but the last time, everywhere
+    x[0, 0, 0, 0] = float('nan')
+    x[0, 0, 1, 1:] = float('nan')
+    x[0, 0, 2, :-1] = float('nan')
+    x[0, 0, 3] = float('nan')
+    t = torch.cumsum(torch.rand(20, dtype=dtype) + 0.1, dim=0)
+
+    # identical to the (scalar path by scalar path) implementation of torchcde
+    out = _linear_interpolation_coeffs_with_missing_values(t, x)
+    assert torch.equal(out, loop_coeffs(t, x))
+    assert not torch.isnan(out).any()
+
+    coeffs = linear_interpolation_coeffs(x.transpose(-1, -2), t)
+    assert torch.equal(coeffs, out.transpose(-1, -2))
+
+
+def test_missing_values_gradient():
+
+    x = torch.randn(2, 3, 10, dtype=torch.float64)
+    x[torch.rand_like(x) < 0.4] = float('nan')
+    x[0, 0, 0] = x[0, 1, -1] = float('nan')
+    x[1, 2] = float('nan')
+    t = torch.cumsum(torch.rand(10, dtype=torch.float64) + 0.1, dim=0)
+
+    # finite gradients with respect to the observations and the times
+    x.requires_grad_(True)
+    t.requires_grad_(True)
+    torch.autograd.gradcheck(_linear_interpolation_coeffs_with_missing_values, (t, x))
@@ -0,0 +1,51 @@
+import io
+import pytest
+import torch
+from concurrent.futures import ThreadPoolExecutor
+from torchspde.neural_spde import NeuralSPDE
+from torchspde.serving import DynamicBatcher, _load
+
+
+def test_dynamic_batcher():
+    n, dim_x, dim_t = 8, 16, 10
+    u0 = torch.rand(n, 1, dim_x, dtype=torch.float32)
+    xi = torch.rand(n, 1, dim_x, dim_t, dtype=torch.float32)
+    model = NeuralSPDE(dim=1, in_channels=1, noise_channels=1, hidden_channels=8, n_iter=2, modes1=8, modes2=6).eval()
+
+    with torch.no_grad():
+        out = model(u0, xi)
+
+    # single-sample requests sent concurrently are batched together 
+    batcher = DynamicBatcher(model, max_batch_size=n, max_latency=1., n_workers=2)
+    with ThreadPoolExecutor(max_workers=n) as pool:
+        ys = list(pool.map(batcher, u0, xi))
+    # a request with another shape goes to another bucket
+    y = batcher(u0[:2, ..., :dim_x//2], xi[:2, :, :dim_x//2])
+    batcher.close()
+
+    torch.testing.assert_close(torch.stack(ys), out, rtol=1e-03, atol=1e-05)
+    assert y.shape == (2, 1, dim_x//2, dim_t)
+
+    metrics = batcher.metrics.summary()
+    assert metrics['requests'] == n+1 and metrics['samples'] == n+2
+    assert metrics['batch_size']['max'] == n
+
+
+class Payload(object):
+    pass
+
+
+def test_load_payload():
+    u0, xi = torch.rand(1, 1, 16), torch.rand(1, 1, 16, 10)
+    buffer = io.BytesIO()
+    torch.save({'u0': u0, 'xi': xi}, buffer)
+    torch.testing.assert_close(_load(buffer.getvalue(), 'application/octet-stream'), (u0, xi))
+
+    # only dicts of tensors are accepted, and arbitrary objects are never unpickled
+    for payload in ([u0, xi], {'u0': u0, 'xi': xi.tolist()}, {'u0': u0, 'xi': Payload()}):
+        buffer = io.BytesIO()
+        torch.save(payload, buffer)
+        with pytest.raises(ValueError):
+            _load(buffer.getvalue(), 'application/octet-stream')
+    with pytest.raises(ValueError):
+        _load(b'not a payload', 'application/octet-stream')
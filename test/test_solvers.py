@@ -2,6 +2,13 @@ import pytest
 import torch
 import numpy as np
 from torchspde.neural_spde import NeuralSPDE
+from torchspde.root_finding_algorithms import forward_iteration, broyden, lbroyden, anderson
+from torchspde.static_inference import StaticNeuralSPDE
+from torchspde.root_find_solver import ImplicitGradient
+from torchspde.solution_cache import SolutionCache
+from torchspde.diffeq_solver import compl_mat_vec_mul
+from torchspde.linear_interpolation import LinearInterpolation
+from utilities import dataloader_nspde_1d
 
 
 def test_fixed_point_solver_1d():
@@ -35,4 +42,383 @@ def test_diffeq_solver_2d():
     xi = torch.rand(batch, 1, dim_x, dim_y, dim_t, dtype=torch.float32)
     model = NeuralSPDE(dim=2, in_channels=1, noise_channels=1, hidden_channels=16, n_iter=4, modes1=16, modes2=16, solver='diffeq').cuda()
     out= model(u0.cuda(), xi.cuda())
-    assert out.shape == (batch, in_channels, dim_x, dim_y, dim_t)
\ No newline at end of file
+    assert out.shape == (batch, in_channels, dim_x, dim_y, dim_t)
+
+@pytest.mark.parametrize("dim", (1, 2))
+def test_diffeq_solver_complex_state(dim):
+    batch, dim_x, dim_t = 2, 8, 6
+    u0 = torch.rand(batch, 1, *[dim_x]*dim, dtype=torch.float32)
+    xi = torch.rand(batch, 1, *[dim_x]*dim, dim_t, dtype=torch.float32)
+    model = NeuralSPDE(dim=dim, in_channels=1, noise_channels=1, hidden_channels=4, modes1=8, modes2=8 if dim==2 else None, solver='diffeq', method='rk4')
+    out = model(u0, xi)
+    assert out.shape == (batch, 1, *[dim_x]*dim, dim_t)
+    out.sum().backward()
+    assert model.solver.cde.A.grad is not None
+
+    # one complex product against the four real products of the (real, imaginary) parts
+    A, v = model.solver.cde.A, torch.randn(batch, 2, *[8]*dim, 4)
+    op = lambda A, v: torch.einsum('...ij, b...j -> b...i', A, v)
+    expected = torch.complex(op(A[0], v[:, 0]) - op(A[1], v[:, 1]), op(A[1], v[:, 0]) + op(A[0], v[:, 1]))
+    torch.testing.assert_close(compl_mat_vec_mul(model.solver.cde.compl_A(), torch.complex(v[:, 0], v[:, 1])), expected)
+
+
+@pytest.mark.parametrize("dim", (1, 2))
+def test_diffeq_solver_etd(dim):
+    batch, dim_x, dim_t = 2, 8, 6
+    u0 = torch.rand(batch, 1, *[dim_x]*dim, dtype=torch.float32)
+    xi = torch.rand(batch, 1, *[dim_x]*dim, dim_t, dtype=torch.float32)
+    model = NeuralSPDE(dim=dim, in_channels=1, noise_channels=1, hidden_channels=4, modes1=8, modes2=8 if dim==2 else None, solver='diffeq', method='rk4', options={'step_size': 0.005}).eval()
+
+    # stiff linear part: one exponential step per time step against many small Runge-Kutta steps
+    with torch.no_grad():
+        model.solver.cde.A.zero_()
+        model.solver.cde.A[0] -= 50*torch.eye(4)
+        expected = model(u0, xi)
+        model.solver.kwargs.update(method='etd2', options=None)
+        torch.testing.assert_close(model(u0, xi), expected, rtol=1e-3, atol=1e-3)
+        cache = model.solver.cde.exponentials_cache
+        model(u0, xi)
+        assert model.solver.cde.exponentials_cache is cache
+
+    model.train()
+    model(u0, xi).sum().backward()
+    assert model.solver.cde.A.grad is not None
+
+
+@pytest.mark.parametrize("dim", (1, 2))
+def test_diffeq_solver_adjoint(dim):
+    batch, dim_x, dim_t = 2, 12, 8
+    u0 = torch.rand(batch, 1, *[dim_x]*dim, dtype=torch.float32)
+    xi = torch.rand(batch, 1, *[dim_x]*dim, dim_t, dtype=torch.float32, requires_grad=True)
+    grads = []
+    for kwargs in ({'adjoint': False}, {'adjoint': True}, {'adjoint': True, 'checkpoint_every': 4}):
+        torch.manual_seed(0)
+        model = NeuralSPDE(dim=dim, in_channels=1, noise_channels=1, hidden_channels=4, modes1=8, modes2=8 if dim==2 else None, solver='diffeq', 
+                           method='rk4', options={'step_size': 0.25}, **kwargs).eval()
+        out = model(u0, xi, times=[3, -1])
+        assert out.shape == (batch, 1, *[dim_x]*dim, 2)
+        torch.testing.assert_close(out, model(u0, xi)[..., [3, -1]])
+        xi.grad = None
+        out.square().sum().backward()
+        grads.append([model.solver.cde.A.grad, model.spde_func.F[0].weight.grad, xi.grad])
+
+    # the adjoint parameters are A, the weights of F and G and the noise
+    for grads_adjoint in grads[1:]:
+        for g, g_adjoint in zip(grads[0], grads_adjoint):
+            torch.testing.assert_close(g_adjoint, g, rtol=1e-4, atol=1e-5)
+
+
+@pytest.mark.parametrize("disk", (False, True))
+def test_diffeq_solver_precomputed_control(disk, tmp_path):
+    u, xi = torch.rand(6, 16, 8), torch.randn(6, 16, 8)
+    model = NeuralSPDE(dim=1, in_channels=1, noise_channels=1, hidden_channels=4, modes1=8, solver='diffeq', method='rk4').eval()
+    _, test_dl = dataloader_nspde_1d(u, xi, ntrain=4, ntest=2, T=8, batch_size=2, dim_x=16)
+    _, control_dl = dataloader_nspde_1d(u, xi, ntrain=4, ntest=2, T=8, batch_size=2, dim_x=16, control=True, control_dir=str(tmp_path) if disk else None)
+    with torch.no_grad():
+        for (u0_, xi_, _), (u0_control, X, _) in zip(test_dl, control_dl):
+            assert isinstance(X, LinearInterpolation)
+            torch.testing.assert_close(model(u0_control, X), model(u0_, xi_))
+
+
+def test_fixed_point_solver_tol():
+    batch, dim_x, dim_t = 4, 32, 20
+    u0 = torch.rand(batch, 1, dim_x, dtype=torch.float32)
+    xi = torch.rand(batch, 1, dim_x, dim_t, dtype=torch.float32)
+    model = NeuralSPDE(dim=1, in_channels=1, noise_channels=1, hidden_channels=8, n_iter=4, modes1=16, modes2=10).eval()
+    with torch.no_grad():
+        out = model(u0, xi)
+
+        # with a zero tolerance, all the max_iter iterations are used
+        model.solver.tol = 0.
+        out_tol = model(u0, xi)
+        assert (model.solver.n_iters == 4).all()
+        torch.testing.assert_close(out_tol, out)
+
+        # with a large tolerance, every sample exits after one iteration
+        model.solver.tol = 1e8
+        model(u0, xi)
+        assert (model.solver.n_iters == 1).all()
+
+
+def test_fixed_point_solver_checkpoint():
+    batch, dim_x, dim_y, dim_t = 2, 8, 8, 10
+    u0 = torch.rand(batch, 1, dim_x, dim_y, dtype=torch.float32)
+    xi = torch.rand(batch, 1, dim_x, dim_y, dim_t, dtype=torch.float32)
+    model = NeuralSPDE(dim=2, in_channels=1, noise_channels=1, hidden_channels=4, n_iter=4, modes1=4, modes2=4, modes3=6)
+
+    grads = []
+    for segments in [None, 2]:
+        model.solver.checkpoint_segments = segments
+        model.zero_grad()
+        model(u0, xi).sum().backward()
+        grads.append([p.grad.clone() for p in model.parameters()])
+
+    for g, g_ckpt in zip(*grads):
+        torch.testing.assert_close(g_ckpt, g)
+
+
+@pytest.mark.parametrize("window, modes_t, real_fft", ((6, 6, False), (6, 6, True), (4, 6, False)))
+def test_rollout(window, modes_t, real_fft):
+    batch, dim_x, dim_t = 2, 16, 23
+    u0 = torch.rand(batch, 1, dim_x, dtype=torch.float32)
+    xi = torch.rand(batch, 1, dim_x, dim_t, dtype=torch.float32)
+    model = NeuralSPDE(dim=1, in_channels=1, noise_channels=1, hidden_channels=8, n_iter=2, modes1=8, modes2=modes_t, real_fft=real_fft).eval()
+
+    # every time step is predicted exactly once
+    times = []
+    for t, ys in model.rollout(u0, xi, window):
+        assert ys.shape[:3] == (batch, 1, dim_x)
+        times += list(range(t, t+ys.size(-1)))
+    assert times == list(range(dim_t))
+
+    out = model.rollout(u0, xi, window, out=torch.zeros(batch, 1, dim_x, dim_t))
+
+    # windows of 6 time steps (start, first new time step, start of the next window), the last one moved back 
+    # to end at the last time step
+    with torch.no_grad():
+        z0 = model.encode(u0)
+        for t, t_new, t_next in ((0, 0, 5), (5, 6, 10), (10, 11, 15), (15, 16, 17), (17, 21, None)):
+            zs = model.solver(z0, xi[..., t:t+6])
+            torch.testing.assert_close(out[..., t_new:t+6], model.decode(zs)[..., t_new-t:])
+            if t_next is not None:
+                z0 = zs[..., t_next-t]
+        torch.testing.assert_close(out[..., :6], model(u0, xi[..., :6]))
+
+
+@pytest.mark.parametrize("solver", ('fixed_point', 'root_find'))
+def test_mixed_precision(solver):
+    batch, dim_x, dim_t = 2, 16, 12
+    u0 = torch.rand(batch, 1, dim_x, dtype=torch.float32)
+    xi = torch.rand(batch, 1, dim_x, dim_t, dtype=torch.float32)
+    kwargs = {'root_finder': forward_iteration} if solver=='root_find' else {}
+    model = NeuralSPDE(dim=1, in_channels=1, noise_channels=1, hidden_channels=8, n_iter=2, modes1=8, modes2=6, solver=solver, amp_dtype=torch.bfloat16, **kwargs)
+    out = model(u0, xi)
+    assert out.dtype == torch.float32
+    out.sum().backward()
+    assert model.solver.convolution.weights.grad.dtype == torch.cfloat
+
+    # close to the single precision model
+    model.amp_dtype = None
+    torch.testing.assert_close(out, model(u0, xi), rtol=5e-2, atol=5e-2)
+
+
+@pytest.mark.parametrize("dim, real_fft", ((1, False), (1, True), (2, False), (2, True)))
+def test_static_inference(dim, real_fft):
+    batch, dim_x, dim_t = 2, 16, 12
+    size = (dim_x, dim_t) if dim==1 else (dim_x, dim_x, dim_t)
+    u0 = torch.rand(batch, 1, *size[:-1], dtype=torch.float32)
+    xi = torch.rand(batch, 1, *size, dtype=torch.float32)
+    model = NeuralSPDE(dim=dim, in_channels=1, noise_channels=1, hidden_channels=8, n_iter=2, modes1=8, modes2=8, modes3=8 if dim==2 else None, real_fft=real_fft).eval()
+
+    static = StaticNeuralSPDE(model, size)
+    scripted = torch.jit.script(static)
+
+    with torch.no_grad():
+        out = model(u0, xi)
+        torch.testing.assert_close(static(u0, xi), out, rtol=1e-03, atol=1e-05)
+        torch.testing.assert_close(scripted(u0, xi), out, rtol=1e-03, atol=1e-05)
+
+
+# the FFTs and the spectral contractions fall back to eager kernels
+@pytest.mark.filterwarnings("ignore:Torchinductor does not support code generation for complex operators")
+@pytest.mark.parametrize("dim, real_fft", ((1, False), (1, True), (2, False)))
+def test_static_inference_compile(dim, real_fft):
+    # torch.compile needs inductor and a working C++ compiler
+    try:
+        torch.compile(lambda x: x + 1)(torch.zeros(1))
+    except Exception as e:
+        pytest.skip('torch.compile unavailable: {}'.format(e))
+
+    batch, dim_x, dim_t = 2, 16, 12
+    size = (dim_x, dim_t) if dim==1 else (dim_x, dim_x, dim_t)
+    u0 = torch.rand(batch, 1, *size[:-1], dtype=torch.float32)
+    xi = torch.rand(batch, 1, *size, dtype=torch.float32)
+    model = NeuralSPDE(dim=dim, in_channels=1, noise_channels=1, hidden_channels=8, n_iter=2, modes1=8, modes2=8, modes3=8 if dim==2 else None, real_fft=real_fft).eval()
+
+    compiled = torch.compile(StaticNeuralSPDE(model, size))
+
+    with torch.no_grad():
+        torch.testing.assert_close(compiled(u0, xi), model(u0, xi), rtol=1e-03, atol=1e-05)
+
+
+def test_ensemble():
+    n_samples, dim_x, dim_t = 37, 16, 10
+    u0 = torch.rand(1, dim_x, dtype=torch.float32)
+    xi = torch.rand(n_samples, 1, dim_x, dim_t, dtype=torch.float32)
+    model = NeuralSPDE(dim=1, in_channels=1, noise_channels=1, hidden_channels=8, n_iter=2, modes1=8, modes2=6).eval()
+
+    # draw the noise paths in order from xi
+    draws = iter(xi.split(8))
+    stats = model.ensemble(u0, lambda n: next(draws), n_samples, batch_size=8, quantiles=(0.1, 0.5, 0.9))
+
+    with torch.no_grad():
+        ys = model(u0.expand(n_samples, 1, dim_x), xi)
+    torch.testing.assert_close(stats['mean'], ys.mean(0), rtol=1e-04, atol=1e-05)
+    torch.testing.assert_close(stats['var'], ys.var(0), rtol=1e-03, atol=1e-06)
+    assert stats['quantiles'].shape == (3, 1, dim_x, dim_t)
+    # the P^2 estimates stay between the extreme samples
+    assert (stats['quantiles'] >= ys.min(0).values - 1e-6).all() and (stats['quantiles'] <= ys.max(0).values + 1e-6).all()
+
+
+@pytest.mark.parametrize("solver", ('fixed_point', 'root_find'))
+def test_fanout(solver):
+    n_init, batch, dim_x, dim_t = 2, 5, 16, 10
+    u0 = torch.rand(n_init, 1, dim_x, dtype=torch.float32)
+    xi = torch.rand(batch, 1, dim_x, dim_t, dtype=torch.float32)
+    index = torch.tensor([0, 1, 1, 0, 1])
+    kwargs = {'root_finder': forward_iteration} if solver=='root_find' else {}
+    model = NeuralSPDE(dim=1, in_channels=1, noise_channels=1, hidden_channels=8, n_iter=2, modes1=8, modes2=6, solver=solver, **kwargs).eval()
+
+    with torch.no_grad():
+        torch.testing.assert_close(model.forward_fanout(u0, xi, index), model(u0[index], xi), rtol=1e-03, atol=1e-05)
+
+
+def test_lbroyden():
+    batch, channels, dim_t = 3, 8, 5
+    A = 0.4 * torch.randn(channels*dim_t, channels*dim_t, dtype=torch.float64) / np.sqrt(channels*dim_t)
+    b = torch.randn(batch, channels, dim_t, dtype=torch.float64)
+    f = lambda x: torch.tanh(torch.einsum('ij, bj -> bi', A, x.reshape(batch, -1)).reshape_as(x)) + b
+    x0 = torch.zeros_like(b)
+
+    # with a circular buffer of 3 updates
+    x = lbroyden(f, x0, threshold=40, eps=1e-10, memory=3)['result']
+    torch.testing.assert_close(f(x), x, rtol=1e-06, atol=1e-06)
+
+    # with as many updates as iterations, same iterates as Broyden's method
+    torch.testing.assert_close(lbroyden(f, x0, threshold=6, eps=1e-10, memory=6)['result'], broyden(f, x0, threshold=6, eps=1e-10)['result'])
+
+    # reduced precision storage
+    x = lbroyden(f, x0, threshold=40, eps=1e-6, memory=3, storage_dtype=torch.float32)['result']
+    torch.testing.assert_close(f(x), x, rtol=1e-04, atol=1e-05)
+
+
+@pytest.mark.parametrize("root_finder", (forward_iteration, broyden, anderson))
+def test_root_finder_per_sample(root_finder):
+    batch, channels, dim_t = 4, 6, 5
+    torch.manual_seed(0)
+    A = 0.3 * torch.randn(channels*dim_t, channels*dim_t, dtype=torch.float64) / np.sqrt(channels*dim_t)
+    # the first sample converges after one iteration, the last ones are less contractive
+    scale = torch.tensor([0., 0.2, 0.5, 1.], dtype=torch.float64)
+    b = torch.randn(batch, channels, dim_t, dtype=torch.float64)
+    calls = []
+
+    def f(x, index=None):
+        index = torch.arange(batch) if index is None else index
+        calls.append(index.size(0))
+        return torch.tanh(scale[index, None] * torch.einsum('ij, bj -> bi', A, x.reshape(x.size(0), -1))).reshape_as(x) + b[index]
+
+    out = root_finder(f, torch.zeros_like(b), threshold=60, eps=1e-9, check_every=2)
+    x = out['result']
+    torch.testing.assert_close(f(x), x, rtol=1e-06, atol=1e-06)
+    assert out['nstep'].shape == (batch,)
+    # the converged samples were removed from the active batch
+    assert min(calls) < batch
+
+    # same fixed point with a map evaluated on the whole batch
+    x_full = root_finder(lambda x: f(x), torch.zeros_like(b), threshold=60, eps=1e-9, check_every=2)['result']
+    torch.testing.assert_close(x_full, x, rtol=1e-06, atol=1e-06)
+
+
+def test_implicit_gradient():
+    batch, channels, dim_t = 2, 4, 3
+    torch.manual_seed(0)
+    A = 0.3 * torch.randn(channels*dim_t, channels*dim_t, dtype=torch.float64) / np.sqrt(channels*dim_t)
+    b = torch.randn(batch, channels, dim_t, dtype=torch.float64, requires_grad=True)
+    f = lambda x: torch.tanh(torch.einsum('ij, bj -> bi', A, x.reshape(batch, -1)).reshape_as(x)) + b
+
+    # reference: backpropagation through the unrolled iterations
+    z = torch.zeros_like(b)
+    for _ in range(100):
+        z = f(z)
+    grad_ref, = torch.autograd.grad((z**2).sum(), b)
+
+    for solver, warm_start in [(forward_iteration, False), (broyden, True), (anderson, True)]:
+        with torch.no_grad():
+            info = solver(f, torch.zeros_like(b), threshold=60, eps=1e-12, return_jacobian=warm_start)
+        z = info['result'].requires_grad_()
+        jacobian = (info['Us'], info['VTs']) if warm_start else None
+        new_z = ImplicitGradient.apply(f(z), z, solver, 60, 1e-12, jacobian)
+        grad, = torch.autograd.grad((new_z**2).sum(), b)
+        torch.testing.assert_close(grad, grad_ref)
+
+
+@pytest.mark.parametrize("grad_mode", ('implicit', 'jfb', 'phantom'))
+def test_root_find_solver_backward(grad_mode):
+    batch, dim_x, dim_t = 2, 16, 10
+    u0 = torch.rand(batch, 1, dim_x, dtype=torch.float32)
+    xi = torch.rand(batch, 1, dim_x, dim_t, dtype=torch.float32)
+    model = NeuralSPDE(dim=1, in_channels=1, noise_channels=1, hidden_channels=8, n_iter=4, modes1=8, modes2=6, solver='root_find', root_finder=broyden, 
+                       warm_start=True, grad_mode=grad_mode, grad_steps=2)
+    model(u0, xi).sum().backward()
+    assert all(p.grad is not None for p in model.parameters())
+
+
+def test_root_find_solver_forward_eps():
+    batch, dim_x, dim_t = 2, 16, 10
+    u0 = torch.rand(batch, 1, dim_x, dtype=torch.float32)
+    xi = torch.rand(batch, 1, dim_x, dim_t, dtype=torch.float32)
+
+    # the tolerance of the forward solve is that of forward_eps, not of the root finder
+    eps = []
+    def root_finder(f, x0, **kwargs):
+        eps.append(kwargs['eps'])
+        return forward_iteration(f, x0, **kwargs)
+    model = NeuralSPDE(dim=1, in_channels=1, noise_channels=1, hidden_channels=8, n_iter=4, modes1=8, modes2=6, solver='root_find', root_finder=root_finder, 
+                       forward_eps=1e-4)
+    model(u0, xi)
+    assert eps == [1e-4]
+
+
+@pytest.mark.parametrize("disk", (False, True))
+def test_solution_cache(disk, tmp_path):
+    batch, dim_x, dim_t = 3, 16, 10
+    u0 = torch.rand(batch, 1, dim_x, dtype=torch.float32)
+    xi = torch.rand(batch, 1, dim_x, dim_t, dtype=torch.float32)
+    cache = SolutionCache(dtype=torch.float16, path=str(tmp_path) if disk else None)
+    model = NeuralSPDE(dim=1, in_channels=1, noise_channels=1, hidden_channels=8, n_iter=20, modes1=8, modes2=6, solver='root_find', 
+                       root_finder=forward_iteration, solution_cache=cache).eval()
+    sample_ids = torch.tensor([4, 0, 7])
+
+    with torch.no_grad():
+        out = model(u0, xi)
+        torch.testing.assert_close(model(u0, xi, sample_ids=sample_ids), out, rtol=1e-03, atol=1e-04)
+        assert len(cache) == batch and cache.misses == batch
+
+        # the second solve starts from the cached fixed points
+        torch.testing.assert_close(model(u0, xi, sample_ids=sample_ids), out, rtol=1e-03, atol=1e-04)
+        assert cache.hits == batch
+
+    # least recently used entries are evicted beyond the byte budget
+    cache.max_bytes = cache.n_bytes // batch
+    cache.put(torch.tensor([1]), torch.zeros(1, 8*dim_x, dim_t))
+    assert len(cache) == 1 and 1 in cache
+
+
+@pytest.mark.parametrize("grad_mode", ('implicit', 'jfb', 'phantom'))
+def test_jacobian_regularization(grad_mode):
+    batch, dim_x, dim_t = 2, 16, 10
+    u0 = torch.rand(batch, 1, dim_x, dtype=torch.float32)
+    xi = torch.rand(batch, 1, dim_x, dim_t, dtype=torch.float32)
+    model = NeuralSPDE(dim=1, in_channels=1, noise_channels=1, hidden_channels=8, n_iter=4, modes1=8, modes2=6, solver='root_find', root_finder=forward_iteration, 
+                       grad_mode=grad_mode, jac_loss_every=2, jac_loss_vecs=2, spectral_radius_every=2, spectral_radius_iters=5)
+
+    bn = model.spde_func.F[1]
+    n_updates = []
+    for step in range(3):
+        n = bn.num_batches_tracked.item()
+        out = model(u0, xi)
+        n_updates.append(bn.num_batches_tracked.item() - n)
+        # the penalty is only computed every 2 steps
+        assert (model.solver.jac_loss is not None) == (step % 2 == 0)
+        loss = out.sum() + (model.solver.jac_loss if model.solver.jac_loss is not None else 0.)
+        loss.backward()
+
+    assert [s for s, _ in model.solver.spectral_radius] == [0, 2]
+
+    # the penalty does not update the running statistics of the batch norms once more
+    assert n_updates[0] == n_updates[1]
+
+    # nothing is computed by default
+    model.solver.jac_loss_every = model.solver.spectral_radius_every = None
+    model(u0, xi)
+    assert model.solver.jac_loss is None
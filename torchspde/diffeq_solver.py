@@ -1,38 +1,22 @@
+import math
 import torch
-import torchcde 
+import torchdiffeq
 import torch.nn as nn
 import torch.nn.functional as F
-from functools import partial
-from .linear_interpolation import LinearInterpolation
+from .linear_interpolation import LinearInterpolation, linear_interpolation_coeffs
+from .fixed_point_solver import SpectralPlan, retained_modes
 
 
 #=============================================================================================
 # Convolution in physical space = pointwise mutliplication of complex tensors in Fourier space
 #=============================================================================================
 
-def compl_mat_vec_mul_1d(A, z):
-    """A: contains complex matrices of coefficients  (2, dim_x, hidden_size, hidden_size)
-       z: (batch, 2, dim_x, hidden_size)
-       out: (batch, 2, dim_x, hidden_size)
+def compl_mat_vec_mul(A, z):
+    """A: complex matrices of coefficients (modes1, (possibly modes2), hidden_size, hidden_size) -- complex
+       z: (batch, modes1, (possibly modes2), hidden_size) -- complex
+       out: (batch, modes1, (possibly modes2), hidden_size) -- complex
     """
-    op = partial(torch.einsum, "xij, bxj-> bxi") 
-
-    return torch.stack([
-        op(A[0], z[:, 0]) - op(A[1], z[:, 1]),
-        op(A[1], z[:, 0]) + op(A[0], z[:, 1])
-    ], dim=1)
-
-def compl_mat_vec_mul_2d(A, z):
-    """A: contains complex matrices of coefficients  (2, dim_x, dim_y, hidden_size, hidden_size)
-       z: (batch, 2, dim_x, dim_y, hidden_size)
-       out: (batch, 2, dim_x, dim_y, hidden_size)
-    """
-    op = partial(torch.einsum, "xyij, bxyj-> bxyi") 
-
-    return torch.stack([
-        op(A[0], z[:, 0]) - op(A[1], z[:, 1]),
-        op(A[1], z[:, 0]) + op(A[0], z[:, 1])
-    ], dim=1)
+    return torch.matmul(A, z.unsqueeze(-1)).squeeze(-1)
 
 
 
@@ -44,6 +28,7 @@ class ControlledODE(torch.nn.Module):
     """Differential Equation solver in Fourier space: R'(t) = A*R(t) + control.
        A is a complex matrix resulting from a prior p;
        control is the space Fourier transform of H (see paper).
+       The state R only contains the retained modes -modes//2, ..., modes//2-1 (centred on the zero frequency).
     """
 
     def __init__(self, spde_func, hidden_channels, modes1, modes2=None):
@@ -53,52 +38,57 @@ class ControlledODE(torch.nn.Module):
 
         self.flag1d = False if modes2 else True
         
+        # A stores the real and imaginary parts of the complex matrices (the layout of the checkpoints)
         if self.flag1d:
             self.A = nn.Parameter(scale * torch.rand(2, modes1, hidden_channels, hidden_channels))
             self.modes = [modes1]
+            self.dims = [2]
         else:
             self.A = nn.Parameter(scale * torch.rand(2, modes1, modes2, hidden_channels, hidden_channels)) 
             self.modes = [modes1, modes2]
+            self.dims = [2, 3]
 
         self.spde_func = spde_func
 
-    def forward(self, t, v):
-        """ v: (batch, 2, dim_x, (possibly dim y), hidden_size)"""
-
-        freqs = [ (v.size(2+i)//2 - self.modes[i]//2, v.size(2+i)//2 + self.modes[i]//2) for i in range(len(self.modes)) ]
+        self.plans = {}
+        self.exponentials_cache = None
 
-        Av = torch.zeros(v.size(), device=v.device, dtype=v.dtype)
+    def compl_A(self):
+        """ A as complex matrices (modes1, (possibly modes2), hidden_channels, hidden_channels) """
+        return torch.complex(self.A[0], self.A[1])
 
-        if self.flag1d:
-            Av[:, :, freqs[0][0]:freqs[0][1] ] = compl_mat_vec_mul_1d(self.A, v[:, :, freqs[0][0]:freqs[0][1] ] )
-        else:
-            Av[:, :, freqs[0][0]:freqs[0][1], freqs[1][0]:freqs[1][1] ]  = compl_mat_vec_mul_2d(self.A, v[:, :, freqs[0][0]:freqs[0][1], freqs[1][0]:freqs[1][1] ] )
+    def plan(self, size, dtype, device):
+        """ Returns the (cached) spectral plan between the retained modes and the spectrum of the given size 
+            (batch, hidden_channels, dim_x, (possibly dim_y), ...); the trailing axes (e.g. time) are kept.
+            Plans are shared across batch sizes.
+        """
+        key = (tuple(size[1:]), dtype, device)
+        if key not in self.plans:
+            index = [retained_modes(size[2+i], self.modes[i], device) for i in range(len(self.modes))]
+            index += [slice(None)]*(len(size) - 2 - len(self.modes))
+            self.plans[key] = SpectralPlan(list(size), index, device, dtype)
+        return self.plans[key]
 
-        return Av
+    def forward(self, t, v):
+        """ v: (batch, modes1, (possibly modes2), hidden_size) -- complex"""
+        return compl_mat_vec_mul(self.compl_A(), v)
 
     def prod(self, t, v, xi):
-        # v is of shape (batch, 2, modes1, possibly modes2, hidden_channels) 
+        # v is of shape (batch, modes1, possibly modes2, hidden_channels) -- complex
         # xi is of shape (batch, dim_x, possibly dim_y, noise_size)
 
-        # lower and upper bounds of selected frequencies
-        freqs = [ (v.size(2+i)//2 - self.modes[i]//2, v.size(2+i)//2 + self.modes[i]//2) for i in range(len(self.modes)) ]
-        out_size = v.size() 
-        xi = xi[:,0,...] # we had to dupplicate xi so that its shape was compatible with the requirements of cdeint
+        # We form the vector field A + FFT o H o FFT^-1
+        sol = self.forward(t, v) + self.nonlinearity(t, v, xi)
+       
+        return sol
+
+    def nonlinearity(self, t, v, xi):
+        """ FFT o H o FFT^-1 (v), restricted to the retained modes """
 
-        # compute Av
-        Av = self.forward(t, v)
+        plan = self.plan((v.size(0), v.size(-1)) + xi.shape[1:-1], v.dtype, v.device)
 
-        # 1) FFT^-1
-        if self.flag1d:
-            dim_x = xi.size(1)
-            v = torch.fft.ifftshift(v, dim=[2]) # centering modes
-            v = torch.view_as_complex(v.permute(0,2,3,1).contiguous()) # (batch, modes1, hidden_channels) -- complex
-            z = torch.fft.ifftn(v, dim=[1], s=dim_x).real.permute(0,2,1) # FFT^-1(v) (batch, hidden_channels, dim_x) -- real
-        else:
-            dim_x, dim_y = xi.size(1), xi.size(2)
-            v = torch.fft.ifftshift(v, dim=[2, 3]) # centering modes
-            v = torch.view_as_complex(v.permute(0,2,3,4,1).contiguous()) # (batch, modes1, modes2, hidden_channels) -- complex
-            z = torch.fft.ifftn(v, dim=[1, 2], s=[dim_x, dim_y]).real.permute(0,3,1,2) # FFT^-1(v) (batch, hidden_channels, dim_x, dim_y) -- real
+        # 1) FFT^-1 (the retained modes are scattered in a spectrum of the size of the grid of xi)
+        z = torch.fft.ifftn(plan.scatter(v.movedim(-1, 1)), dim=self.dims).real # FFT^-1(v) (batch, hidden_channels, dim_x, possibly dim_y) -- real
 
         # 2) H o FFT^-1
         
@@ -116,24 +106,141 @@ class ControlledODE(torch.nn.Module):
         H = F_z + G_z_xi
 
         # 3) FFT o H o FFT^-1
-        out_ft = torch.zeros(out_size, device=H.device, dtype=H.dtype)
-        if self.flag1d:
-            v = torch.fft.fftn(H, dim=[2]) # FFT(H) (batch, hidden_channels, dim_x) -- complex 
-            v = torch.fft.fftshift(v, dim=[2]) # centering modes
-            v = torch.stack([v.real, v.imag], dim=1) # (batch, 2, hidden_channels, dim_x) 
-            v = v.permute(0,1,3,2)  # (batch, 2, dim_x, hidden_channels) 
-            out_ft[:, :, freqs[0][0]:freqs[0][1] ]  = v[:, :, freqs[0][0]:freqs[0][1] ] 
-        else:
-            v = torch.fft.fftn(H, dim=[2,3]) # FFT(H) (batch, hidden_channels, dim_x, dim_y) -- complex 
-            v = torch.fft.fftshift(v, dim=[2,3]) # centering modes
-            v = torch.stack([v.real, v.imag], dim=1) # (batch, 2, hidden_channels, dim_x, dim_y) 
-            v = v.permute(0,1,3,4,2)  # (batch, 2, dim_x, dim_y, hidden_channels) 
-            out_ft[:, :, freqs[0][0]:freqs[0][1], freqs[1][0]:freqs[1][1] ]  = v[:, :, freqs[0][0]:freqs[0][1], freqs[1][0]:freqs[1][1] ] 
+        v = plan.gather(torch.fft.fftn(H, dim=self.dims)) # (batch, hidden_channels, modes1, possibly modes2) -- complex 
 
-        # We form the vector field A + FFT o H o FFT^-1
-        sol = Av + out_ft
-       
-        return sol
+        return v.movedim(1, -1)
+
+    def exponentials(self, steps, order=2):
+        """ Matrix exponentials of the linear part for the step sizes in steps, as a dict
+            h -> (exp(hA), h*phi_1(hA), (if order 2) h*phi_2(hA)), each of shape (modes1, (possibly modes2), hidden, hidden).
+            If no gradient has to flow through them, they are cached and only recomputed when the step sizes or A change
+            (any in-place update of A, e.g. an optimizer step or load_state_dict, increments its version counter).
+        """
+        steps = tuple(sorted(set(steps)))
+
+        if torch.is_grad_enabled() and self.A.requires_grad:
+            return {h: self._exponentials(h, order) for h in steps}
+
+        key = (steps, order, self.A._version, self.A.data_ptr(), self.A.device)
+        if self.exponentials_cache is None or self.exponentials_cache[0] != key:
+            with torch.no_grad():
+                self.exponentials_cache = (key, {h: self._exponentials(h, order) for h in steps})
+        return self.exponentials_cache[1]
+
+    def _exponentials(self, h, order):
+        # phi functions from the exponential of the augmented matrix [[hA, I, 0], [0, 0, I], [0, 0, 0]]:
+        # its first block row is (exp(hA), phi_1(hA), phi_2(hA))
+        A = self.compl_A()
+        n = A.size(-1)
+        M = torch.zeros(*A.shape[:-2], (order+1)*n, (order+1)*n, dtype=A.dtype, device=A.device)
+        M[..., :n, :n] = h * A
+        eye = torch.eye(n, dtype=A.dtype, device=A.device)
+        for k in range(order):
+            M[..., k*n:(k+1)*n, (k+1)*n:(k+2)*n] = eye
+        E = torch.linalg.matrix_exp(M)[..., :n, :]
+        return tuple(E[..., k*n:(k+1)*n] * (h if k else 1.) for k in range(order+1))
+
+
+#=============================================================================================
+# Exponential time differencing: the linear part is integrated exactly, mode by mode, and 
+# only the non-linearity FFT o H o FFT^-1 is approximated (Cox and Matthews, 2002).
+#=============================================================================================
+
+ETD_METHODS = {'etd1': 1, 'etd2': 2}
+
+def etdint(X, z0, func, t, method='etd2', options=None):
+    """ Solves dz = (A z + N(z, X'(t))) dt with first order (exponential Euler) or second order (ETDRK2) 
+        exponential time differencing, with the same conventions as torchcde.cdeint.
+        - X: control with a derivative method
+        - z0: (batch, modes1, (possibly modes2), hidden_channels) -- complex
+        - func: ControlledODE
+        - t: (len_t,) output times
+        - method: 'etd1' or 'etd2'
+        - options: {'step_size': h} to take several steps of size at most h between two output times
+        returns z: (batch, modes1, (possibly modes2), len_t, hidden_channels) -- complex
+    """
+
+    order = ETD_METHODS[method]
+    step_size = (options or {}).get('step_size')
+
+    # step sizes between the output times
+    dts = (t[1:] - t[:-1]).tolist()
+    n_steps = [1 if step_size is None else max(1, math.ceil(dt/step_size - 1e-8)) for dt in dts]
+    exps = func.exponentials([dt/n for dt, n in zip(dts, n_steps)], order)
+
+    z, zs = z0, [z0]
+    for t0, dt, n in zip(t[:-1].tolist(), dts, n_steps):
+        h = dt/n
+        E = exps[h]
+        for k in range(n):
+            s = t0 + k*h
+            N = func.nonlinearity(s, z, X.derivative(s))
+            z_next = compl_mat_vec_mul(E[0], z) + compl_mat_vec_mul(E[1], N)
+            if order == 2:
+                N_next = func.nonlinearity(s+h, z_next, X.derivative(s+h))
+                z_next = z_next + compl_mat_vec_mul(E[2], N_next - N)
+            z = z_next
+        zs.append(z)
+
+    return torch.stack(zs, dim=-2)
+
+
+#=============================================================================================
+# Controlled ODE solver: the vector field is A v + FFT o H o FFT^-1 (v) with H evaluated on the 
+# control at time t, as in torchcde.cdeint. The state (retained modes) and the control (grid) 
+# do not share their batch dimensions, which torchcde.cdeint requires, so torchdiffeq is called directly.
+#=============================================================================================
+
+class _VectorField(torch.nn.Module):
+    def __init__(self, X, func, real=False):
+        super(_VectorField, self).__init__()
+        self.X = X
+        self.func = func
+        self.real = real # the state is the real view (..., 2) of the complex state
+
+    def forward(self, t, v):
+        if self.real:
+            return torch.view_as_real(self.func.prod(t, torch.complex(v[..., 0], v[..., 1]), self.X.derivative(t)))
+        return self.func.prod(t, v, self.X.derivative(t))
+
+
+def cdeint(X, z0, func, t, adjoint=False, **kwargs):
+    """ Same arguments and default tolerances as torchcde.cdeint
+        - X: control with a derivative method
+        - z0: (batch, modes1, (possibly modes2), hidden_channels) -- complex
+        - func: ControlledODE
+        - t: (len_t,) output times
+        - adjoint: if True, the gradients are computed by solving the adjoint equation backward in time 
+          (torchdiffeq.odeint_adjoint), which only stores the states at the times t. The parameters of func 
+          (A and the weights of spde_func) and the coefficients of X if they require gradients are the adjoint parameters.
+        returns z: (batch, modes1, (possibly modes2), len_t, hidden_channels) -- complex
+    """
+    if 'atol' not in kwargs:
+        kwargs['atol'] = 1e-6
+    if 'rtol' not in kwargs:
+        kwargs['rtol'] = 1e-4
+
+    if not adjoint:
+        out = torchdiffeq.odeint(func=_VectorField(X, func), y0=z0, t=t, **kwargs) # (len_t, batch, modes1, possibly modes2, hidden_channels)
+        return out.movedim(0, -2)
+
+    kwargs.setdefault('adjoint_atol', kwargs['atol'])
+    kwargs.setdefault('adjoint_rtol', kwargs['rtol'])
+    if 'adjoint_params' not in kwargs:
+        kwargs['adjoint_params'] = tuple(func.parameters()) + tuple(c for c in [X._coeffs] if c.requires_grad)
+
+    # the adjoint state of torchdiffeq concatenates the state with the (real) parameters, hence the real view of the state
+    out = torchdiffeq.odeint_adjoint(func=_VectorField(X, func, real=True), y0=torch.view_as_real(z0), t=t, **kwargs)
+    return torch.view_as_complex(out).movedim(0, -2)
+
+
+def control_coeffs(xi):
+    """ Coefficients of the linear interpolation of the noise, in the layout of the ODE solver. They can be computed once
+        per sample in the data pipeline and passed to DiffeqSolver as LinearInterpolation(coeffs) instead of the noise.
+        - xi: (batch, forcing_channels, dim_x, (possibly dim_y), dim_t), possibly with missing values (NaNs)
+        returns coeffs: (batch, dim_x, (possibly dim_y), dim_t, forcing_channels)
+    """
+    return linear_interpolation_coeffs(xi.movedim(1, -1)).contiguous()
 
 
 #=============================================================================================
@@ -158,59 +265,65 @@ class DiffeqSolver(nn.Module):
 
         if 'adjoint' not in kwargs:
             kwargs['adjoint']=False
+        assert not (kwargs['adjoint'] and kwargs.get('method') in ETD_METHODS), 'the adjoint method is not implemented for the exponential integrators'
+
+        # the forward states are stored (and, with the adjoint method, the backward solve restarts from them) 
+        # at the output times and every checkpoint_every time steps
+        self.checkpoint_every = kwargs.pop('checkpoint_every', 1)
         self.kwargs = kwargs
 
-    def forward(self, z0, xi, grid=None):
+    def forward(self, z0, xi, grid=None, times=None):
         """ - z0: (batch, hidden_channels, dim_x, (possibly dim_y))
-            - xi: (batch, forcing_channels, dim_x, (possibly dim_y), dim_t)
+            - xi: (batch, forcing_channels, dim_x, (possibly dim_y), dim_t), 
+                  or the precomputed control LinearInterpolation(control_coeffs(xi))
             - grid: should be speficied if computing gradients of the solution
+            - times: optional indices of the time steps to output (by default all the dim_t time steps)
         """
 
-        # lower and upper bounds of selected frequencies
-        freqs = [ (z0.size(2+i)//2 - self.modes[i]//2, z0.size(2+i)//2 + self.modes[i]//2) for i in range(len(self.modes)) ]
-
-        # compute fourier transform of initial condition  
-        z0_ft = torch.fft.fftshift(torch.fft.fftn(z0, dim=self.dims), dim=self.dims) 
-        z0_ft = torch.stack([z0_ft.real, z0_ft.imag], dim=1) # (batch, 2, hidden_channels, dim_x, possibly dim_y)
-
-        # antialiasing (the highest modes are set to zero)  # TODO: would padding be more efficient?
-        v0 = torch.zeros(z0_ft.size(), device=z0.device, dtype=z0.dtype)
-        if self.flag1d:
-            v0[:, :, :, freqs[0][0]:freqs[0][1] ]  = z0_ft[:, :, :, freqs[0][0]:freqs[0][1] ] 
-        else:
-            v0[:, :, :, freqs[0][0]:freqs[0][1], freqs[1][0]:freqs[1][1] ]  = z0_ft[:, :, :, freqs[0][0]:freqs[0][1], freqs[1][0]:freqs[1][1] ] 
+        # compute fourier transform of initial condition and keep the retained modes (antialiasing)
+        plan = self.cde.plan(z0.size(), z0.dtype.to_complex(), z0.device)
+        v0 = plan.gather(torch.fft.fftn(z0, dim=self.dims)) # (batch, hidden_channels, modes1, possibly modes2) -- complex
         
-        # reshape for cdeint 
-        if self.flag1d:
-            v0 = v0.permute(0,1,3,2) # (batch, 2, dim_x, hidden_channels)
-            xi = xi.permute(0,2,3,1) # (batch, dim_x, dim_t, hidden_channels)
+        # reshape for the ODE solver: the channels come last
+        v0 = v0.movedim(1, -1) # (batch, modes1, possibly modes2, hidden_channels) -- complex
+
+        # interpolate xi so that it can be queried at any time t (unless the control is precomputed)
+        if not isinstance(xi, LinearInterpolation):
+            xi = LinearInterpolation(control_coeffs(xi)) # coefficients (batch, dim_x, possibly dim_y, dim_t, noise_channels)
+
+        # times at which the solution is computed: the output times and the checkpoints 
+        # (the exponential integrators go through every time step)
+        dim_t = xi._t.size(0)
+        if times is None or self.kwargs.get('method') in ETD_METHODS:
+            solve = torch.arange(dim_t)
         else:
-            v0 = v0.permute(0,1,3,4,2) # (batch, 2, dim_x, dim_y, hidden_channels)
-            xi = xi.permute(0,2,3,4,1) # (batch, dim_x, dim_y, dim_t, hidden_channels)
-
-        # hack so that xi's shape is compatible with that of v0
-        xi = torch.stack([xi, torch.zeros_like(xi)], dim=1) # (batch,2, dim_x, possibly dim_y, dim_t, hidden_channels)
-
-        # interpolate xi so that it can be queried at any time t 
-        xi = torchcde.linear_interpolation_coeffs(xi)
-        xi = LinearInterpolation(xi) 
+            solve = torch.arange(0, dim_t, self.checkpoint_every)
+        if times is not None:
+            times = torch.as_tensor(times).reshape(-1) % dim_t
+            solve, index = torch.unique(torch.cat([solve, times]), return_inverse=True)
+            index = index[-times.size(0):]
   
-        # Solve the CDE,  get v of shape (batch, 2, dim_x, (possibly dim_y), dim_t, hidden_channels) 
-        v = torchcde.cdeint(X=xi,
-                            z0=v0,
-                            func=self.cde,
-                            t=xi._t,
-                            # adjoint = self.kwargs['adjoint'],
-                            **self.kwargs) 
-
-        # Compute z = FFT^-1(v) 
-        if self.flag1d:
-            v = v.permute(0,4,2,3,1) # (batch, hidden_channels, dim_x, dim_t, 2) 
+        # Solve the CDE,  get v of shape (batch, modes1, (possibly modes2), len(solve), hidden_channels) -- complex
+        if self.kwargs.get('method') in ETD_METHODS:
+            v = etdint(X=xi,
+                       z0=v0,
+                       func=self.cde,
+                       t=xi._t,
+                       method=self.kwargs['method'],
+                       options=self.kwargs.get('options'))
         else:
-            v = v.permute(0,5,2,3,4,1) # (batch, hidden_channels, dim_x, dim_y, dim_t, 2) 
+            v = cdeint(X=xi,
+                       z0=v0,
+                       func=self.cde,
+                       t=xi._t[solve.to(xi._t.device)],
+                       **self.kwargs) 
+        if times is not None:
+            v = v[..., index.to(v.device), :]
 
-        v = torch.view_as_complex(v.contiguous()) # (batch, hidden_channels, dim_x, dim_y, dim_t) -- complex 
+        # Compute z = FFT^-1(v) 
+        v = v.movedim(-1, 1) # (batch, hidden_channels, modes1, possibly modes2, len(times)) -- complex 
+        plan = self.cde.plan(v.shape[:2] + z0.shape[2:] + v.shape[-1:], v.dtype, v.device)
 
-        z = torch.fft.ifftn(torch.fft.ifftshift(v, dim=self.dims), dim=self.dims).real  # (batch, hidden_channels, dim_x, dim_y, dim_t) -- real 
+        z = torch.fft.ifftn(plan.scatter(v), dim=self.dims).real  # (batch, hidden_channels, dim_x, possibly dim_y, len(times)) -- real 
 
-        return z  # (batch, hidden_channels, dim_x, dim_t)
+        return z  # (batch, hidden_channels, dim_x, possibly dim_y, len(times))
@@ -0,0 +1,112 @@
+import torch
+
+#=============================================================================================
+# Streaming estimators of the statistics of an ensemble of predictions. The memory does not
+# depend on the number of samples: the samples are seen batch by batch and then discarded.
+#=============================================================================================
+
+class StreamingMoments(object):
+    """ Pointwise mean and variance of a stream of batches, with Welford's update merged batch-wise (Chan et al.). """
+
+    def __init__(self):
+        self.count = 0
+        self.mean = None
+        self.m2 = None    # sum of squared deviations from the mean
+
+    def update(self, x):
+        """ x: (batch, ...) a batch of samples """
+        x = x.double()
+        n, mean = x.size(0), x.mean(0)
+        m2 = ((x - mean)**2).sum(0)
+        if self.count == 0:
+            self.count, self.mean, self.m2 = n, mean, m2
+            return
+        total = self.count + n
+        delta = mean - self.mean
+        self.mean = self.mean + delta * n / total
+        self.m2 = self.m2 + m2 + delta**2 * self.count * n / total
+        self.count = total
+
+    @property
+    def var(self):
+        """ unbiased variance """
+        return self.m2 / max(self.count - 1, 1)
+
+
+class StreamingQuantiles(object):
+    """ Pointwise quantiles of a stream of batches with the P^2 algorithm (Jain and Chlamtac, 1985),
+        which tracks 5 markers per quantile and per point instead of storing the samples.
+    """
+
+    def __init__(self, quantiles):
+        self.p = torch.tensor(quantiles, dtype=torch.float64)
+        self.buffer = []    # the first 5 samples, used to initialise the markers
+        self.q = None       # marker heights (n_quantiles, 5, ...)
+        self.n = None       # marker positions (n_quantiles, 5, ...)
+        self.count = 0
+
+    def update(self, x):
+        """ x: (batch, ...) a batch of samples """
+        for x_ in x.double():
+            self.count += 1
+            if self.q is None:
+                self.buffer.append(x_)
+                if len(self.buffer) == 5:
+                    self._init()
+            else:
+                self._step(x_)
+
+    def _init(self):
+        x = torch.stack(self.buffer).sort(dim=0).values
+        self.buffer = []
+        shape = [len(self.p), 5] + [1]*(x.dim()-1)
+        self.q = x.unsqueeze(0).repeat(len(self.p), *[1]*x.dim())
+        self.n = torch.arange(1., 6., dtype=torch.float64, device=x.device).reshape(shape[1:]).expand_as(self.q).clone()
+        p = self.p.to(x.device)[:, None]
+        self.dn = torch.cat([torch.zeros_like(p), p/2, p, (1+p)/2, torch.ones_like(p)], dim=1).reshape(shape)
+        self.n_desired = (1. + 4.*self.dn)
+
+    def _step(self, x):
+        q, n = self.q, self.n
+
+        # cell k of the new sample (q_k <= x < q_k+1) and update of the extreme markers
+        k = (x.unsqueeze(0) >= q[:, 1:4]).sum(1, keepdim=True)
+        q[:, 0] = torch.minimum(q[:, 0], x)
+        q[:, 4] = torch.maximum(q[:, 4], x)
+        n += (torch.arange(5, device=x.device).reshape([1, 5] + [1]*x.dim()) > k).to(n.dtype)
+        self.n_desired = self.n_desired + self.dn
+
+        # adjust the heights of the middle markers with the piecewise-parabolic (or linear) formula
+        for i in range(1, 4):
+            d = self.n_desired[:, i] - n[:, i]
+            move = ((d >= 1) & (n[:, i+1] - n[:, i] > 1)) | ((d <= -1) & (n[:, i-1] - n[:, i] < -1))
+            d = torch.sign(d) * move
+            parabolic = q[:, i] + d / (n[:, i+1] - n[:, i-1]) * ((n[:, i] - n[:, i-1] + d) * (q[:, i+1] - q[:, i]) / (n[:, i+1] - n[:, i])
+                                                                + (n[:, i+1] - n[:, i] - d) * (q[:, i] - q[:, i-1]) / (n[:, i] - n[:, i-1]))
+            q_next = torch.where(d > 0, q[:, i+1], q[:, i-1])
+            n_next = torch.where(d > 0, n[:, i+1], n[:, i-1])
+            linear = q[:, i] + d * (q_next - q[:, i]) / (n_next - n[:, i])
+            ok = (q[:, i-1] < parabolic) & (parabolic < q[:, i+1])
+            q[:, i] = torch.where(move, torch.where(ok, parabolic, linear), q[:, i])
+            n[:, i] = n[:, i] + d
+
+    @property
+    def values(self):
+        """ quantiles (n_quantiles, ...) """
+        if self.q is None: # fewer than 5 samples: exact quantiles
+            return torch.quantile(torch.stack(self.buffer), self.p.to(self.buffer[0].device), dim=0)
+        return self.q[:, 2]
+
+
+def increments_sampler(sample_dW, dim_t):
+    """ Noise paths in the format of the data loaders (increments in time, starting from 0) from a sampler of
+        the noise increments over one time step, e.g. with the samplers of data/random_forcing.py
+            sample_dW = lambda n: get_twod_dW(bj, kappa, n, device)[0]
+        or  sample_dW = lambda n: np.sqrt(dt)*grf.sample(n)   with grf a GaussianRF
+        sample_dW: n -> (n, dim_x, (possibly dim_y))
+        returns a sampler n -> xi: (n, 1, dim_x, (possibly dim_y), dim_t)
+    """
+    def sampler(n):
+        dW = torch.stack([sample_dW(n) for _ in range(dim_t-1)], dim=-1)
+        return torch.cat([torch.zeros_like(dW[..., :1]), dW], dim=-1).unsqueeze(1)
+    return sampler
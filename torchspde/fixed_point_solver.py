@@ -2,6 +2,9 @@ import torch
 import torch.nn as nn
 import torch.nn.functional as F
 import numpy as np
+import functools
+from collections import OrderedDict
+from torch.utils.checkpoint import checkpoint
 
 #=============================================================================================
 # Convolution in physical space = pointwise mutliplication of complex tensors in Fourier space
@@ -27,14 +30,49 @@ def compl_mul2d_time(func_fft, kernel_tensor):
 # (x,t) -> z(x,t) 
 #=============================================================================================
 
-def inverseDFTn(u_ft, grid, dim, s=None): 
+# cache of the basis matrices of grids which do not require gradients, keyed by the grid storage; 
+# it keeps the last few grids alive and can be emptied with _dft_basis_cache.clear()
+_dft_basis_cache = OrderedDict()
+_dft_basis_cache_size = 8
+
+
+def _dft_bases(grid, grid_freq):
+    # grid: (dim_x, (possibly dim_y), (possibly dim_t), d), grid_freq: reciprocal grid
+    # returns, if the grid is a tensor-product grid, the basis of each axis i: (n, n) with n = grid.size(i) and 
+    # basis[k][j] = exp(2i pi <x_j, s_k>) / n, otherwise None
+    # the grid is identified by its storage (no device synchronisation), which is kept alive by the cache entry
+    key = (grid.data_ptr(), tuple(grid.size()), grid.stride(), grid._version, grid.device, grid.dtype)
+    if key in _dft_basis_cache:
+        _dft_basis_cache.move_to_end(key)
+        return _dft_basis_cache[key][-1]
+    bases = []
+    for i in range(grid.dim()-1):
+        index = tuple(slice(None) if j==i else 0 for j in range(grid.dim()-1)) + (i,)
+        x, x_freq = grid[index], grid_freq[index]
+        if not torch.equal(grid[..., i], x.reshape([-1 if j==i else 1 for j in range(grid.dim()-1)]).expand(grid.shape[:-1])):
+            bases = None
+            break
+        bases.append(torch.exp(2.*np.pi*1j*torch.outer(x_freq, x))/grid.size(i))
+    _dft_basis_cache[key] = (grid, bases)
+    if len(_dft_basis_cache) > _dft_basis_cache_size:
+        _dft_basis_cache.popitem(last=False)
+    return bases
+
+
+def inverseDFTn(u_ft, grid, dim, s=None, max_elements=2**24): 
     # u_ft: (batch, channels, modesx, (possibly modesy), modest) 
     #    or (channels, channels, modesx, (possibly modesy), modest)
     # grid: (dim_x, (possibly dim_y), dim_t, d) d=len(dim)
     # or    (dim_x, (possibly dim_y), d) d=len(dim)
     # or    (dim_t, 1)
+    # max_elements: maximal number of elements of the basis functions computed at once (tiling over the output points)
     # u: (batch, channels, modesx, (possibly modesy), dim_t) 
     # or (batch, channels, dim_x, (possibly dim_y), dim_t)
+    #
+    # The transform is computed one axis at a time, as a (batched) matrix product with the basis functions.
+    # If the grid is a tensor-product grid which does not require gradients, the basis matrices of each axis 
+    # are cached. Otherwise the basis depends on all the grid coordinates, which handles arbitrary point sets
+    # and keeps the dependence of the output on every grid point explicit for autograd (see gradients.py).
 
     assert len(grid.size()) == len(dim) + 1, 'Error grid size '
     if dim == [-1]:
@@ -52,198 +90,535 @@ def inverseDFTn(u_ft, grid, dim, s=None):
     # reciprocal frequency grid 
     N = torch.tensor(grid.size()[:-1], device=grid.device)
     with torch.no_grad():  
-        if len(grid.shape) == 2: 
-            delta = grid[1,:] - grid[0,:]
-            grid_freq = grid/(delta**2*N)
-        if len(grid.shape) == 3: 
-            delta = grid[1,1,:] - grid[0,0,:]
-            grid_freq = grid/(delta**2*N)     
-        elif len(grid.shape) == 4: 
-            delta = grid[1,1,1,:] - grid[0,0,0,:]  
-            grid_freq = grid/(delta**2*N)  
-    
-    shape = [u_ft.shape[i] if i in dim else 1 for i in range(len(u_ft.shape))]+[grid.shape[-1]]
-    grid = grid.reshape(shape)
-    grid_freq = grid_freq.reshape(shape)
+        delta = grid[(1,)*len(dim)] - grid[(0,)*len(dim)]
+        grid_freq = grid/(delta**2*N)
+
+    keep = [i for i in range(len(u_ft.shape)) if i not in dim]
+    bases = None if grid.requires_grad else _dft_bases(grid, grid_freq)
 
     for i in range(len(dim)):
 
-        u_ft_ = u_ft.unsqueeze(1 + dim[i])
-        grid_ = grid.unsqueeze(dim[i])
-        grid_freq_ = grid_freq.unsqueeze(1 + dim[i])
-        
-        grid_prod = grid_[..., i]*grid_freq_[..., i]    # grid_prod[k][j] = <x_j, s_k>  
-    
-        # basis functions
-        basis = torch.exp(2.*np.pi*1j*grid_prod)  
+        a = dim[i]
+
+        if bases is not None:
+            # tensor-product grid: the coordinates along axis a do not depend on the other axes 
+            basis = bases[i]
+            u_ft = torch.matmul(u_ft.movedim(a, -1), basis.to(u_ft.dtype)).movedim(-1, a)
+            continue
+
+        # the other transformed axes index batches of basis matrices (grid_prod[k][j] = <x_j, s_k>)
+        other = [d for d in dim if d != a]
+        R = [u_ft.size(d) for d in other]
+        x = grid[..., i].movedim(i, -1).unsqueeze(-2)              # (R..., 1, dim_a)
+        x_freq = grid_freq[..., i].movedim(i, -1).unsqueeze(-1)    # (R..., modes_a, 1)
+
+        perm = other + keep + [a]
+        u_ = u_ft.permute(perm)
+        size_ = list(u_.shape)
+        u_ = u_.reshape(R + [-1, size_[-1]])     # (R..., batch*channels, modes_a)
 
-        # compute inverse DFT
-        u_ft = torch.sum(u_ft_*basis, axis=dim[i])/N[i] # devide by N[i] to match the ifft with norm='backward'
+        # tile over the output points to bound the size of the basis
+        chunk = max(1, max_elements // max(1, int(np.prod(R)) * size_[-1]))
+        out = []
+        for x_ in x.split(chunk, dim=-1):
+            basis = torch.exp(2.*np.pi*1j*x_freq*x_)/N[i]    # (R..., modes_a, chunk)
+            out.append(torch.matmul(u_, basis.to(u_.dtype)))
+        u_ = torch.cat(out, dim=-1).reshape(size_[:-1] + [x.size(-1)])
+
+        u_ft = u_.permute([int(j) for j in np.argsort(perm)])
 
     return u_ft
 
+#=============================================================================================
+# Evaluation of a sparse spectral representation at arbitrary query points
+#=============================================================================================
+
+def pointwise_inverseDFT(coeffs, omegas, points, chunk_size=4096):
+    # coeffs: (batch, channels, n_modes) complex coefficients
+    # omegas: (n_modes, d) angular frequencies, in radians per grid step
+    # points: (n_points, d) or (batch, n_points, d) query points, in grid-index units
+    # u: (batch, channels, n_points) with u(p) = Re sum_k coeffs_k exp(i <omegas_k, p>)
+
+    u = []
+    with torch.autocast(device_type=coeffs.device.type, enabled=False):   # the phases need single precision
+        for p in points.float().split(chunk_size, dim=-2):
+            basis = torch.exp(1j*torch.matmul(p, omegas.transpose(0, 1)))    # (possibly batch), chunk, n_modes 
+            if len(p.size())==2:
+                u.append(torch.einsum('bck, pk -> bcp', coeffs, basis).real)
+            else:
+                u.append(torch.einsum('bck, bpk -> bcp', coeffs, basis).real)
+    return torch.cat(u, dim=-1)
+
+#=============================================================================================
+# Half-spectrum (real-to-complex) utilities
+#=============================================================================================
+
+def hermitian_extension(u_ft, n, dims):
+    # u_ft: half spectrum along the last axis as returned by rfftn, of size n//2+1 (no fftshift)
+    # dims: the other axes over which the spectrum is taken (no fftshift)
+    # returns the full spectrum u of size n along the last axis, such that ifftn(u).real == irfftn(u_ft)
+
+    # u(k, -k_t) = conj(u(-k, k_t))
+    neg = u_ft[..., 1:n-u_ft.size(-1)+1].flip(-1).conj()
+    if len(dims) > 0:
+        neg = torch.roll(torch.flip(neg, dims=dims), shifts=[1]*len(dims), dims=dims)
+    return torch.cat([u_ft, neg], dim=-1)
+
+
+def spectrum_full_to_half(weights):
+    # weights: (channels, channels, modes1, (possibly modes2), modes_t) full-spectrum kernel, centred on the zero frequency
+    # returns: (channels, channels, modes1, (possibly modes2), modes_t//2+1) half-spectrum kernel, whose
+    #          Hermitian part matches the real part of the full-spectrum convolution. The only contributions
+    #          lost are those paired with the unrepresented highest space frequency modes//2.
+
+    # extend every frequency axis with the (zero) frequency +modes//2 so that k -> -k is a flip 
+    size = list(weights.shape[:2]) + [m+1 for m in weights.shape[2:]]
+    padded = torch.zeros(size, device=weights.device, dtype=weights.dtype)
+    padded[(slice(None), slice(None)) + tuple(slice(0, m) for m in weights.shape[2:])] = weights
+
+    # Hermitian part: (K(k) + conj(K(-k)))/2
+    dims = list(range(2, weights.dim()))
+    sym = 0.5 * (padded + torch.flip(padded, dims=dims).conj())
+
+    # keep the original space modes and the time frequencies 0, ..., modes_t//2
+    return sym[(slice(None), slice(None)) + tuple(slice(0, m) for m in weights.shape[2:-1]) + (slice(weights.size(-1)//2, None),)].contiguous()
+
+#=============================================================================================
+# FFTs are not supported in reduced precision: the spectral part is computed in single precision
+#=============================================================================================
+
+def single_precision(method):
+    """ Runs a method of KernelConvolution in single precision with autocast disabled. 
+        Reduced-precision inputs (e.g. from SPDEFunc under autocast) are cast back to float32. 
+    """
+    @functools.wraps(method)
+    def wrapper(self, z, *args, **kwargs):
+        if z.dtype in [torch.float16, torch.bfloat16]:
+            z = z.float()
+        with torch.autocast(device_type=z.device.type, enabled=False):
+            return method(self, z, *args, **kwargs)
+    return wrapper
+
+#=============================================================================================
+# Spectral plan: retained modes in unshifted FFT order and a reusable output buffer
+#=============================================================================================
+
+class SpectralPlan(object):
+    """ Scatter/gather indices of the retained Fourier modes for a given input shape (up to the batch 
+        size), dtype and device. The indices are in unshifted FFT order (negative frequencies at the end 
+        of each axis), so that no fftshift/ifftshift is needed. The output buffer is allocated once for 
+        the largest batch seen, and sliced and reused whenever no gradient has to flow through it.
+    """
+
+    def __init__(self, out_size, index, device, dtype=torch.cfloat):
+        # out_size: size of the full spectral output (batch, channels, ...), the batch size is that of the input of scatter
+        # index: for each transformed axis, either a tensor of retained indices or a slice
+
+        self.out_size = list(out_size[1:])
+        self.device = device
+        self.dtype = dtype
+
+        # broadcast the index tensors against each other so that they select a block of modes
+        n_tensors = sum(torch.is_tensor(i) for i in index)
+        block, k = [slice(None), slice(None)], 0
+        for i in index:
+            if torch.is_tensor(i):
+                block.append(i.reshape([-1 if j==k else 1 for j in range(n_tensors)]))
+                k += 1
+            else:
+                block.append(i)
+        self.block = tuple(block)
+
+        self.workspace = None
+
+    def gather(self, u_ft):
+        return u_ft[self.block]
+
+    def scatter(self, u_ft):
+        # the entries outside of the block are never written, hence stay zero in the reused workspace
+        size = [u_ft.size(0)] + self.out_size
+        if torch.is_grad_enabled() and u_ft.requires_grad:
+            out_ft = torch.zeros(size, device=self.device, dtype=self.dtype)
+        else:
+            if self.workspace is None or self.workspace.size(0) < size[0]:
+                self.workspace = torch.zeros(size, device=self.device, dtype=self.dtype)
+            out_ft = self.workspace[:size[0]]
+        out_ft[self.block] = u_ft
+        return out_ft
+
+
+def retained_modes(n, m, device=None):
+    # indices of the frequencies -m//2, ..., m//2-1 in an unshifted FFT of size n
+    if m > n:
+        raise ValueError('{} modes are retained on an axis of only {} grid points'.format(m, n))
+    return torch.arange(-(m//2), m//2, device=device) % n
+
 #=============================================================================================
 # Semigroup action is integration against a kernel
 #=============================================================================================
 class KernelConvolution(nn.Module):
-    def __init__(self, channels, modes1, modes2, modes3=None):
+    def __init__(self, channels, modes1, modes2, modes3=None, real_fft=False):
         super(KernelConvolution, self).__init__()
 
         """ This module has a kernel parametrized as a complex tensor in the spectral domain. 
             The method forward computes S*H;
             The method forward_init computes S_t*u_0.
+            If real_fft is True, the kernel only stores the non-negative time frequencies (the negative 
+            ones follow by Hermitian symmetry) and real-to-complex FFTs are used along the time axis.
+            A full-spectrum checkpoint loaded with real_fft=True keeps its kernel in weights_init for 
+            S_t*u_0, whose time dependence F_t^-1(ifftshift(K)) is not determined by the half kernel.
         """
 
         self.scale = 1. / (channels**2)
+        self.real_fft = real_fft
 
         # define kernel-tensor shape depending on dim of the problem
         if not modes3: # 1d
             self.modes = [modes1, modes2]
             self.dims = [2,3]
-            self.weights = nn.Parameter(self.scale * torch.rand(channels, channels, modes1, modes2,  dtype=torch.cfloat)) # K_theta in paper
         else: # 2d
             self.modes = [modes1, modes2, modes3]
             self.dims = [2,3,4]
-            self.weights = nn.Parameter(self.scale * torch.rand(channels, channels, modes1, modes2, modes3, dtype=torch.cfloat)) # K_theta in paper
-       
-   
+
+        # number of retained time frequencies
+        modes_t = self.modes[-1]//2 + 1 if real_fft else self.modes[-1]
+        self.weights = nn.Parameter(self.scale * torch.rand(channels, channels, *self.modes[:-1], modes_t, dtype=torch.cfloat)) # K_theta in paper
+
+        # full-spectrum kernel of S_t*u_0, only set when a full-spectrum checkpoint is converted
+        self.register_parameter('weights_init', None)
+
+        # spectral plans, keyed by (input size without the batch size, dtype, device, init, half spectrum)
+        self.plans = {}
+
+        # time kernel K_t of the last forward_init in eval mode, keyed by (dim_t, time grid, weights version)
+        self.kernel_t_cache = None
+
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        # convert full-spectrum checkpoints when loading into a half-spectrum kernel
+        key, key_init = prefix + 'weights', prefix + 'weights_init'
+        if self.real_fft and key in state_dict and state_dict[key].shape[-1] == self.modes[-1] != self.weights.size(-1):
+            state_dict[key_init] = state_dict[key]
+            state_dict[key] = spectrum_full_to_half(state_dict[key])
+        if self.real_fft and key_init in state_dict and self.weights_init is None:
+            self.weights_init = nn.Parameter(torch.empty_like(state_dict[key_init], device=self.weights.device))
+        super(KernelConvolution, self)._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+
+    def plan(self, z, init=False):
+        """ Returns the (cached) spectral plan for inputs of the same size (up to the batch size), dtype and device as z. """
+        half = self.half_spectrum(init)
+        key = (tuple(z.shape[1:]), z.dtype, z.device, init, half)
+        if key not in self.plans:
+            size = list(z.size())
+            if self.modes[-1] > size[-1]:
+                raise ValueError('{} time modes are retained on only {} time steps'.format(self.modes[-1], size[-1]))
+            index = [retained_modes(size[2+i], self.modes[i], z.device) for i in range(len(self.modes)-1)]
+            modes_t = self.weights.size(-1)
+            if half:
+                size[-1] = size[-1]//2 + 1
+                index.append(slice(0, modes_t))
+            elif not init:
+                index.append(retained_modes(size[-1], self.modes[-1], z.device))
+            self.plans[key] = SpectralPlan(size, index, z.device)
+        return self.plans[key]
+
+    def half_spectrum(self, init=False):
+        """ Whether S*u (or S_t*u_0 if init) is computed from the half-spectrum kernel. """
+        return self.real_fft and not (init and self.weights_init is not None)
+
+    def kernel_init(self):
+        """ The kernel of S_t*u_0. """
+        return self.weights if self.weights_init is None else self.weights_init
+
+    @single_precision
     def forward(self, z, grid=None, init=False):
         """ z: (batch, channels, dim_x, (possibly dim_y), dim_t)
         grid: dim_x, (possibly dim_y), dim_t, d) with d=2 or 3 """
-        
-        # lower and upper bounds of selected frequencies
-        freqs = [ (z.size(2+i)//2 - self.modes[i]//2, z.size(2+i)//2 + self.modes[i]//2) for i in range(len(self.modes)) ]
- 
-        if not init: # S * u
 
-            # Compute FFT
+        if init: # S_t * z_0
+            return self.forward_init(z, grid)
+
+        # S * u 
+        plan = self.plan(z)
+
+        # Compute FFT
+        if self.real_fft:
+            z_ft = torch.fft.rfftn(z, dim=self.dims)
+        else:
             z_ft = torch.fft.fftn(z, dim=self.dims)
-            z_ft = torch.fft.fftshift(z_ft, dim=self.dims)
- 
-            # Pointwise multiplication of kernel_tensor and func_fft
-            out_ft = torch.zeros(z.size(), device=z.device, dtype=torch.cfloat)
-            if len(self.modes)==2: # 1d case
-                out_ft[:, :, freqs[0][0]:freqs[0][1], freqs[1][0]:freqs[1][1] ] = compl_mul2d(z_ft[:, :, freqs[0][0]:freqs[0][1], freqs[1][0]:freqs[1][1] ], self.weights)
-            else: # 2d case
-                out_ft[:, :, freqs[0][0]:freqs[0][1], freqs[1][0]:freqs[1][1], freqs[2][0]:freqs[2][1] ] = compl_mul3d(z_ft[:, :, freqs[0][0]:freqs[0][1], freqs[1][0]:freqs[1][1], freqs[2][0]:freqs[2][1] ], self.weights)
-            
-            # Compute Inverse FFT  
-            out_ft = torch.fft.ifftshift(out_ft, dim=self.dims) 
-            
-            # (*) if the grid is provided, then compute the final DFT_inverse by hand to make explicit the dependence on the input and allow for autograd to compute gradients.
-            if grid is None:
-                z = torch.fft.ifftn(out_ft, dim=self.dims)
-            else:  
-                z = inverseDFTn(out_ft, grid, self.dims)
 
-            return z.real
+        # Pointwise multiplication of kernel_tensor and func_fft
+        if len(self.modes)==2: # 1d case
+            out_ft = plan.scatter(compl_mul2d(plan.gather(z_ft), self.weights))
+        else: # 2d case
+            out_ft = plan.scatter(compl_mul3d(plan.gather(z_ft), self.weights))
+
+        # Compute Inverse FFT  
+        # (*) if the grid is provided, then compute the final DFT_inverse by hand to make explicit the dependence on the input and allow for autograd to compute gradients.
+        if self.real_fft:
+            if grid is None:
+                return torch.fft.irfftn(out_ft, dim=self.dims, s=z.shape[2:])
+            return inverseDFTn(hermitian_extension(out_ft, z.size(-1), self.dims[:-1]), grid, self.dims).real
 
-        else: # S_t * z_0
-            return self.forward_init(z, grid)
+        if grid is None:
+            z = torch.fft.ifftn(out_ft, dim=self.dims)
+        else:  
+            z = inverseDFTn(out_ft, grid, self.dims)
 
+        return z.real
     
+    def kernel_t(self, dim_t, grid=None):
+        """ Time kernel K_t = F_t^-1(K) on dim_t time steps (or on the time grid). 
+            In eval mode, if no gradient has to flow through it, K_t is cached and only recomputed when 
+            dim_t, the time grid or the weights change (any in-place update of the weights, e.g. an 
+            optimizer step or load_state_dict, increments their version counter).
+        """
+
+        if grid is not None:
+            gridt = grid[...,-1].unsqueeze(-1)
+            gridt = gridt[0] if len(self.modes)==2 else gridt[0,0]
+
+        weights = self.kernel_init()
+        if self.training or (torch.is_grad_enabled() and (weights.requires_grad or (grid is not None and grid.requires_grad))):
+            return self._kernel_t(dim_t, gridt if grid is not None else None)
+
+        # the time grid is identified by its storage, which is kept alive by the cache entry
+        grid_key = None if grid is None else (gridt.data_ptr(), tuple(gridt.size()), gridt.stride(), gridt._version, gridt.device)
+        key = (int(dim_t), grid_key, weights._version, weights.data_ptr(), weights.device)
+        if self.kernel_t_cache is None or self.kernel_t_cache[0] != key:
+            with torch.no_grad():
+                self.kernel_t_cache = (key, grid, self._kernel_t(dim_t, gridt if grid is not None else None))
+        return self.kernel_t_cache[-1]
+
+    def _kernel_t(self, dim_t, gridt=None):
+        weights = torch.fft.ifftshift(self.kernel_init(), dim=[-1])
+        if gridt is None: # (*)
+            return torch.fft.ifftn(weights, dim=[-1], s=dim_t)
+        return inverseDFTn(weights, gridt, dim=[-1], s=[dim_t])
+
+    @single_precision
     def forward_init(self, z0_path, grid=None):
-        """ z0_path: (batch, channels, dim_x, (possibly dim_y), dim_t)
+        """ z0_path: (batch, channels, dim_x, (possibly dim_y), dim_t), constant in time
             grid: dim_x, (possibly dim_y), dim_t, d) with d=2 or 3"""
-        if grid is not None:
-            gridx, gridt = grid[...,0,:-1], grid[...,-1].unsqueeze(-1)
-            if len(self.modes)==2:
-                gridt = gridt[0]
-            else:
-                gridt = gridt[0,0]
 
-        # lower and upper bounds of selected frequencies
-        freqs = [ (z0_path.size(2+i)//2 - self.modes[i]//2, z0_path.size(2+i)//2 + self.modes[i]//2) for i in range(len(self.modes)-1) ]
+        plan = self.plan(z0_path, init=True)
+        half = self.half_spectrum(init=True)
 
         # K_t = F_t^-1(K)  
-        if grid is None: # (*)
-            weights = torch.fft.ifftn(torch.fft.ifftshift(self.weights, dim=[-1]), dim=[-1], s=z0_path.size(-1))
-        else:  
-            weights = inverseDFTn(torch.fft.ifftshift(self.weights, dim=[-1]), gridt, dim=[-1], s=[z0_path.size(-1)])
+        if half: # the time transform is applied to the output
+            weights = self.weights 
+        else:
+            weights = self.kernel_t(z0_path.size(-1), grid)
 
-        # Compute FFT of the input signal to convolve
-        z_ft = torch.fft.fftn(z0_path, dim=self.dims[:-1])
-        z_ft = torch.fft.fftshift(z_ft, dim=self.dims[:-1])
+        # Compute FFT of the input signal to convolve (the path is constant in time)
+        z_ft = plan.gather(torch.fft.fftn(z0_path[..., 0], dim=self.dims[:-1]).unsqueeze(-1))
+        z_ft = z_ft.expand(*z_ft.shape[:-1], weights.size(-1))
 
         # Pointwise multiplication by complex matrix 
-        out_ft = torch.zeros(z0_path.size(), device=z0_path.device, dtype=torch.cfloat)
         if len(self.modes)==2: # 1d case
-            out_ft[:, :, freqs[0][0]:freqs[0][1], : ] = compl_mul1d_time(z_ft[:, :, freqs[0][0]:freqs[0][1] ], weights)
+            out_ft = plan.scatter(compl_mul1d_time(z_ft, weights))
         else: # 2d case
-            out_ft[:, :, freqs[0][0]:freqs[0][1], freqs[1][0]:freqs[1][1], : ] = compl_mul2d_time(z_ft[:, :, freqs[0][0]:freqs[0][1], freqs[1][0]:freqs[1][1] ], weights)
-
+            out_ft = plan.scatter(compl_mul2d_time(z_ft, weights))
 
         # Compute Inverse FFT   
-        out_ft = torch.fft.ifftshift(out_ft, dim=self.dims[:-1])
+        if half:
+            if grid is None: # (*)
+                return torch.fft.irfftn(out_ft, dim=self.dims, s=z0_path.shape[2:])
+            return inverseDFTn(hermitian_extension(out_ft, z0_path.size(-1), self.dims[:-1]), grid, self.dims).real
 
         if grid is None: # (*)
             z = torch.fft.ifftn(out_ft, dim=self.dims[:-1])
         else: 
-            z = inverseDFTn(out_ft, gridx, self.dims[:-1])
+            z = inverseDFTn(out_ft, grid[...,0,:-1], self.dims[:-1])
         return z.real
 
 
+    @single_precision
+    def spectrum(self, z, init=False):
+        """ Sparse spectral representation of S*z (or of S_t*z_0 if init) on the retained modes.
+            z: (batch, channels, dim_x, (possibly dim_y), dim_t)
+            returns coeffs (batch, channels, n_modes) and omegas (n_modes, d) such that the output 
+            at a point p in grid-index units is Re sum_k coeffs_k exp(i <omegas_k, p>) (see pointwise_inverseDFT)
+        """
+        sizes = list(z.shape[2:])
+        plan = self.plan(z, init=init)
+        half = self.half_spectrum(init)
+        weights = self.kernel_init() if init else self.weights
+
+        if init: 
+            # the time dependence of K_t is that of F_t^-1(ifftshift(K)), padded to dim_t (see forward_init)
+            if not half:
+                weights = torch.fft.ifftshift(weights, dim=[-1])
+            z_ft = plan.gather(torch.fft.fftn(z[..., 0], dim=self.dims[:-1]).unsqueeze(-1))
+            z_ft = z_ft.expand(*z_ft.shape[:-1], weights.size(-1))
+            freqs_t = torch.arange(weights.size(-1), device=z.device)
+        else:
+            z_ft = plan.gather(torch.fft.rfftn(z, dim=self.dims) if self.real_fft else torch.fft.fftn(z, dim=self.dims))
+            freqs_t = torch.arange(weights.size(-1), device=z.device) if self.real_fft else torch.arange(-(self.modes[-1]//2), self.modes[-1]//2, device=z.device)
+
+        if len(self.modes)==2: # 1d case
+            coeffs = compl_mul2d(z_ft, weights)
+        else: # 2d case
+            coeffs = compl_mul3d(z_ft, weights)
+
+        # signed frequencies along each axis
+        freqs = [torch.arange(-(m//2), m//2, device=z.device) for m in self.modes[:-1]] + [freqs_t]
+
+        # normalisation of the inverse FFT, and negative time frequencies accounted for by Hermitian symmetry
+        scale = torch.ones(len(freqs_t), device=z.device) / np.prod(sizes)
+        if half:
+            scale[(freqs_t > 0) & (2*freqs_t < sizes[-1])] *= 2.
+        coeffs = (coeffs * scale).reshape(coeffs.size(0), coeffs.size(1), -1)
+
+        omegas = torch.stack(torch.meshgrid(*freqs, indexing='ij'), dim=-1).reshape(-1, len(freqs))
+        omegas = 2.*np.pi*omegas / torch.tensor(sizes, device=z.device)
+
+        return coeffs, omegas
+
+
 #=============================================================================================
 # SPDE solver: neural fixed point problem solved by Picard's iteration.
 #=============================================================================================
 
 class NeuralFixedPoint(nn.Module):
-    def __init__(self, spde_func, n_iter, modes1, modes2, modes3=None):
+    def __init__(self, spde_func, n_iter, modes1, modes2, modes3=None, real_fft=False, **kwargs):
         super(NeuralFixedPoint, self).__init__()
 
         # self.padding = int(2**(np.ceil(np.log2(abs(2*T-1)))))
 
         # number of Picard's iterations
         self.n_iter = n_iter
+
+        # in eval mode, if a tolerance is given the iterations stop (per sample) once the relative 
+        # residual |z_{k+1}-z_k|/|z_{k+1}| is below tol, or after max_iter iterations
+        self.tol = kwargs.get('tol', None)
+        self.max_iter = kwargs.get('max_iter', None) or n_iter
+
+        # number of iterations used by each sample in the last forward pass
+        self.n_iters = None
+
+        # if given, the Picard's iterations are split into this number of gradient-checkpointed segments: 
+        # only the iterates at the segment boundaries are stored and the rest is recomputed during backward.
+        # NB: the running statistics of the batch norms in spde_func are updated again by the recomputation.
+        self.checkpoint_segments = kwargs.get('checkpoint_segments', None)
         
         # vector fields F and G
         self.spde_func = spde_func
         
         # semigroup
-        self.convolution = KernelConvolution(spde_func.hidden_channels, modes1, modes2, modes3) 
+        self.convolution = KernelConvolution(spde_func.hidden_channels, modes1, modes2, modes3, real_fft) 
 
+    def vector_field(self, z, xi):
+        """ H(z, xi) = F(z) + G(z)xi """
 
-    def forward(self, z0, xi, grid=None):
+        F_z, G_z = self.spde_func(z) 
+
+        if len(xi.size())==4:
+            G_z_xi = torch.einsum('abcde, acde -> abde', G_z, xi.to(G_z.dtype))
+        else:
+            G_z_xi = torch.einsum('abcdef, acdef -> abdef', G_z, xi.to(G_z.dtype))
+
+        return F_z + G_z_xi
+
+    def forward(self, z0, xi, grid=None, index=None):
         """ - z0: (batch, hidden_channels, dim_x (possibly dim_y))
             - xi: (batch, forcing_channels, dim_x, (possibly dim_y), dim_t)
             - grid: (dim_x, (possibly dim_y), dim_t)
+            - index: optional (batch,) indices of the initial condition of each noise path. Then z0 is 
+                     (n_init, hidden_channels, dim_x (possibly dim_y)) and S_t * z_0 is computed once per initial condition.
         """
         
-        # if True 1d, else 2d
         assert len(xi.size()) in [4,5], '1d and 2d cases only are implemented '
-        dim_flag = len(xi.size())==4
-
-        # constant path
-        if dim_flag:
-            z0_path = z0.unsqueeze(-1).repeat(1, 1, 1, xi.size(-1)) 
-        else:
-            z0_path = z0.unsqueeze(-1).repeat(1, 1, 1, 1, xi.size(-1)) 
 
         # S_t * z_0
-        z0_path =  self.convolution(z0_path, grid=grid, init=True) 
+        z0_path = self.convolution(z0.unsqueeze(-1).expand(*z0.shape, xi.size(-1)), grid=grid, init=True) 
+        if index is not None:
+            z0_path = z0_path[index]
+
+        if self.tol is not None and not self.training and grid is None:
+            return self.forward_tol(z0_path, xi)
 
         # step 1 of Picard
         z = z0_path
 
         # Picard's iterations
-        for i in range(self.n_iter):
+        if self.checkpoint_segments and torch.is_grad_enabled():
+            bounds = np.unique(np.linspace(0, self.n_iter, self.checkpoint_segments+1).astype(int))
+            for start, end in zip(bounds[:-1], bounds[1:]):
+                z = checkpoint(self.picard, z, z0_path, xi, int(start), int(end), grid, use_reentrant=False)
+            y = z
+        else:
+            y = self.picard(z, z0_path, xi, 0, self.n_iter, grid)
 
-            F_z, G_z = self.spde_func(z) 
+        self.n_iters = torch.full((z0_path.size(0),), self.n_iter, dtype=torch.long, device=z0_path.device)
+        
+        return y
 
-            if dim_flag:
-                G_z_xi = torch.einsum('abcde, acde -> abde', G_z, xi)
-            else:
-                G_z_xi = torch.einsum('abcdef, acdef -> abdef', G_z, xi)
+    def forward_points(self, z0, xi, points, chunk_size=4096):
+        """ Solution evaluated at arbitrary query points, from the spectral representation of the last iteration.
+            - z0: (batch, hidden_channels, dim_x (possibly dim_y))
+            - xi: (batch, forcing_channels, dim_x, (possibly dim_y), dim_t)
+            - points: (n_points, d) or (batch, n_points, d) with d=2 or 3, in grid-index units 
+                      (the j-th grid point along an axis has coordinate j)
+            returns z: (batch, hidden_channels, n_points)
+        """
+
+        assert len(xi.size()) in [4,5], '1d and 2d cases only are implemented '
+
+        # constant path and S_t * z_0
+        z0_path = z0.unsqueeze(-1).expand(*z0.shape, xi.size(-1))
+        z0_path_ = self.convolution(z0_path, init=True)
+
+        # all but the last Picard's iteration
+        z = self.picard(z0_path_, z0_path_, xi, 0, self.n_iter-1)
+
+        # last iteration, in the spectral domain: z = S_t * z_0 + S * H(z, xi)
+        coeffs_init, omegas_init = self.convolution.spectrum(z0_path, init=True)
+        coeffs, omegas = self.convolution.spectrum(self.vector_field(z, xi))
+
+        return pointwise_inverseDFT(torch.cat([coeffs_init, coeffs], dim=-1), torch.cat([omegas_init, omegas], dim=0), points.to(omegas.dtype), chunk_size)
+
+    def picard(self, z, z0_path, xi, start, end, grid=None):
+        """ Picard's iterations start, ..., end-1. The grid is only used in the last iteration (see (*)). """
+
+        for i in range(start, end):
 
-            H_z_xi = F_z + G_z_xi
+            H_z_xi = self.vector_field(z, xi)
 
             if i==self.n_iter-1:
-                y = z0_path + self.convolution(H_z_xi, grid=grid)
+                z = z0_path + self.convolution(H_z_xi, grid=grid)
             else:
-                y = z0_path + self.convolution(H_z_xi)
-            
-            z = y
-        
+                z = z0_path + self.convolution(H_z_xi)
+
+        return z
+
+    def forward_tol(self, z0_path, xi):
+        """ Picard's iterations with per-sample early exit. Converged samples are removed from the active batch.
+            - z0_path: S_t * z_0 (batch, hidden_channels, dim_x, (possibly dim_y), dim_t)
+            - xi: (batch, forcing_channels, dim_x, (possibly dim_y), dim_t)
+        """
+
+        batch = z0_path.size(0)
+        y = z0_path.clone()
+        self.n_iters = torch.zeros(batch, dtype=torch.long, device=z0_path.device)
+
+        # indices of the samples which have not converged yet
+        active = torch.arange(batch, device=z0_path.device)
+        z = z0_path
+
+        for i in range(self.max_iter):
+
+            y_active = z0_path[active] + self.convolution(self.vector_field(z, xi[active]))
+
+            res = (y_active - z).reshape(active.size(0), -1).norm(dim=1) / (1e-9 + y_active.reshape(active.size(0), -1).norm(dim=1))
+            y[active] = y_active
+            self.n_iters[active] += 1
+
+            # shrink the active batch
+            not_converged = res >= self.tol
+            active, z = active[not_converged], y_active[not_converged]
+            if active.size(0) == 0:
+                break
+
         return y
 
 
@@ -14,78 +14,35 @@ _two_pi = 2 * math.pi
 _inv_two_pi = 1 / _two_pi
 
 
-def _linear_interpolation_coeffs_with_missing_values_scalar(t, x):
-    # t and X both have shape (length,)
-
-    not_nan = ~torch.isnan(x)
-    path_no_nan = x.masked_select(not_nan)
-
-    if path_no_nan.size(0) == 0:
-        # Every entry is a NaN, so we take a constant path with derivative zero, so return zero coefficients.
-        return torch.zeros(x.size(0), dtype=x.dtype, device=x.device)
-
-    if path_no_nan.size(0) == x.size(0):
-        # Every entry is not-NaN, so just return.
-        return x
-
-    x = x.clone()
+def _linear_interpolation_coeffs_with_missing_values(t, x):
+    # t has shape (length,) and x has shape (..., length). Every scalar path x[i, ..., :] is filled independently.
     # How to deal with missing values at the start or end of the time series? We impute an observation at the very start
     # equal to the first actual observation made, and impute an observation at the very end equal to the last actual
-    # observation made, and then proceed as normal.
-    if torch.isnan(x[0]):
-        x[0] = path_no_nan[0]
-    if torch.isnan(x[-1]):
-        x[-1] = path_no_nan[-1]
-
-    nan_indices = torch.arange(x.size(0), device=x.device).masked_select(torch.isnan(x))
-
-    if nan_indices.size(0) == 0:
-        # We only had missing values at the start or end
-        return x
-
-    prev_nan_index = nan_indices[0]
-    prev_not_nan_index = prev_nan_index - 1
-    prev_not_nan_indices = [prev_not_nan_index]
-    for nan_index in nan_indices[1:]:
-        if prev_nan_index != nan_index - 1:
-            prev_not_nan_index = nan_index - 1
-        prev_nan_index = nan_index
-        prev_not_nan_indices.append(prev_not_nan_index)
-
-    next_nan_index = nan_indices[-1]
-    next_not_nan_index = next_nan_index + 1
-    next_not_nan_indices = [next_not_nan_index]
-    for nan_index in reversed(nan_indices[:-1]):
-        if next_nan_index != nan_index + 1:
-            next_not_nan_index = nan_index + 1
-        next_nan_index = nan_index
-        next_not_nan_indices.append(next_not_nan_index)
-    next_not_nan_indices = reversed(next_not_nan_indices)
-    for prev_not_nan_index, nan_index, next_not_nan_index in zip(prev_not_nan_indices,
-                                                                 nan_indices,
-                                                                 next_not_nan_indices):
-        prev_stream = x[prev_not_nan_index]
-        next_stream = x[next_not_nan_index]
-        prev_time = t[prev_not_nan_index]
-        next_time = t[next_not_nan_index]
-        time = t[nan_index]
-        ratio = (time - prev_time) / (next_time - prev_time)
-        x[nan_index] = prev_stream + ratio * (next_stream - prev_stream)
-
-    return x
-
-
-def _linear_interpolation_coeffs_with_missing_values(t, x):
-    if x.ndimension() == 1:
-        # We have to break everything down to individual scalar paths because of the possibility of missing values
-        # being different in different channels
-        return _linear_interpolation_coeffs_with_missing_values_scalar(t, x)
-    else:
-        out_pieces = []
-        for p in x.unbind(dim=0):  # TODO: parallelise over this
-            out = _linear_interpolation_coeffs_with_missing_values(t, p)
-            out_pieces.append(out)
-        return misc.cheap_stack(out_pieces, dim=0)
+    # observation made, and then proceed as normal. A path with no observation is the constant path zero.
+    not_nan = ~torch.isnan(x)
+    length = x.size(-1)
+    index = torch.arange(length, device=x.device).expand_as(x)
+
+    # index of the last observation at or before each time (-1 if none), and of the next one at or after it (length if none)
+    prev_index = torch.where(not_nan, index, -1).cummax(dim=-1).values
+    next_index = torch.where(not_nan, index, length).flip(-1).cummin(dim=-1).values.flip(-1)
+    no_prev, no_next = prev_index < 0, next_index == length
+    prev_index, next_index = prev_index.clamp(min=0), next_index.clamp(max=length-1)
+
+    # the missing values and the zero denominators at the observations are masked below, but would give nan gradients
+    observed = torch.where(not_nan, x, torch.zeros_like(x))
+    prev_stream = observed.gather(-1, prev_index)
+    next_stream = observed.gather(-1, next_index)
+    prev_time = t[prev_index]
+    next_time = t[next_index]
+    ratio = (t - prev_time) / torch.where(next_time > prev_time, next_time - prev_time, torch.ones_like(next_time))
+    out = prev_stream + ratio * (next_stream - prev_stream)
+
+    # constant extrapolation before the first and after the last observation
+    out = torch.where(no_prev, next_stream, out)
+    out = torch.where(no_next, prev_stream, out)
+    out = torch.where(no_prev & no_next, torch.zeros_like(x), out)
+    return torch.where(not_nan, x, out)
 
 
 def _prepare_rectilinear_interpolation(data, time_index):
@@ -182,11 +139,9 @@ class LinearInterpolation(interpolation_base.InterpolationBase):
         if t is None:
             t = torch.linspace(0, coeffs.size(-2) - 1, coeffs.size(-2), dtype=coeffs.dtype, device=coeffs.device)
 
-        derivs = (coeffs[..., 1:, :] - coeffs[..., :-1, :]) / (t[1:] - t[:-1]).unsqueeze(-1)
-
+        # no derivative buffer: the derivative is the evaluation (see derivative)
         self.register_buffer('_t', t)
         self.register_buffer('_coeffs', coeffs)
-        self.register_buffer('_derivs', derivs)
 
     @property
     def grid_points(self):
@@ -197,8 +152,8 @@ class LinearInterpolation(interpolation_base.InterpolationBase):
         return torch.stack([self._t[0], self._t[-1]])
 
     def _interpret_t(self, t):
-        t = torch.as_tensor(t, dtype=self._derivs.dtype, device=self._derivs.device)
-        maxlen = self._derivs.size(-2) - 1
+        t = torch.as_tensor(t, dtype=self._coeffs.dtype, device=self._coeffs.device)
+        maxlen = self._coeffs.size(-2) - 2
         # clamp because t may go outside of [t[0], t[-1]]; this is fine
         index = torch.bucketize(t.detach(), self._t.detach()).sub(1).clamp(0, maxlen)
         # will never access the last element of self._t; this is correct behaviour
@@ -4,6 +4,7 @@ import torch.nn.functional as F
 from .fixed_point_solver import NeuralFixedPoint 
 from .root_find_solver import NeuralRootFind
 from .diffeq_solver import DiffeqSolver
+from .ensemble import StreamingMoments, StreamingQuantiles
 
 class SPDEFunc0d(torch.nn.Module):
     """ Modelling local operators F and G in (latent) SPDE (d_t - L)u = F(u)dt + G(u) dxi_t 
@@ -91,7 +92,7 @@ class SPDEFunc2d(torch.nn.Module):
 
 class NeuralSPDE(torch.nn.Module):  
 
-    def __init__(self, dim, in_channels, noise_channels, hidden_channels, modes1, modes2=None, modes3=None, n_iter=4, solver='fixed_point', **kwargs):
+    def __init__(self, dim, in_channels, noise_channels, hidden_channels, modes1, modes2=None, modes3=None, n_iter=4, solver='fixed_point', real_fft=False, amp_dtype=None, **kwargs):
         super().__init__()
         """
         dim: dimension of spatial domain (1 or 2 for now)
@@ -100,7 +101,12 @@ class NeuralSPDE(torch.nn.Module):
         hidden_channels: the dimension of the latent space
         modes1, modes2, (possibly modes 3): Fourier modes
         solver: 'fixed_point', 'root_find' or 'diffeq'
-        kwargs: Any additional kwargs to pass to the cdeint solver of torchdiffeq
+        real_fft: if True, the kernel convolution of the 'fixed_point' and 'root_find' solvers uses real-to-complex FFTs in time
+        amp_dtype: if torch.bfloat16 or torch.float16, the lift, the local operators F and G and the readout run under autocast 
+                   in this precision, while the FFTs and the spectral contractions stay in single precision ('fixed_point' and 'root_find' only)
+        kwargs: Any additional kwargs to pass to the cdeint solver of torchdiffeq, or to the fixed point and root find solvers 
+                (e.g. tol and max_iter for 'fixed_point', root_finder, forward_eps, backward_solver, backward_eps, warm_start, grad_mode and solution_cache for 'root_find',
+                method='etd1' or 'etd2' for the exponential integrators, adjoint and checkpoint_every for 'diffeq')
         """
 
         assert dim in [1,2], 'dimension of spatial domain (1 or 2 for now)'
@@ -112,8 +118,10 @@ class NeuralSPDE(torch.nn.Module):
             assert modes2 is not None, 'specify modes2' 
         if dim == 1 and solver == 'diffeq':
             assert modes2 is None, 'modes2 should not be specified' 
+        assert amp_dtype is None or solver in ['fixed_point', 'root_find'], "mixed precision is only implemented for the 'fixed_point' and 'root_find' solvers"
 
         self.dim = dim
+        self.amp_dtype = amp_dtype
 
         # initial lift
         self.lift = nn.Linear(in_channels, hidden_channels)
@@ -131,36 +139,182 @@ class NeuralSPDE(torch.nn.Module):
 
         # SPDE solver (for now Picard)
         if solver=='fixed_point':
-            self.solver = NeuralFixedPoint(self.spde_func, n_iter, modes1, modes2, modes3)
+            self.solver = NeuralFixedPoint(self.spde_func, n_iter, modes1, modes2, modes3, real_fft, **kwargs)
         elif solver=='diffeq':
             self.solver = DiffeqSolver(hidden_channels, self.spde_func, modes1, modes2, **kwargs)
         elif solver=='root_find':
-            self.solver = NeuralRootFind(self.spde_func, n_iter, modes1, modes2, modes3, **kwargs)
+            self.solver = NeuralRootFind(self.spde_func, n_iter, modes1, modes2, modes3, real_fft, **kwargs)
 
 
-    def forward(self, u0, xi, grid=None):
+    def autocast(self, device):
+        """ Autocast context of the mixed-precision mode (disabled if amp_dtype is None). """
+        return torch.autocast(device_type=device.type, dtype=self.amp_dtype, enabled=self.amp_dtype is not None)
+
+    def encode(self, u0):
+        """ u0: (batch, in_channels, dim_x, (possibly dim_y)) -> z0: (batch, hidden_channels, dim_x, (possibly dim_y)) """
+        if self.dim==1:
+            return self.lift(u0.permute(0,2,1)).permute(0,2,1) 
+        return self.lift(u0.permute(0,2,3,1)).permute(0,3,1,2)
+
+    def decode(self, zs):
+        """ zs: (batch, hidden_channels, ...) -> ys: (batch, in_channels, ...) """
+        return self.readout(zs.movedim(1, -1)).movedim(-1, 1)
+
+    def forward(self, u0, xi, grid=None, sample_ids=None, times=None):
         """ u0: (batch, hidden_size, dim_x, (possibly dim_y))
             xi: (batch, hidden_size, dim_x, (possibly dim_y), dim_t)
             grid: (batch, dim_x, (possibly dim_y), dim_t)
+            sample_ids: optional (batch,) dataset indices of the samples, used by the solution cache of the 'root_find' solver
+            times: optional indices of the time steps to output (the 'diffeq' solver only stores the solution at these times and its checkpoints)
         """
         if grid is not None:
             grid = grid[0]
             
         # Actually solve the SPDE. 
-        if self.dim==1:
-            z0 = self.lift(u0.permute(0,2,1)).permute(0,2,1) 
-        else:
-            z0 = self.lift(u0.permute(0,2,3,1)).permute(0,3,1,2)
+        with self.autocast(u0.device):
+            z0 = self.encode(u0)
 
-        zs = self.solver(z0, xi, grid)
+            if sample_ids is not None and isinstance(self.solver, NeuralRootFind):
+                zs = self.solver(z0, xi, grid, sample_ids=sample_ids)
+            elif isinstance(self.solver, DiffeqSolver):
+                zs = self.solver(z0, xi, grid, times=times)
+            else:
+                zs = self.solver(z0, xi, grid)
 
-        if self.dim==1:
-            ys = self.readout(zs.permute(0,2,3,1)).permute(0,3,1,2)
-        else:
-            ys = self.readout(zs.permute(0,2,3,4,1)).permute(0,4,1,2,3)
+            if times is not None and not isinstance(self.solver, DiffeqSolver):
+                zs = zs[..., times]
+
+            ys = self.decode(zs)
         
-        return ys
+        return ys.float() if self.amp_dtype is not None else ys
+
+    def forward_fanout(self, u0, xi, index, grid=None):
+        """ Solutions of many noise paths sharing a few initial conditions: the lift and S_t*z_0 are computed 
+            once per initial condition and broadcast to the noise paths.
+            Only implemented for the 'fixed_point' and 'root_find' solvers.
+            u0: (n_init, in_channels, dim_x, (possibly dim_y))
+            xi: (batch, noise_channels, dim_x, (possibly dim_y), dim_t)
+            index: (batch,) index in u0 of the initial condition of each noise path
+            grid: (batch, dim_x, (possibly dim_y), dim_t, d)
+            returns ys: (batch, in_channels, dim_x, (possibly dim_y), dim_t)
+        """
+        assert isinstance(self.solver, (NeuralFixedPoint, NeuralRootFind)), 'fan-out is only implemented for the fixed point and root find solvers'
+        if grid is not None:
+            grid = grid[0]
+
+        with self.autocast(u0.device):
+            z0 = self.encode(u0)
+
+            zs = self.solver(z0, xi, grid, index=index.to(u0.device))
+
+            ys = self.decode(zs)
 
+        return ys.float() if self.amp_dtype is not None else ys
+
+    def rollout(self, u0, xi, window, out=None):
+        """ Long-horizon rollout solving the SPDE on consecutive time windows, so that the memory only depends on the window length.
+            The latent state at the end of a window is the initial condition of the next one, hence consecutive windows overlap by one time step.
+            Every window has max(window, modes_t) time steps (modes_t the number of time modes of the kernel), the last one is moved 
+            back to end at the last time step and only its new time steps are returned.
+            u0: (batch, in_channels, dim_x, (possibly dim_y))
+            xi: (batch, noise_channels, dim_x, (possibly dim_y), dim_t), possibly kept on cpu (or memory-mapped); each window is moved to the device of u0
+            window: number of time steps per window (>1)
+            out: optional array-like of shape (batch, in_channels, dim_x, (possibly dim_y), dim_t) (e.g. a tensor, numpy memmap or h5py dataset)
+                 into which the predictions are written.
+            returns out if given, otherwise a generator of (t_start, ys) with ys: (batch, in_channels, dim_x, (possibly dim_y), t_end-t_start)
+                 the predictions at time steps t_start, ..., t_end-1
+        """
+        assert window > 1, 'a window should contain at least two time steps'
+        rollout = self._rollout(u0, xi, window)
+        if out is None:
+            return rollout
+        for t, ys in rollout:
+            out[..., t:t+ys.size(-1)] = ys.cpu() if torch.is_tensor(out) else ys.cpu().numpy()
+        return out
+
+    def _rollout(self, u0, xi, window):
+        # the kernel is never built on fewer time steps than its time modes
+        if isinstance(self.solver, (NeuralFixedPoint, NeuralRootFind)):
+            window = max(window, self.solver.convolution.modes[-1])
+        dim_t = xi.size(-1)
+
+        with torch.no_grad(), self.autocast(u0.device):
+            z0 = self.encode(u0)
+        t, t_end = 0, 0 # start of the window and first time step not yet returned
+        while t_end < dim_t:
+            with torch.no_grad(), self.autocast(u0.device):
+                zs = self.solver(z0, xi[..., t:t+window].to(u0.device))
+                ys = self.decode(zs)
+                ys = ys.float() if self.amp_dtype is not None else ys
+            # the time steps before t_end were returned with the previous window
+            yield t_end, ys[..., t_end-t:]
+            t_end = t + zs.size(-1)
+            if t_end == dim_t:
+                break
+            # the next window starts at the end of this one, or earlier if it would end after the last time step
+            t_next = min(t_end - 1, dim_t - window)
+            z0 = zs[..., t_next-t]
+            t = t_next
+
+    def evaluate(self, u0, xi, points, grid=None, chunk_size=4096):
+        """ Evaluates the solution at arbitrary (off-grid) query points, e.g. sensor locations or a finer grid.
+            Only implemented for the 'fixed_point' solver. 
+            u0: (batch, hidden_size, dim_x, (possibly dim_y))
+            xi: (batch, hidden_size, dim_x, (possibly dim_y), dim_t)
+            points: (n_points, d) or (batch, n_points, d) with d=2 or 3 the (x, (possibly y), t) coordinates. 
+                    If grid is None, the coordinates are in grid-index units (the j-th grid point along an axis has coordinate j).
+            grid: (batch, dim_x, (possibly dim_y), dim_t, d) the grid on which u0 and xi are given, used to rescale the points
+            returns ys: (batch, in_channels, n_points)
+        """
+        assert isinstance(self.solver, NeuralFixedPoint), 'evaluation at query points is only implemented for the fixed point solver'
+
+        if grid is not None:
+            grid = grid[0]
+            d = grid.size(-1)
+            delta = grid[(1,)*d] - grid[(0,)*d]
+            points = (points - grid[(0,)*d]) / delta
+
+        with self.autocast(u0.device):
+            z0 = self.encode(u0)
+
+            zs = self.solver.forward_points(z0, xi, points, chunk_size)   # (batch, hidden_channels, n_points)
+
+            ys = self.decode(zs)
+
+        return ys.float() if self.amp_dtype is not None else ys
+
+    def ensemble(self, u0, sampler, n_samples, batch_size=256, quantiles=(0.05, 0.5, 0.95), grid=None):
+        """ Monte Carlo ensemble of the solutions started from the same initial condition under n_samples noise realisations.
+            The noise is drawn on the fly, batch by batch, and the statistics are accumulated with streaming estimators, 
+            so that the memory does not depend on n_samples.
+            u0: (in_channels, dim_x, (possibly dim_y)) or (1, in_channels, dim_x, (possibly dim_y))
+            sampler: n -> xi: (n, noise_channels, dim_x, (possibly dim_y), dim_t), e.g. built with increments_sampler 
+                     from the samplers of data/random_forcing.py
+            grid: (batch, dim_x, (possibly dim_y), dim_t, d)
+            returns a dictionary with the pointwise 'mean', 'var' (in_channels, dim_x, (possibly dim_y), dim_t) 
+                    and 'quantiles' (n_quantiles, in_channels, dim_x, (possibly dim_y), dim_t)
+        """
+        if u0.dim() == self.dim + 1:
+            u0 = u0.unsqueeze(0)
+        moments = StreamingMoments()
+        sketch = StreamingQuantiles(quantiles) if quantiles else None
+
+        with torch.no_grad():
+            for start in range(0, n_samples, batch_size):
+                n = min(batch_size, n_samples - start)
+                xi = sampler(n).to(u0.device)
+                if isinstance(self.solver, (NeuralFixedPoint, NeuralRootFind)):
+                    ys = self.forward_fanout(u0, xi, torch.zeros(n, dtype=torch.long), grid)
+                else:
+                    ys = self(u0.expand(n, *u0.shape[1:]), xi, grid)
+                moments.update(ys)
+                if sketch is not None:
+                    sketch.update(ys)
+
+        stats = {'mean': moments.mean.float(), 'var': moments.var.float()}
+        if sketch is not None:
+            stats['quantiles'] = sketch.values.float()
+        return stats
 
 
 
@@ -2,194 +2,15 @@ import torch
 import torch.nn as nn
 import torch.nn.functional as F
 import numpy as np
-from .root_finding_algorithms import anderson, broyden, forward_iteration, jac_loss_estimate
-
-#=============================================================================================
-# Convolution in physical space = pointwise mutliplication of complex tensors in Fourier space
-#=============================================================================================
-
-def compl_mul2d(func_fft, kernel_tensor):
-    return torch.einsum("bixt, ijxt -> bjxt", func_fft, kernel_tensor)
-
-
-def compl_mul1d_time(func_fft, kernel_tensor):
-    return torch.einsum("bixt, ijxt -> bjxt", func_fft, kernel_tensor)
-
-
-def compl_mul3d(func_fft, kernel_tensor):
-    return torch.einsum("bixyt, ijxyt -> bjxyt", func_fft, kernel_tensor)
-
-
-def compl_mul2d_time(func_fft, kernel_tensor):
-    return torch.einsum("bixyt, ijxyt -> bjxyt", func_fft, kernel_tensor)
-
-#=============================================================================================
-# Implementation of the inverse discrete Fourier transform to create the computational graph
-# (x,t) -> z(x,t) 
-#=============================================================================================
-
-def inverseDFTn(u_ft, grid, dim, s=None): 
-    # u_ft: (batch, channels, modesx, (possibly modesy), modest) 
-    #    or (channels, channels, modesx, (possibly modesy), modest)
-    # grid: (dim_x, (possibly dim_y), dim_t, d) d=len(dim)
-    # or    (dim_x, (possibly dim_y), d) d=len(dim)
-    # or    (dim_t, 1)
-    # u: (batch, channels, modesx, (possibly modesy), dim_t) 
-    # or (batch, channels, dim_x, (possibly dim_y), dim_t)
-
-    assert len(grid.size()) == len(dim) + 1, 'Error grid size '
-    if dim == [-1]:
-        dim = [len(u_ft.size())-1]
-
-    new_size = np.array(u_ft.shape)
-    if s is not None:
-        assert len(s)==len(dim), "'s' should have the same length as 'dim'" 
-        new_size[dim] = s
-
-    # pad the input on axis i where s[i]>u_ft.shape[i] for i in dimensions where the dft is computed
-    padding = np.concatenate([ [0, 0] if i not in dim else [0, new_size[i]-u_ft.shape[i]] for i in range(len(u_ft.shape)-1, -1, -1) ])
-    u_ft = F.pad(u_ft, tuple(padding))
-
-    # reciprocal frequency grid 
-    N = torch.tensor(grid.size()[:-1], device=grid.device)
-    with torch.no_grad():  
-        if len(grid.shape) == 2: 
-            delta = grid[1,:] - grid[0,:]
-            grid_freq = grid/(delta**2*N)
-        if len(grid.shape) == 3: 
-            delta = grid[1,1,:] - grid[0,0,:]
-            grid_freq = grid/(delta**2*N)     
-        elif len(grid.shape) == 4: 
-            delta = grid[1,1,1,:] - grid[0,0,0,:]  
-            grid_freq = grid/(delta**2*N)  
-    
-    shape = [u_ft.shape[i] if i in dim else 1 for i in range(len(u_ft.shape))]+[grid.shape[-1]]
-    grid = grid.reshape(shape)
-    grid_freq = grid_freq.reshape(shape)
-
-    for i in range(len(dim)):
-
-        u_ft_ = u_ft.unsqueeze(1 + dim[i])
-        grid_ = grid.unsqueeze(dim[i])
-        grid_freq_ = grid_freq.unsqueeze(1 + dim[i])
-        
-        grid_prod = grid_[..., i]*grid_freq_[..., i]    # grid_prod[k][j] = <x_j, s_k>  
-    
-        # basis functions
-        basis = torch.exp(2.*np.pi*1j*grid_prod)  
-
-        # compute inverse DFT
-        u_ft = torch.sum(u_ft_*basis, axis=dim[i])/N[i] # devide by N[i] to match the ifft with norm='backward'
-
-    return u_ft
-
-#=============================================================================================
-# Semigroup action is integration against a kernel
-#=============================================================================================
-class KernelConvolution(nn.Module):
-    def __init__(self, channels, modes1, modes2, modes3=None):
-        super(KernelConvolution, self).__init__()
-
-        """ This module has a kernel parametrized as a complex tensor in the spectral domain. 
-            The method forward computes S*H;
-            The method forward_init computes S_t*u_0.
-        """
-
-        self.scale = 1. / (channels**2)
-
-        # define kernel-tensor shape depending on dim of the problem
-        if not modes3: # 1d
-            self.modes = [modes1, modes2]
-            self.dims = [2,3]
-            self.weights = nn.Parameter(self.scale * torch.rand(channels, channels, modes1, modes2,  dtype=torch.cfloat)) # K_theta in paper
-        else: # 2d
-            self.modes = [modes1, modes2, modes3]
-            self.dims = [2,3,4]
-            self.weights = nn.Parameter(self.scale * torch.rand(channels, channels, modes1, modes2, modes3, dtype=torch.cfloat)) # K_theta in paper
-       
-   
-    def forward(self, z, grid=None, init=False):
-        """ z: (batch, channels, dim_x, (possibly dim_y), dim_t)
-        grid: dim_x, (possibly dim_y), dim_t, d) with d=2 or 3 """
-        
-        # lower and upper bounds of selected frequencies
-        freqs = [ (z.size(2+i)//2 - self.modes[i]//2, z.size(2+i)//2 + self.modes[i]//2) for i in range(len(self.modes)) ]
- 
-        if not init: # S * u
-
-            # Compute FFT
-            z_ft = torch.fft.fftn(z, dim=self.dims)
-            z_ft = torch.fft.fftshift(z_ft, dim=self.dims)
- 
-            # Pointwise multiplication of kernel_tensor and func_fft
-            out_ft = torch.zeros(z.size(), device=z.device, dtype=torch.cfloat)
-            if len(self.modes)==2: # 1d case
-                out_ft[:, :, freqs[0][0]:freqs[0][1], freqs[1][0]:freqs[1][1] ] = compl_mul2d(z_ft[:, :, freqs[0][0]:freqs[0][1], freqs[1][0]:freqs[1][1] ], self.weights)
-            else: # 2d case
-                out_ft[:, :, freqs[0][0]:freqs[0][1], freqs[1][0]:freqs[1][1], freqs[2][0]:freqs[2][1] ] = compl_mul3d(z_ft[:, :, freqs[0][0]:freqs[0][1], freqs[1][0]:freqs[1][1], freqs[2][0]:freqs[2][1] ], self.weights)
-            
-            # Compute Inverse FFT  
-            out_ft = torch.fft.ifftshift(out_ft, dim=self.dims) 
-            
-            # (*) if the grid is provided, then compute the final DFT_inverse by hand to make explicit the dependence on the input and allow for autograd to compute gradients.
-            if grid is None:
-                z = torch.fft.ifftn(out_ft, dim=self.dims)
-            else:  
-                z = inverseDFTn(out_ft, grid, self.dims)
-
-            return z.real
-
-        else: # S_t * z_0
-            return self.forward_init(z, grid)
-
-    
-    def forward_init(self, z0_path, grid=None):
-        """ z0_path: (batch, channels, dim_x, (possibly dim_y), dim_t)
-            grid: dim_x, (possibly dim_y), dim_t, d) with d=2 or 3"""
-        if grid is not None:
-            gridx, gridt = grid[...,0,:-1], grid[...,-1].unsqueeze(-1)
-            if len(self.modes)==2:
-                gridt = gridt[0]
-            else:
-                gridt = gridt[0,0]
-
-        # lower and upper bounds of selected frequencies
-        freqs = [ (z0_path.size(2+i)//2 - self.modes[i]//2, z0_path.size(2+i)//2 + self.modes[i]//2) for i in range(len(self.modes)-1) ]
-
-        # K_t = F_t^-1(K)  
-        if grid is None: # (*)
-            weights = torch.fft.ifftn(torch.fft.ifftshift(self.weights, dim=[-1]), dim=[-1], s=z0_path.size(-1))
-        else:  
-            weights = inverseDFTn(torch.fft.ifftshift(self.weights, dim=[-1]), gridt, dim=[-1], s=[z0_path.size(-1)])
-
-        # Compute FFT of the input signal to convolve
-        z_ft = torch.fft.fftn(z0_path, dim=self.dims[:-1])
-        z_ft = torch.fft.fftshift(z_ft, dim=self.dims[:-1])
-
-        # Pointwise multiplication by complex matrix 
-        out_ft = torch.zeros(z0_path.size(), device=z0_path.device, dtype=torch.cfloat)
-        if len(self.modes)==2: # 1d case
-            out_ft[:, :, freqs[0][0]:freqs[0][1], : ] = compl_mul1d_time(z_ft[:, :, freqs[0][0]:freqs[0][1] ], weights)
-        else: # 2d case
-            out_ft[:, :, freqs[0][0]:freqs[0][1], freqs[1][0]:freqs[1][1], : ] = compl_mul2d_time(z_ft[:, :, freqs[0][0]:freqs[0][1], freqs[1][0]:freqs[1][1] ], weights)
-
-
-        # Compute Inverse FFT   
-        out_ft = torch.fft.ifftshift(out_ft, dim=self.dims[:-1])
-
-        if grid is None: # (*)
-            z = torch.fft.ifftn(out_ft, dim=self.dims[:-1])
-        else: 
-            z = inverseDFTn(out_ft, gridx, self.dims[:-1])
-        return z.real
-
+from .root_finding_algorithms import anderson, broyden, lbroyden, forward_iteration, jac_loss_estimate, power_method, rmatvec
+from .fixed_point_solver import KernelConvolution
 
 #=============================================================================================
 # SPDE solver: neural fixed point problem solved by Picard's iteration.
 #=============================================================================================
 
 class NeuralRootFind(nn.Module):
-    def __init__(self, spde_func, n_iter, modes1, modes2, modes3=None, **kwargs):
+    def __init__(self, spde_func, n_iter, modes1, modes2, modes3=None, real_fft=False, **kwargs):
         super(NeuralRootFind, self).__init__()
 
         # self.padding = int(2**(np.ceil(np.log2(abs(2*T-1)))))
@@ -199,14 +20,45 @@ class NeuralRootFind(nn.Module):
 
         # algorithm to solve the fixed point problem
         self.root_finder = kwargs['root_finder']
+
+        # tolerance of the fixed point problem solved in the forward pass
+        self.forward_eps = kwargs.get('forward_eps', 1e-6)
+
+        # algorithm, maximal number of iterations and tolerance of the adjoint fixed point problem solved in the backward pass.
+        # If warm_start, the backward solve starts from the inverse Jacobian estimate of the forward solve (broyden or anderson)
+        self.backward_solver = kwargs.get('backward_solver', None) or self.root_finder
+        self.backward_threshold = kwargs.get('backward_threshold', None) or n_iter
+        self.backward_eps = kwargs.get('backward_eps', 1e-8)
+        self.warm_start = kwargs.get('warm_start', False)
+
+        # optional Jacobian penalty |J_f|_F^2 (Hutchinson estimator with jac_loss_vecs vectors) computed every jac_loss_every 
+        # training steps and stored in self.jac_loss (see train_nspde), and spectral radius of J_f estimated with 
+        # spectral_radius_iters iterations of the power method every spectral_radius_every training steps, appended 
+        # to self.spectral_radius as (step, largest spectral radius of the batch)
+        self.jac_loss_every = kwargs.get('jac_loss_every', None)
+        self.jac_loss_vecs = kwargs.get('jac_loss_vecs', 1)
+        self.spectral_radius_every = kwargs.get('spectral_radius_every', None)
+        self.spectral_radius_iters = kwargs.get('spectral_radius_iters', 20)
+        self.jac_loss = None
+        self.spectral_radius = []
+        self.n_steps = 0
+
+        # optional SolutionCache of the fixed points of the training samples, keyed by their dataset index (see forward)
+        self.solution_cache = kwargs.get('solution_cache', None)
+
+        # gradient of the fixed point: 'implicit' (adjoint fixed point problem), 'jfb' (Jacobian-free: backpropagation 
+        # through grad_steps iterations from the fixed point) or 'phantom' (through grad_steps damped iterations 
+        # z <- (1-grad_damping) z + grad_damping f(z) from the fixed point)
+        self.grad_mode = kwargs.get('grad_mode', 'implicit')
+        assert self.grad_mode in ['implicit', 'jfb', 'phantom'], "grad_mode should be 'implicit', 'jfb' or 'phantom'"
+        self.grad_steps = kwargs.get('grad_steps', 1)
+        self.grad_damping = kwargs.get('grad_damping', 0.5) if self.grad_mode == 'phantom' else 1.
         
         # vector fields F and G
         self.spde_func = spde_func
         
         # semigroup
-        self.convolution = KernelConvolution(spde_func.hidden_channels, modes1, modes2, modes3) 
-
-        self.hook = None
+        self.convolution = KernelConvolution(spde_func.hidden_channels, modes1, modes2, modes3, real_fft) 
 
     def iteration(self, z, xi, size):
         
@@ -215,76 +67,130 @@ class NeuralRootFind(nn.Module):
         F_z, G_z = self.spde_func(z.reshape(size)) 
 
         if dim_flag:
-            G_z_xi = torch.einsum('abcde, acde -> abde', G_z, xi)
+            G_z_xi = torch.einsum('abcde, acde -> abde', G_z, xi.to(G_z.dtype))
         else:
-            G_z_xi = torch.einsum('abcdef, acdef -> abdef', G_z, xi)
+            G_z_xi = torch.einsum('abcdef, acdef -> abdef', G_z, xi.to(G_z.dtype))
 
         H_z_xi = F_z + G_z_xi
 
         return self.convolution(H_z_xi).reshape(z.size())
         
 
-    def forward(self, z0, xi, grid=None):
+    def forward(self, z0, xi, grid=None, index=None, sample_ids=None):
         """ - z0: (batch, hidden_channels, dim_x (possibly dim_y))
             - xi: (batch, forcing_channels, dim_x, (possibly dim_y), dim_t)
             - grid: (dim_x, (possibly dim_y), dim_t)
+            - index: optional (batch,) indices of the initial condition of each noise path. Then z0 is 
+                     (n_init, hidden_channels, dim_x (possibly dim_y)) and S_t * z_0 is computed once per initial condition.
+            - sample_ids: optional (batch,) dataset indices of the samples. If a solution cache is set, the root finder 
+                          starts from the cached fixed points of these samples, and the new fixed points are cached.
         """
         
-        # if True 1d, else 2d
         assert len(xi.size()) in [4,5], '1d and 2d cases only are implemented '
-        dim_flag = len(xi.size())==4
-
-        # constant path
-        if dim_flag:
-            z0_path = z0.unsqueeze(-1).repeat(1, 1, 1, xi.size(-1)) 
-        else:
-            z0_path = z0.unsqueeze(-1).repeat(1, 1, 1, 1, xi.size(-1)) 
 
         # S_t * z_0
-        z0_path =  self.convolution(z0_path, grid=grid, init=True) 
+        z0_path = self.convolution(z0.unsqueeze(-1).expand(*z0.shape, xi.size(-1)), grid=grid, init=True) 
+        if index is not None:
+            z0_path = z0_path[index]
         size = z0_path.size()
+        z0_path = z0_path.reshape(size[0], -1, size[-1])    #(batch, flat_channels, dim_t)
 
-        # step 1 of Picard
-        z = z0_path
+        # step 1 of Picard, or the cached fixed points
+        z = z0_path.detach()
+        use_cache = self.solution_cache is not None and sample_ids is not None
+        if use_cache:
+            z, _ = self.solution_cache.get(sample_ids, z)
 
         # root finding
-        z, _ = self._forward(z.reshape(z.size(0), -1, z.size(-1)), xi, size)  #(batch, flat_channels, dim_t)
+        z, _ = self._forward(z0_path, xi, size, z)
+
+        if use_cache:
+            self.solution_cache.put(sample_ids, z)
 
         return z.reshape(size)
 
-    def _forward(self, z0, xi, size):
+    def _forward(self, z0, xi, size, z_init=None):
         
         training = z0.requires_grad
 
+        # in eval mode, the root finder can evaluate the map on the samples which have not converged yet only 
+        # (in training mode, the batch norms of spde_func use the statistics of the whole batch)
+        def f(z, index=None):
+            if index is None:
+                return z0 + self.iteration(z, xi, size)
+            return z0[index] + self.iteration(z, xi[index], (index.size(0),) + tuple(size[1:]))
+
         # 1) solve fixed point without computing any gradient 
         with torch.no_grad():
-            z = self.root_finder(lambda z: z0 + self.iteration(z, xi, size), z0, threshold=self.n_iter, eps=1e-6)['result']   
+            kwargs = {'return_jacobian': True} if training and self.warm_start and self.grad_mode == 'implicit' else {}
+            info = self.root_finder(f if not self.training else lambda z: f(z), z0 if z_init is None else z_init, threshold=self.n_iter, eps=self.forward_eps, **kwargs)
+        z = info['result']
         
         new_z = z
-        jac_loss = None 
-        if training:
+        self.jac_loss = None 
+        if not training:
+            return new_z, self.jac_loss
+
+        # the Jacobian penalty and the spectral radius probe are only computed every jac_loss_every and spectral_radius_every steps
+        step, self.n_steps = self.n_steps, self.n_steps + 1
+        need_jac = bool(self.jac_loss_every) and step % self.jac_loss_every == 0
+        need_rho = bool(self.spectral_radius_every) and step % self.spectral_radius_every == 0
+        
+        if self.grad_mode != 'implicit':
+
+            # the first unrolled step evaluates f at the fixed point, which the Jacobian terms differentiate 
+            # (an extra evaluation would update the running statistics of the batch norms of spde_func once more)
+            if need_jac or need_rho:
+                z = new_z = z.detach().requires_grad_()
+
+            # unrolled (possibly damped) iterations from the fixed point, which is treated as a constant
+            for k in range(self.grad_steps):
+                f_new_z = z0 + self.iteration(new_z, xi, size)
+                if k == 0:
+                    f_z = f_new_z
+                new_z = (1. - self.grad_damping) * new_z + self.grad_damping * f_new_z
+
+        else:
         
             # 2)  re-engage autodiff (so that df/d(.) is computed) where f: z -> z0 + self.iter_layer(z,xi) 
             z.requires_grad_() 
-            new_z  = z0 + self.iteration(z, xi, size)
-
-            jac_loss = jac_loss_estimate(new_z, z, vecs=1)
-            jac_loss = jac_loss.view(-1,1)
-
-            # 3) Compute the fixed point g: g = (df/dz)^T g + y, since (dz/d())^Ty = (df/d())^Tg
-            def backward_hook(grad):
-                if self.hook is not None:
-                    self.hook.remove()
-                    torch.cuda.synchronize()   # To avoid infinite recursion
-                # Compute the fixed point of yJ + grad, where J=J_f is the Jacobian of f at z_star
-                g = self.root_finder(lambda y: torch.autograd.grad(new_z, z, y, retain_graph=True)[0] + grad, \
-                                    grad, threshold=self.n_iter, eps=1e-8)['result']
-                return g
-
-            self.hook = new_z.register_hook(backward_hook)
-    
+            new_z = f_z = z0 + self.iteration(z, xi, size)
+
+            # 3) the backward pass solves the fixed point g = (df/dz)^T g + y, since (dz/d())^Ty = (df/d())^Tg
+            jacobian = (info['Us'], info['VTs']) if 'Us' in info else None
+            new_z = ImplicitGradient.apply(new_z, z, self.backward_solver, self.backward_threshold, self.backward_eps, jacobian)
+
+        if need_jac:
+            self.jac_loss = jac_loss_estimate(f_z, z, vecs=self.jac_loss_vecs)
+        if need_rho:
+            _, rho = power_method(f_z, z, n_iters=self.spectral_radius_iters, retain_graph=True)
+            self.spectral_radius.append((step, rho.max().item()))
  
-        return new_z, jac_loss
+        return new_z, self.jac_loss
+
+
+class ImplicitGradient(torch.autograd.Function):
+    """ Identity on new_z = f(z) at a fixed point z = f(z). In the backward pass, the incoming gradient grad is replaced 
+        by the solution g of the adjoint fixed point problem g = J^T g + grad, with J the Jacobian of f at z, so that 
+        backpropagating g through new_z = f(z) gives the implicit gradient of the fixed point.
+        If the factors (Us, VTs) of the forward inverse Jacobian estimate -I + UV^T of f(z)-z are given, the backward 
+        solve starts from -(I - UV^T)^T applied to grad instead of grad.
+    """
+
+    @staticmethod
+    def forward(ctx, new_z, z, solver, threshold, eps, jacobian=None):
+        # the graph of new_z = f(z) is kept to compute vector-Jacobian products in the backward pass
+        ctx.graph = (new_z, z)
+        ctx.solver, ctx.threshold, ctx.eps, ctx.jacobian = solver, threshold, eps, jacobian
+        return new_z.clone()
+
+    @staticmethod
+    def backward(ctx, grad):
+        new_z, z = ctx.graph
+        g0 = grad if ctx.jacobian is None else -rmatvec(*ctx.jacobian, grad)
+        g = ctx.solver(lambda y: torch.autograd.grad(new_z, z, y, retain_graph=True)[0] + grad, g0, threshold=ctx.threshold, eps=ctx.eps)['result']
+        ctx.graph = ctx.jacobian = None
+        return g, None, None, None, None, None
 
 
 
@@ -7,6 +7,7 @@ from torch import nn
 import torch.nn.functional as functional
 from torch.autograd import Function
 import numpy as np 
+import inspect
 import pickle
 import sys
 import os
@@ -14,16 +15,105 @@ from scipy.optimize import root
 import time
 from termcolor import colored
 
-def forward_iteration(f, x0, threshold=50, eps=1e-2):
-    f0 = f(x0)
-    res = []
+#=============================================================================================
+# Per-sample convergence: the residuals are computed per sample on device, the converged samples
+# are frozen, and the host only checks for convergence every check_every iterations, when the
+# converged samples are compacted out of the active batch.
+#=============================================================================================
+
+def _accepts_index(f):
+    # f(x, index) evaluates the map on the samples index of the batch only
+    try:
+        return len(inspect.signature(f).parameters) >= 2
+    except (TypeError, ValueError):
+        return False
+
+
+def _residual(fx, x, stop_mode='rel', eps=1e-5):
+    # per-sample absolute residual |f(x)-x| or relative residual |f(x)-x|/|f(x)|
+    abs_diff = (fx - x).reshape(x.size(0), -1).norm(dim=1)
+    if stop_mode == 'abs':
+        return abs_diff
+    return abs_diff / (eps + fx.reshape(x.size(0), -1).norm(dim=1))
+
+
+def _where(mask, x, y):
+    # per-sample torch.where
+    return torch.where(mask.reshape([-1] + [1]*(x.dim()-1)), x, y)
+
+
+class ActiveSet(object):
+    """ Samples of the batch which have not converged yet. 
+        If f accepts a second argument index, f(x, index) is only evaluated on the active samples, 
+        otherwise the converged samples are frozen but f is still evaluated on the whole batch.
+    """
+
+    def __init__(self, f, x0, check_every=4):
+        self.f = f
+        self.compact = _accepts_index(f)
+        self.batch = x0.size(0)
+        self.index = torch.arange(self.batch, device=x0.device)
+        self.done = torch.zeros(self.batch, dtype=torch.bool, device=x0.device)
+        self.check_every = max(1, check_every)
+
+    def __call__(self, x):
+        if not self.compact:
+            return self.f(x)
+        return self.f(x, None if self.index.size(0) == self.batch else self.index)
+
+    @property
+    def running(self):
+        return ~self.done
+
+    def step(self, k, converged, outputs, states):
+        """ Marks the converged samples after iteration k. Every check_every iterations, the active samples of the 
+            first len(outputs) states are written to the (full batch) outputs, and the converged samples are removed 
+            from the states (all of them have the active samples along the first axis).
+            Returns (stop, states) with stop=True if every sample has converged.
+        """
+        self.done = self.done | converged
+        if (k+1) % self.check_every != 0:
+            return False, states
+        self.write(outputs, states)
+        if bool(self.done.all()):
+            return True, states
+        if self.compact and bool(self.done.any()):
+            keep = ~self.done
+            self.index, self.done = self.index[keep], self.done[keep]
+            states = [s[keep] for s in states]
+        return False, states
+
+    def write(self, outputs, states):
+        for out, s in zip(outputs, states):
+            if out is not None:
+                out[self.index] = s
+
+
+def forward_iteration(f, x0, threshold=50, eps=1e-2, stop_mode='rel', check_every=4, **kwargs):
+    """ Fixed point iteration x <- f(x), stopped per sample once the residual is below eps. """
+    active = ActiveSet(f, x0, check_every)
+    x = active(x0)
+    bsz = x.size(0)
+
+    # outputs (full batch) and states (active samples)
+    result, lowest, nstep = x.clone(), torch.full((bsz,), np.inf, dtype=x.dtype, device=x.device), torch.zeros(bsz, dtype=torch.long, device=x.device)
+    states = [x, lowest.clone(), nstep.clone()]
+
     for k in range(threshold):
-        x = f0
-        f0 = f(x)
-        res.append((f0 - x).norm().item() / (1e-5 + f0.norm().item()))
-        if (res[-1] < eps):
+        x, res, n = states
+        fx = active(x)
+        running = active.running
+        states = [_where(running, fx, x), torch.where(running, _residual(fx, x, stop_mode), res), n + running]
+        stop, states = active.step(k, states[1] < eps, [result, lowest, nstep], states)
+        if stop:
             break
-    return {"result": f0}
+    active.write([result, lowest, nstep], states)
+
+    return {"result": result,
+            "lowest": lowest,
+            "nstep": nstep,
+            "eps": eps,
+            "threshold": threshold}
 
 def _safe_norm(v):
     if not torch.isfinite(v).all():
@@ -130,147 +220,186 @@ def matvec(part_Us, part_VTs, x):
     return -x + torch.einsum('bijd, bd -> bij', part_Us, VTx)     # (N, 2d, L'), but should really be (N, (2d*L'), 1)
 
 
-def broyden(f, x0, threshold, eps=1e-3, stop_mode="rel", ls=False, name="unknown"):
+def broyden(f, x0, threshold, eps=1e-3, stop_mode="rel", ls=False, name="unknown", memory=None, storage_dtype=None, check_every=4, return_jacobian=False):
+    """ Broyden's method. The inverse Jacobian is approximated by -I + UV^T, where U and V have (at most) memory
+        columns: once memory updates are stored, each new update overwrites the oldest one (circular buffer). 
+        memory=None keeps every update (memory=threshold). The updates can be stored in a reduced precision 
+        storage_dtype (e.g. torch.bfloat16), the products with them are computed in the precision of x0.
+        The stopping criteria are per sample (see ActiveSet). The line search (ls=True) uses one step size for the batch.
+        If return_jacobian, the factors Us, VTs of the inverse Jacobian estimate are returned (e.g. to warm-start a backward solve).
+    """
     bsz, total_hsize, seq_len = x0.size()
-    g = lambda y: f(y) - y
     dev = x0.device
-    alternative_mode = 'rel' if stop_mode == 'abs' else 'abs'
+    active = ActiveSet(f, x0, check_every)
+    g = lambda y: active(y) - y
     
     x_est = x0           # (bsz, 2d, L')
     gx = g(x_est)        # (bsz, 2d, L')
-    nstep = 0
-    tnstep = 0
     
     # For fast calculation of inv_jacobian (approximately)
-    Us = torch.zeros(bsz, total_hsize, seq_len, threshold).to(dev)     # One can also use an L-BFGS scheme to further reduce memory
-    VTs = torch.zeros(bsz, threshold, total_hsize, seq_len).to(dev)
-    update = -matvec(Us[:,:,:,:nstep], VTs[:,:nstep], gx)      # Formally should be -torch.matmul(inv_jacobian (-I), gx)
-    prot_break = False
+    memory = threshold if memory is None else min(memory, threshold)
+    storage_dtype = storage_dtype or x0.dtype
+    Us = torch.zeros(bsz, total_hsize, seq_len, memory, dtype=storage_dtype, device=dev)
+    VTs = torch.zeros(bsz, memory, total_hsize, seq_len, dtype=storage_dtype, device=dev)
+    update = gx      # Formally should be -torch.matmul(inv_jacobian (-I), gx)
     
     # To be used in protective breaks
     protect_thres = (1e6 if stop_mode == "abs" else 1e3) * seq_len
-    new_objective = 1e8
-
-    trace_dict = {'abs': [],
-                  'rel': []}
-    lowest_dict = {'abs': 1e8,
-                   'rel': 1e8}
-    lowest_step_dict = {'abs': 0,
-                        'rel': 0}
-    nstep, lowest_xest, lowest_gx = 0, x_est, gx
-
-    while nstep < threshold:
-        x_est, gx, delta_x, delta_gx, ite = line_search(update, x_est, gx, g, nstep=nstep, on=ls)
-        nstep += 1
-        tnstep += (ite+1)
-        abs_diff = torch.norm(gx).item()
-        rel_diff = abs_diff / (torch.norm(gx + x_est).item() + 1e-9)
-        diff_dict = {'abs': abs_diff,
-                     'rel': rel_diff}
-        trace_dict['abs'].append(abs_diff)
-        trace_dict['rel'].append(rel_diff)
-        for mode in ['rel', 'abs']:
-            if diff_dict[mode] < lowest_dict[mode]:
-                if mode == stop_mode: 
-                    lowest_xest, lowest_gx = x_est.clone().detach(), gx.clone().detach()
-                lowest_dict[mode] = diff_dict[mode]
-                lowest_step_dict[mode] = nstep
-
-        new_objective = diff_dict[stop_mode]
-        if new_objective < eps: break
-        if new_objective < 3*eps and nstep > 30 and np.max(trace_dict[stop_mode][-30:]) / np.min(trace_dict[stop_mode][-30:]) < 1.3:
-            # if there's hardly been any progress in the last 30 steps
-            break
-        if new_objective > trace_dict[stop_mode][0] * protect_thres:
-            prot_break = True
-            break
 
-        part_Us, part_VTs = Us[:,:,:,:nstep-1], VTs[:,:nstep-1]
+    # outputs (full batch)
+    result = x0.clone()
+    lowest = torch.full((bsz,), 1e8, dtype=x0.dtype, device=dev)
+    nstep = torch.zeros(bsz, dtype=torch.long, device=dev)
+    prot_break = torch.zeros(bsz, dtype=torch.bool, device=dev)
+
+    # states (active samples): the first ones are the outputs, trace0 is the first objective and history the last 30 ones
+    states = [x0.clone(), lowest.clone(), nstep.clone(), prot_break.clone(), x_est, gx, update, Us, VTs, 
+              torch.zeros(bsz, dtype=x0.dtype, device=dev), torch.zeros(bsz, 30, dtype=x0.dtype, device=dev)]
+    outputs = [result, lowest, nstep, prot_break]
+    if return_jacobian:
+        outputs += [None, None, None, Us.clone(), VTs.clone()]
+
+    for k in range(threshold):
+        lowest_xest, lowest_, nstep_, prot_break_, x_est, gx, update, Us, VTs, trace0, history = states
+        running = active.running
+
+        # the converged samples do not move
+        update = _where(running, update, torch.zeros_like(update))
+        x_est, gx, delta_x, delta_gx, ite = line_search(update, x_est, gx, g, nstep=k, on=ls)
+
+        abs_diff = gx.reshape(gx.size(0), -1).norm(dim=1)
+        objective = abs_diff if stop_mode == 'abs' else abs_diff / ((gx + x_est).reshape(gx.size(0), -1).norm(dim=1) + 1e-9)
+        if k == 0:
+            trace0 = objective
+        history[:, k % 30] = objective
+
+        better = running & (objective < lowest_)
+        lowest_xest = _where(better, x_est, lowest_xest)
+        nstep_ = torch.where(better, k+1, nstep_)
+        lowest_ = torch.where(better, objective, lowest_)
+
+        # hardly any progress in the last 30 steps, or protective break (so that it does not diverge to infinity)
+        stalled = (objective < 3*eps) & (k+1 > 30) & (history.max(1).values / history.min(1).values < 1.3)
+        diverged = objective > trace0 * protect_thres
+        prot_break_ = prot_break_ | (running & diverged)
+
+        # the low-rank terms are summed, hence the order of the columns in the circular buffer does not matter
+        n_stored = min(k, memory)
+        part_Us, part_VTs = Us[:,:,:,:n_stored].to(x_est.dtype), VTs[:,:n_stored].to(x_est.dtype)
         vT = rmatvec(part_Us, part_VTs, delta_x)
         u = (delta_x - matvec(part_Us, part_VTs, delta_gx)) / torch.einsum('bij, bij -> b', vT, delta_gx)[:,None,None]
-        vT[vT != vT] = 0
-        u[u != u] = 0
-        VTs[:,nstep-1] = vT
-        Us[:,:,:,nstep-1] = u
-        update = -matvec(Us[:,:,:,:nstep], VTs[:,:nstep], gx)
-
-    # Fill everything up to the threshold length
-    for _ in range(threshold+1-len(trace_dict[stop_mode])):
-        trace_dict[stop_mode].append(lowest_dict[stop_mode])
-        trace_dict[alternative_mode].append(lowest_dict[alternative_mode])
-
-    return {"result": lowest_xest,
-            "lowest": lowest_dict[stop_mode],
-            "nstep": lowest_step_dict[stop_mode],
-            "prot_break": prot_break,
-            "abs_trace": trace_dict['abs'],
-            "rel_trace": trace_dict['rel'],
-            "eps": eps,
-            "threshold": threshold}
+        vT = vT.masked_fill(vT != vT, 0)    # no host sync, unlike boolean indexing
+        u = u.masked_fill(u != u, 0)
+        VTs[:,k % memory] = vT
+        Us[:,:,:,k % memory] = u
+        n_stored = min(k+1, memory)
+        update = -matvec(Us[:,:,:,:n_stored].to(x_est.dtype), VTs[:,:n_stored].to(x_est.dtype), gx)
+
+        states = [lowest_xest, lowest_, nstep_, prot_break_, x_est, gx, update, Us, VTs, trace0, history]
+        stop, states = active.step(k, (objective < eps) | stalled | diverged, outputs, states)
+        if stop:
+            break
+    active.write(outputs, states)
 
+    out = {"result": result,
+           "lowest": lowest,
+           "nstep": nstep,
+           "prot_break": prot_break,
+           "eps": eps,
+           "threshold": threshold}
+    if return_jacobian:
+        out["Us"], out["VTs"] = outputs[-2].to(x0.dtype), outputs[-1].to(x0.dtype)
+    return out
 
-def anderson(f, x0, m=6, lam=1e-4, threshold=50, eps=1e-3, stop_mode='rel', beta=1.0, **kwargs):
-    """ Anderson acceleration for fixed point iteration. """
+
+def lbroyden(f, x0, threshold, eps=1e-3, memory=8, storage_dtype=None, **kwargs):
+    """ Limited-memory Broyden's method: only the last memory updates of the inverse Jacobian are kept, so that 
+        the memory does not grow with threshold. Use functools.partial to set memory and storage_dtype, e.g. 
+        NeuralRootFind(..., root_finder=partial(lbroyden, memory=8, storage_dtype=torch.bfloat16))
+    """
+    return broyden(f, x0, threshold, eps=eps, memory=memory, storage_dtype=storage_dtype, **kwargs)
+
+
+def anderson(f, x0, m=6, lam=1e-4, threshold=50, eps=1e-3, stop_mode='rel', beta=1.0, check_every=4, return_jacobian=False, **kwargs):
+    """ Anderson acceleration for fixed point iteration. The stopping criteria are per sample (see ActiveSet). 
+        If return_jacobian, the factors Us, VTs of the multisecant inverse Jacobian estimate defined by the last m 
+        iterates are returned (with the same layout as in broyden).
+    """
     bsz, d, L = x0.shape
-    alternative_mode = 'rel' if stop_mode == 'abs' else 'abs'
-    X = torch.zeros(bsz, m, d*L, dtype=x0.dtype, device=x0.device)
-    F = torch.zeros(bsz, m, d*L, dtype=x0.dtype, device=x0.device)
-    X[:,0], F[:,0] = x0.reshape(bsz, -1), f(x0).reshape(bsz, -1)
-    X[:,1], F[:,1] = F[:,0], f(F[:,0].reshape_as(x0)).reshape(bsz, -1)
+    dev = x0.device
+    active = ActiveSet(f, x0, check_every)
+    X = torch.zeros(bsz, m, d*L, dtype=x0.dtype, device=dev)
+    F = torch.zeros(bsz, m, d*L, dtype=x0.dtype, device=dev)
+    X[:,0], F[:,0] = x0.reshape(bsz, -1), active(x0).reshape(bsz, -1)
+    X[:,1], F[:,1] = F[:,0], active(F[:,0].reshape_as(x0)).reshape(bsz, -1)
     
-    H = torch.zeros(bsz, m+1, m+1, dtype=x0.dtype, device=x0.device)
+    H = torch.zeros(bsz, m+1, m+1, dtype=x0.dtype, device=dev)
     H[:,0,1:] = H[:,1:,0] = 1
-    y = torch.zeros(bsz, m+1, 1, dtype=x0.dtype, device=x0.device)
+    y = torch.zeros(bsz, m+1, 1, dtype=x0.dtype, device=dev)
     y[:,0] = 1
 
-    trace_dict = {'abs': [],
-                  'rel': []}
-    lowest_dict = {'abs': 1e8,
-                   'rel': 1e8}
-    lowest_step_dict = {'abs': 0,
-                        'rel': 0}
+    # outputs (full batch) and states (active samples)
+    result = X[:,1].reshape_as(x0).clone()
+    lowest = torch.full((bsz,), 1e8, dtype=x0.dtype, device=dev)
+    nstep = torch.zeros(bsz, dtype=torch.long, device=dev)
+    states = [result.clone(), lowest.clone(), nstep.clone(), X, F, H, y]
+    outputs = [result, lowest, nstep]
+    if return_jacobian:
+        outputs += [X.clone(), F.clone()]
+    k_last = 1
 
     for k in range(2, threshold):
+        lowest_xest, lowest_, nstep_, X, F, H, y = states
         n = min(k, m)
         G = F[:,:n]-X[:,:n]
-        H[:,1:n+1,1:n+1] = torch.bmm(G,G.transpose(1,2)) + lam*torch.eye(n, dtype=x0.dtype,device=x0.device)[None]
-        alpha = torch.solve(y[:,:n+1], H[:,:n+1,:n+1])[0][:, 1:n+1, 0]   # (bsz x n)
+        H[:,1:n+1,1:n+1] = torch.bmm(G,G.transpose(1,2)) + lam*torch.eye(n, dtype=x0.dtype,device=dev)[None]
+        alpha = torch.linalg.solve(H[:,:n+1,:n+1], y[:,:n+1])[:, 1:n+1, 0]   # (bsz x n)
         
         X[:,k%m] = beta * (alpha[:,None] @ F[:,:n])[:,0] + (1-beta)*(alpha[:,None] @ X[:,:n])[:,0]
-        F[:,k%m] = f(X[:,k%m].reshape_as(x0)).reshape(bsz, -1)
-        gx = (F[:,k%m] - X[:,k%m]).view_as(x0)
-        abs_diff = gx.norm().item()
-        rel_diff = abs_diff / (1e-5 + F[:,k%m].norm().item())
-        diff_dict = {'abs': abs_diff,
-                     'rel': rel_diff}
-        trace_dict['abs'].append(abs_diff)
-        trace_dict['rel'].append(rel_diff)
-        
-        for mode in ['rel', 'abs']:
-            if diff_dict[mode] < lowest_dict[mode]:
-                if mode == stop_mode: 
-                    lowest_xest, lowest_gx =  X[:,k%m].view_as(x0).clone().detach(), gx.clone().detach()
-                lowest_dict[mode] = diff_dict[mode]
-                lowest_step_dict[mode] = k
-
-        if trace_dict[stop_mode][-1] < eps:
-            for _ in range(threshold-1-k):
-                trace_dict[stop_mode].append(lowest_dict[stop_mode])
-                trace_dict[alternative_mode].append(lowest_dict[alternative_mode])
+        F[:,k%m] = active(X[:,k%m].reshape(-1, d, L)).reshape(X.size(0), -1)
+        objective = _residual(F[:,k%m], X[:,k%m], stop_mode)
+
+        better = active.running & (objective < lowest_)
+        lowest_xest = _where(better, X[:,k%m].reshape(-1, d, L), lowest_xest)
+        nstep_ = torch.where(better, k, nstep_)
+        lowest_ = torch.where(better, objective, lowest_)
+
+        states = [lowest_xest, lowest_, nstep_, X, F, H, y]
+        k_last = k
+        stop, states = active.step(k-2, objective < eps, outputs, states)
+        if stop:
             break
+    active.write(outputs, states)
 
-    out = {"result": lowest_xest,
-           "lowest": lowest_dict[stop_mode],
-           "nstep": lowest_step_dict[stop_mode],
-           "prot_break": False,
-           "abs_trace": trace_dict['abs'],
-           "rel_trace": trace_dict['rel'],
+    out = {"result": result,
+           "lowest": lowest,
+           "nstep": nstep,
+           "prot_break": torch.zeros(bsz, dtype=torch.bool, device=dev),
            "eps": eps,
            "threshold": threshold}
+    if return_jacobian:
+        out["Us"], out["VTs"] = anderson_inverse_jacobian(outputs[3], outputs[4], k_last, d, L, lam)
     X = F = None
     return out
 
 
+def anderson_inverse_jacobian(X, F, k, d, L, lam=1e-4):
+    """ Multisecant estimate -I + UV^T of the inverse Jacobian of g(x) = f(x)-x from the Anderson history, 
+        with X, F: (bsz, m, d*L) and k the last iteration, stored in the slot k%m.
+        Differences of iterates with the last one dX, and dG of the residuals, satisfy (-I + UV^T) dG = dX with 
+        U = (dX + dG)(dG^T dG)^{-1} and V = dG. 
+        returns Us: (bsz, d, L, r), VTs: (bsz, r, d, L)
+    """
+    bsz, m = X.size(0), X.size(1)
+    n = min(k+1, m)
+    others = [j for j in range(n) if j != k % m]
+    G = F - X
+    dX, dG = X[:, others] - X[:, k%m, None], G[:, others] - G[:, k%m, None]     # (bsz, r, d*L)
+    M = torch.bmm(dG, dG.transpose(1, 2)) + lam*torch.eye(len(others), dtype=X.dtype, device=X.device)[None]
+    Us = torch.linalg.solve(M, dX + dG).transpose(1, 2)
+    return Us.reshape(bsz, d, L, -1), dG.reshape(bsz, -1, d, L)
+
+
 def analyze_broyden(res_info, err=None, judge=True, name='forward', training=True, save_err=True):
     """
     For debugging use only :-)
@@ -334,19 +463,20 @@ def jac_loss_estimate(f0, z0, vecs=2, create_graph=True):
         result += vJ.norm()**2
     return result / vecs / np.prod(z0.shape)
 
-def power_method(f0, z0, n_iters=200):
+def power_method(f0, z0, n_iters=200, retain_graph=False):
     """Estimating the spectral radius of J using power method
     Args:
         f0 (torch.Tensor): Output of the function f (whose J is to be analyzed)
         z0 (torch.Tensor): Input to the function f
         n_iters (int, optional): Number of power method iterations. Defaults to 200.
+        retain_graph (bool, optional): Whether to keep the graph of f after the last iteration. Defaults to False.
     Returns:
         tuple: (largest eigenvector, largest (abs.) eigenvalue)
     """
     evector = torch.randn_like(z0)
     bsz = evector.shape[0]
     for i in range(n_iters):
-        vTJ = torch.autograd.grad(f0, z0, evector, retain_graph=(i < n_iters-1), create_graph=False)[0]
+        vTJ = torch.autograd.grad(f0, z0, evector, retain_graph=retain_graph or (i < n_iters-1), create_graph=False)[0]
         evalue = (vTJ * evector).reshape(bsz, -1).sum(1, keepdim=True) / (evector * evector).reshape(bsz, -1).sum(1, keepdim=True)
         evector = (vTJ.reshape(bsz, -1) / vTJ.reshape(bsz, -1).norm(dim=1, keepdim=True)).reshape_as(z0)
     return (evector, torch.abs(evalue))
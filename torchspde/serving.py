@@ -0,0 +1,285 @@
+import io
+import copy
+import json
+import pickle
+import queue
+import argparse
+import threading
+import numpy as np
+import torch
+from timeit import default_timer
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from socketserver import ThreadingMixIn, UnixStreamServer
+from .neural_spde import NeuralSPDE
+
+#=============================================================================================
+# Local inference service for trained Neural SPDEs. Requests of one (or a few) samples are
+# grouped by shape (dim_x, (possibly dim_y), dim_t) and micro-batched up to a latency deadline
+# before running through a pool of model replicas.
+#=============================================================================================
+
+class InferenceMetrics(object):
+    """ Thread-safe counters of the service: number of requests and batches, batch sizes and latencies.
+        The last `window` latencies and batch sizes are kept to report quantiles.
+    """
+
+    def __init__(self, window=10000):
+        self.lock = threading.Lock()
+        self.n_requests = 0
+        self.n_samples = 0
+        self.n_batches = 0
+        self.n_errors = 0
+        self.latencies = deque(maxlen=window)    # request latency (queueing + inference), in seconds
+        self.batch_sizes = deque(maxlen=window)  # number of samples per batch
+        self.run_times = deque(maxlen=window)    # inference time per batch, in seconds
+
+    def record_batch(self, n_samples, run_time):
+        with self.lock:
+            self.n_batches += 1
+            self.n_samples += n_samples
+            self.batch_sizes.append(n_samples)
+            self.run_times.append(run_time)
+
+    def record_request(self, latency, error=False):
+        with self.lock:
+            self.n_requests += 1
+            self.n_errors += int(error)
+            self.latencies.append(latency)
+
+    def summary(self):
+        def quantiles(values, scale=1.):
+            if len(values) == 0:
+                return {}
+            values = scale*np.array(values)
+            return {'mean': float(values.mean()), 'p50': float(np.quantile(values, 0.5)),
+                    'p90': float(np.quantile(values, 0.9)), 'p99': float(np.quantile(values, 0.99)), 'max': float(values.max())}
+        with self.lock:
+            return {'requests': self.n_requests, 'samples': self.n_samples, 'batches': self.n_batches, 'errors': self.n_errors,
+                    'latency_ms': quantiles(self.latencies, 1e3), 'batch_size': quantiles(self.batch_sizes),
+                    'run_time_ms': quantiles(self.run_times, 1e3)}
+
+
+class DynamicBatcher(object):
+    """ Groups incoming requests by input shape and runs them in batches of at most max_batch_size samples.
+        A batch is dispatched once it is full or once its oldest request has waited max_latency seconds.
+        Each of the n_workers threads owns a replica of the model (the spectral plans of KernelConvolution
+        reuse buffers and are not shared between threads).
+    """
+
+    def __init__(self, model, max_batch_size=64, max_latency=5e-3, n_workers=1, device='cpu', metrics=None):
+        self.max_batch_size = max_batch_size
+        self.max_latency = max_latency
+        self.device = torch.device(device)
+        self.metrics = metrics or InferenceMetrics()
+
+        model = model.to(self.device).eval()
+        self.dim = model.dim
+        self.replicas = queue.Queue()
+        for i in range(n_workers):
+            self.replicas.put(model if i == 0 else copy.deepcopy(model))
+        self.pool = ThreadPoolExecutor(max_workers=n_workers, thread_name_prefix='nspde-worker')
+
+        # pending requests (u0, xi, future, squeeze, arrival time), keyed by the shapes of a sample of u0 and xi
+        self.buckets = {}
+        self.cond = threading.Condition()
+        self.closed = False
+        self.dispatcher = threading.Thread(target=self._dispatch, name='nspde-dispatcher', daemon=True)
+        self.dispatcher.start()
+
+    def submit(self, u0, xi):
+        """ u0: (batch, in_channels, dim_x, (possibly dim_y)) or without the batch axis
+            xi: (batch, noise_channels, dim_x, (possibly dim_y), dim_t) or without the batch axis
+            returns a Future of the prediction (batch, in_channels, dim_x, (possibly dim_y), dim_t),
+                    without the batch axis if the inputs had none
+        """
+        squeeze = u0.dim() == self.dim + 1
+        if squeeze:
+            u0, xi = u0.unsqueeze(0), xi.unsqueeze(0)
+        assert u0.size(0) == xi.size(0) and u0.shape[2:] == xi.shape[2:-1], 'u0 and xi have inconsistent shapes'
+
+        future = Future()
+        with self.cond:
+            assert not self.closed, 'the batcher is closed'
+            self.buckets.setdefault((tuple(u0.shape[1:]), tuple(xi.shape[1:])), deque()).append((u0, xi, future, squeeze, default_timer()))
+            self.cond.notify()
+        return future
+
+    def __call__(self, u0, xi):
+        return self.submit(u0, xi).result()
+
+    def _dispatch(self):
+        while True:
+            with self.cond:
+                while True:
+                    if self.closed and not self.buckets:
+                        return
+                    now, timeout = default_timer(), None
+                    ready = None
+                    for key, bucket in self.buckets.items():
+                        size = sum(r[0].size(0) for r in bucket)
+                        wait = bucket[0][-1] + self.max_latency - now
+                        if size >= self.max_batch_size or wait <= 0 or self.closed:
+                            ready = key
+                            break
+                        timeout = wait if timeout is None else min(timeout, wait)
+                    if ready is not None:
+                        break
+                    self.cond.wait(timeout)
+
+                # take the oldest requests of the bucket, up to max_batch_size samples (at least one request)
+                bucket, batch, size = self.buckets[ready], [], 0
+                while bucket and (not batch or size + bucket[0][0].size(0) <= self.max_batch_size):
+                    batch.append(bucket.popleft())
+                    size += batch[-1][0].size(0)
+                if not bucket:
+                    del self.buckets[ready]
+
+            self.pool.submit(self._run, batch)
+
+    def _run(self, batch):
+        model = self.replicas.get()
+        try:
+            t = default_timer()
+            with torch.no_grad():
+                u0 = torch.cat([r[0] for r in batch]).to(self.device)
+                xi = torch.cat([r[1] for r in batch]).to(self.device)
+                ys = model(u0, xi).cpu()
+            self.metrics.record_batch(u0.size(0), default_timer() - t)
+            for (_, _, future, squeeze, t0), y in zip(batch, ys.split([r[0].size(0) for r in batch])):
+                future.set_result(y[0] if squeeze else y)
+                self.metrics.record_request(default_timer() - t0)
+        except Exception as e:
+            for (_, _, future, _, t0) in batch:
+                if future.done():
+                    continue
+                future.set_exception(e)
+                self.metrics.record_request(default_timer() - t0, error=True)
+        finally:
+            self.replicas.put(model)
+
+    def close(self):
+        """ Runs the pending requests and stops the dispatcher and the workers. """
+        with self.cond:
+            self.closed = True
+            self.cond.notify()
+        self.dispatcher.join()
+        self.pool.shutdown(wait=True)
+
+#=============================================================================================
+# HTTP front-end (TCP or Unix socket)
+#=============================================================================================
+
+def _load(body, content_type):
+    # json: {"u0": nested lists, "xi": nested lists}, otherwise a dict {'u0': tensor, 'xi': tensor} saved with torch.save
+    if content_type == 'application/json':
+        data = json.loads(body)
+        return torch.tensor(data['u0'], dtype=torch.float32), torch.tensor(data['xi'], dtype=torch.float32)
+    # only tensors are unpickled (no arbitrary code execution from the request body)
+    try:
+        data = torch.load(io.BytesIO(body), map_location='cpu', weights_only=True)
+    except (pickle.UnpicklingError, EOFError, RuntimeError) as e:
+        raise ValueError('invalid torch.save payload: {}'.format(e))
+    if not isinstance(data, dict) or not all(torch.is_tensor(v) for v in data.values()):
+        raise ValueError("the payload should be a dict of tensors {'u0': ..., 'xi': ...}")
+    return data['u0'].float(), data['xi'].float()
+
+
+class InferenceHandler(BaseHTTPRequestHandler):
+    """ POST /predict with a json or torch.save payload {'u0': ..., 'xi': ...}; the prediction is returned in the same format.
+        GET /metrics returns the latency and batch-size metrics in json.
+    """
+
+    batcher = None
+
+    def do_GET(self):
+        if self.path.rstrip('/') != '/metrics':
+            return self.send_error(404)
+        self._reply(json.dumps(self.batcher.metrics.summary()).encode(), 'application/json')
+
+    def do_POST(self):
+        if self.path.rstrip('/') != '/predict':
+            return self.send_error(404)
+        content_type = self.headers.get('Content-Type', 'application/octet-stream').split(';')[0]
+        try:
+            u0, xi = _load(self.rfile.read(int(self.headers.get('Content-Length', 0))), content_type)
+            ys = self.batcher(u0, xi)
+        except (KeyError, ValueError, AssertionError) as e:
+            return self.send_error(400, str(e))
+        except Exception as e:
+            return self.send_error(500, str(e))
+        if content_type == 'application/json':
+            self._reply(json.dumps({'u': ys.tolist()}).encode(), content_type)
+        else:
+            out = io.BytesIO()
+            torch.save({'u': ys}, out)
+            self._reply(out.getvalue(), 'application/octet-stream')
+
+    def _reply(self, body, content_type):
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def address_string(self):
+        # the client address of a Unix socket is not a (host, port) pair
+        return self.client_address[0] if isinstance(self.client_address, tuple) else 'unix'
+
+    def log_message(self, format, *args):
+        pass
+
+
+class ThreadingUnixHTTPServer(ThreadingMixIn, UnixStreamServer):
+    daemon_threads = True
+
+    def get_request(self):
+        request, _ = super(ThreadingUnixHTTPServer, self).get_request()
+        return request, ('unix', 0)
+
+
+def make_server(batcher, host='127.0.0.1', port=8000, unix_socket=None):
+    """ HTTP server forwarding the requests to the batcher, listening on host:port or on a Unix socket. """
+    handler = type('Handler', (InferenceHandler,), {'batcher': batcher})
+    if unix_socket is not None:
+        return ThreadingUnixHTTPServer(unix_socket, handler)
+    return ThreadingHTTPServer((host, port), handler)
+
+
+def load_model(checkpoint, config):
+    """ checkpoint: state dict saved by train_nspde or EarlyStopping
+        config: json file with the keyword arguments of NeuralSPDE, e.g. {"dim": 1, "in_channels": 1, ...}
+    """
+    with open(config) as f:
+        kwargs = json.load(f)
+    model = NeuralSPDE(**kwargs)
+    model.load_state_dict(torch.load(checkpoint, map_location='cpu'))
+    return model.eval()
+
+
+if __name__ == '__main__':
+
+    #   python -m torchspde.serving --checkpoint final.pt --config config.json --port 8000
+
+    parser = argparse.ArgumentParser(description='Dynamic-batching inference server for a trained NeuralSPDE')
+    parser.add_argument('--checkpoint', required=True)
+    parser.add_argument('--config', required=True, help='json file with the keyword arguments of NeuralSPDE')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--unix-socket', default=None)
+    parser.add_argument('--device', default='cpu')
+    parser.add_argument('--max-batch-size', type=int, default=64)
+    parser.add_argument('--max-latency-ms', type=float, default=5.)
+    parser.add_argument('--workers', type=int, default=1)
+    args = parser.parse_args()
+
+    batcher = DynamicBatcher(load_model(args.checkpoint, args.config), args.max_batch_size, 1e-3*args.max_latency_ms, args.workers, args.device)
+    server = make_server(batcher, args.host, args.port, args.unix_socket)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        batcher.close()
@@ -0,0 +1,81 @@
+import os
+import torch
+from collections import OrderedDict
+
+#=============================================================================================
+# Cache of the fixed points of the training samples, keyed by their index in the dataset. The
+# fixed point of a sample moves little from one epoch to the next, so the cached value is a
+# good starting point for the next root find.
+#=============================================================================================
+
+class SolutionCache(object):
+    """ Last converged latent of each sample, with least-recently-used eviction once the stored
+        entries exceed max_bytes. The entries can be stored in a reduced precision dtype (e.g. torch.float16),
+        and on disk (one file per sample in the directory path) instead of in (cpu) memory.
+    """
+
+    def __init__(self, max_bytes=2**30, dtype=None, path=None):
+        self.max_bytes = max_bytes
+        self.dtype = dtype
+        self.path = path
+        if path is not None:
+            os.makedirs(path, exist_ok=True)
+        self.entries = OrderedDict()    # index -> (tensor or file name, size in bytes)
+        self.n_bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, i):
+        return int(i) in self.entries
+
+    def get(self, sample_ids, default):
+        """ sample_ids: (batch,) dataset indices
+            default: (batch, ...) the starting points of the samples which are not cached (or cached with another shape)
+            returns the starting points (batch, ...) and a boolean mask (batch,) of the cache hits
+        """
+        out, hit = default.clone(), torch.zeros(default.size(0), dtype=torch.bool)
+        for b, i in enumerate(sample_ids.tolist()):
+            if i not in self.entries:
+                continue
+            entry = self.entries[i][0]
+            z = torch.load(entry) if self.path is not None else entry
+            if z.shape != default.shape[1:]:
+                continue
+            self.entries.move_to_end(i)
+            out[b] = z.to(device=default.device, dtype=default.dtype)
+            hit[b] = True
+        self.hits += int(hit.sum())
+        self.misses += len(hit) - int(hit.sum())
+        return out, hit.to(default.device)
+
+    def put(self, sample_ids, z):
+        """ Stores the fixed points z: (batch, ...) of the samples sample_ids: (batch,) """
+        z = z.detach().to('cpu', dtype=self.dtype or z.dtype)
+        for i, z_ in zip(sample_ids.tolist(), z):
+            self.remove(i)
+            z_ = z_.clone()
+            n_bytes = z_.numel() * z_.element_size()
+            if self.path is not None:
+                entry = os.path.join(self.path, '{}.pt'.format(i))
+                torch.save(z_, entry)
+            else:
+                entry = z_
+            self.entries[i] = (entry, n_bytes)
+            self.n_bytes += n_bytes
+        while self.n_bytes > self.max_bytes and self.entries:
+            self.remove(next(iter(self.entries)))
+
+    def remove(self, i):
+        if i not in self.entries:
+            return
+        entry, n_bytes = self.entries.pop(i)
+        self.n_bytes -= n_bytes
+        if self.path is not None and os.path.exists(entry):
+            os.remove(entry)
+
+    def clear(self):
+        for i in list(self.entries):
+            self.remove(i)
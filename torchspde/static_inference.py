@@ -0,0 +1,126 @@
+import copy
+import torch
+import torch.nn as nn
+from .fixed_point_solver import NeuralFixedPoint, retained_modes
+
+#=============================================================================================
+# Shape-specialised inference graph of a trained Neural SPDE (fixed point solver). All the
+# branching of NeuralSPDE and of the solver (dimension, number of modes, grid, init) is resolved
+# when the module is built, and the retained modes are selected with precomputed flat indices,
+# so that the forward pass compiles under torch.compile and torch.jit.script without graph breaks.
+#=============================================================================================
+
+def flat_index(sizes, index):
+    # sizes: sizes of the axes of a tensor, index: list of retained indices along each axis
+    # returns the indices of the retained block in the flattened tensor (C order)
+    flat = torch.zeros([len(i) for i in index], dtype=torch.long)
+    for n, i, k in zip(sizes, index, range(len(sizes))):
+        flat = flat * n + i.reshape([-1 if j==k else 1 for j in range(len(sizes))])
+    return flat.reshape(-1)
+
+
+class StaticNeuralSPDE(nn.Module):
+
+    real_fft: torch.jit.Final[bool]
+    real_fft_init: torch.jit.Final[bool]
+    n_iter: torch.jit.Final[int]
+
+    def __init__(self, model, size):
+        """ model: trained NeuralSPDE with solver='fixed_point'
+            size: (dim_x, (possibly dim_y), dim_t) the shape of the inputs the module is specialised to
+        """
+        super(StaticNeuralSPDE, self).__init__()
+
+        assert isinstance(model.solver, NeuralFixedPoint), 'only the fixed point solver has a static inference graph'
+        assert len(size) == model.dim + 1, 'size should be (dim_x, (possibly dim_y), dim_t)'
+
+        # the local operators and the projections are frozen in eval mode
+        self.lift = copy.deepcopy(model.lift).eval()
+        self.spde_func = copy.deepcopy(model.spde_func).eval()
+        self.readout = copy.deepcopy(model.readout).eval()
+        self.n_iter = model.solver.n_iter
+
+        conv = model.solver.convolution
+        self.real_fft = conv.real_fft
+        self.real_fft_init = conv.half_spectrum(init=True)
+        weights = conv.weights.detach()
+        channels, device = weights.size(0), weights.device
+        modes_t = weights.size(-1)
+
+        size = [int(n) for n in size]
+        dim_t = size[-1]
+        self.size = size
+        self.dims = list(conv.dims)
+        self.space_dims = list(conv.dims[:-1])
+
+        # retained space modes, in unshifted FFT order
+        index_x = flat_index(size[:-1], [retained_modes(n, m) for n, m in zip(size[:-1], conv.modes[:-1])])
+        self.register_buffer('index_x', index_x.to(device))
+
+        # S * u: retained space-time modes
+        size_t = dim_t//2 + 1 if self.real_fft else dim_t
+        index_t = torch.arange(modes_t) if self.real_fft else retained_modes(dim_t, conv.modes[-1])
+        self.ft_size = size[:-1] + [size_t]
+        self.n_ft = int(index_x.new_tensor(self.ft_size).prod())
+        self.register_buffer('index', (index_x[:, None]*size_t + index_t[None, :]).reshape(-1).to(device))
+        self.register_buffer('weights', weights.reshape(channels, channels, -1).clone())
+
+        # S_t * u_0: K_t = F_t^-1(K) is precomputed (see KernelConvolution.forward_init)
+        if self.real_fft_init:
+            kernel_init, size_init = weights, dim_t//2 + 1
+        else:
+            kernel_init = conv.kernel_init().detach()
+            kernel_init, size_init = torch.fft.ifftn(torch.fft.ifftshift(kernel_init, dim=[-1]), dim=[-1], s=dim_t), dim_t
+        self.ft_size_init = size[:-1] + [size_init]
+        self.n_ft_init = int(index_x.new_tensor(self.ft_size_init).prod())
+        index_init = (index_x[:, None]*size_init + torch.arange(kernel_init.size(-1))[None, :]).reshape(-1)
+        self.register_buffer('index_init', index_init.to(device))
+        self.register_buffer('kernel_init', kernel_init.reshape(channels, channels, index_x.size(0), -1).clone())
+
+    def semigroup(self, z):
+        """ S * z with z: (batch, channels, dim_x, (possibly dim_y), dim_t) """
+        b, c = z.size(0), z.size(1)
+
+        if self.real_fft:
+            z_ft = torch.fft.rfftn(z, dim=self.dims)
+        else:
+            z_ft = torch.fft.fftn(z, dim=self.dims)
+
+        z_ft = z_ft.reshape(b, c, -1).index_select(2, self.index)
+        out = torch.einsum('bik, ijk -> bjk', [z_ft, self.weights])
+        out_ft = torch.zeros([b, c, self.n_ft], dtype=out.dtype, device=out.device)
+        out_ft = out_ft.index_copy(2, self.index, out).reshape([b, c] + self.ft_size)
+
+        if self.real_fft:
+            return torch.fft.irfftn(out_ft, s=self.size, dim=self.dims)
+        return torch.fft.ifftn(out_ft, dim=self.dims).real
+
+    def semigroup_init(self, z0):
+        """ S_t * z0 with z0: (batch, channels, dim_x, (possibly dim_y)) """
+        b, c = z0.size(0), z0.size(1)
+
+        z_ft = torch.fft.fftn(z0, dim=self.space_dims).reshape(b, c, -1).index_select(2, self.index_x)
+        out = torch.einsum('bix, ijxt -> bjxt', [z_ft, self.kernel_init]).reshape(b, c, -1)
+        out_ft = torch.zeros([b, c, self.n_ft_init], dtype=out.dtype, device=out.device)
+        out_ft = out_ft.index_copy(2, self.index_init, out).reshape([b, c] + self.ft_size_init)
+
+        if self.real_fft_init:
+            return torch.fft.irfftn(out_ft, s=self.size, dim=self.dims)
+        return torch.fft.ifftn(out_ft, dim=self.space_dims).real
+
+    def forward(self, u0, xi):
+        """ u0: (batch, in_channels, dim_x, (possibly dim_y))
+            xi: (batch, noise_channels, dim_x, (possibly dim_y), dim_t)
+        """
+        z0 = self.lift(u0.movedim(1, -1)).movedim(-1, 1)
+
+        # S_t * z_0
+        z0_path = self.semigroup_init(z0)
+
+        # Picard's iterations
+        z = z0_path
+        for _ in range(self.n_iter):
+            F_z, G_z = self.spde_func(z)
+            z = z0_path + self.semigroup(F_z + (G_z * xi.unsqueeze(1)).sum(2))
+
+        return self.readout(z.movedim(1, -1)).movedim(-1, 1)
@@ -1,3 +1,4 @@
+import os
 import torch
 import scipy.io
 import h5py
@@ -14,12 +15,47 @@ from functools import reduce
 from functools import partial 
 from timeit import default_timer
 from torchspde.neural_spde import NeuralSPDE
+from torchspde.diffeq_solver import control_coeffs
+from torchspde.linear_interpolation import LinearInterpolation
 
 #===========================================================================
 # Data Loaders for Neural SPDE
 #===========================================================================
 
-def dataloader_nspde_1d(u, xi=None, ntrain=1000, ntest=200, T=51, sub_t=1, batch_size=20, dim_x=128, dataset=None):
+def precompute_control(xi, path=None):
+    """ Control coefficients of the 'diffeq' solver (see control_coeffs), computed once for the whole dataset.
+        If path is given, they are saved there and memory-mapped from disk instead of being kept in memory.
+        xi: (n, forcing_channels, dim_x, (possibly dim_y), dim_t)
+    """
+    coeffs = control_coeffs(xi)
+    if path is None:
+        return coeffs
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    torch.save(coeffs, path)
+    return torch.load(path, mmap=True)
+
+
+def collate_control(batch):
+    """ Collates samples (u0, coeffs, u, ...) and wraps the batch of control coefficients in the LinearInterpolation 
+        expected by the 'diffeq' solver in place of the noise.
+    """
+    u0, coeffs, *rest = torch.utils.data.default_collate(batch)
+    return [u0, LinearInterpolation(coeffs), *rest]
+
+
+def _loader(data, batch_size, shuffle, control, control_path):
+    # data: [u0, xi, u, ...]; if control, xi is replaced by the precomputed control coefficients
+    collate_fn = None
+    if control:
+        data = [data[0], precompute_control(data[1], control_path)] + data[2:]
+        collate_fn = collate_control
+    return torch.utils.data.DataLoader(torch.utils.data.TensorDataset(*data), batch_size=batch_size, shuffle=shuffle, collate_fn=collate_fn)
+
+
+def dataloader_nspde_1d(u, xi=None, ntrain=1000, ntest=200, T=51, sub_t=1, batch_size=20, dim_x=128, dataset=None, return_index=False, control=False, control_dir=None):
+    """ control: if True, the batches contain the precomputed control of the 'diffeq' solver instead of the noise, 
+                 stored in memory, or on disk in control_dir (see precompute_control)
+    """
 
     if xi is None:
         print('There is no known forcing')
@@ -47,8 +83,11 @@ def dataloader_nspde_1d(u, xi=None, ntrain=1000, ntest=200, T=51, sub_t=1, batch
     else:
         xi_test = torch.zeros_like(u_test).unsqueeze(1)
 
-    train_loader = torch.utils.data.DataLoader(torch.utils.data.TensorDataset(u0_train, xi_train, u_train), batch_size=batch_size, shuffle=True)
-    test_loader = torch.utils.data.DataLoader(torch.utils.data.TensorDataset(u0_test, xi_test, u_test), batch_size=batch_size, shuffle=False)
+    # the training batches can also contain the indices of the samples (see the solution cache of NeuralRootFind)
+    train_data = [u0_train, xi_train, u_train] + ([torch.arange(u0_train.size(0))] if return_index else [])
+    paths = [os.path.join(control_dir, f) for f in ('control_train.pt', 'control_test.pt')] if control_dir is not None else [None, None]
+    train_loader = _loader(train_data, batch_size, True, control, paths[0])
+    test_loader = _loader([u0_test, xi_test, u_test], batch_size, False, control, paths[1])
 
     return train_loader, test_loader
 
@@ -84,7 +123,10 @@ def dataloader_nspde_1d(u, xi=None, ntrain=1000, ntest=200, T=51, sub_t=1, batch
 #     return train_loader, test_loader
 
 
-def dataloader_nspde_2d(u, xi=None, ntrain=1000, ntest=200, T=51, sub_t=1, sub_x=4, batch_size=20, dataset=None):
+def dataloader_nspde_2d(u, xi=None, ntrain=1000, ntest=200, T=51, sub_t=1, sub_x=4, batch_size=20, dataset=None, return_index=False, control=False, control_dir=None):
+    """ control: if True, the batches contain the precomputed control of the 'diffeq' solver instead of the noise, 
+                 stored in memory, or on disk in control_dir (see precompute_control)
+    """
 
     if xi is None:
         print('There is no known forcing')
@@ -108,8 +150,11 @@ def dataloader_nspde_2d(u, xi=None, ntrain=1000, ntest=200, T=51, sub_t=1, sub_x
     else:
         xi_test = torch.zeros_like(u_test)
 
-    train_loader = torch.utils.data.DataLoader(torch.utils.data.TensorDataset(u0_train, xi_train, u_train), batch_size=batch_size, shuffle=True)
-    test_loader = torch.utils.data.DataLoader(torch.utils.data.TensorDataset(u0_test, xi_test, u_test), batch_size=batch_size, shuffle=False)
+    # the training batches can also contain the indices of the samples (see the solution cache of NeuralRootFind)
+    train_data = [u0_train, xi_train, u_train] + ([torch.arange(u0_train.size(0))] if return_index else [])
+    paths = [os.path.join(control_dir, f) for f in ('control_train.pt', 'control_test.pt')] if control_dir is not None else [None, None]
+    train_loader = _loader(train_data, batch_size, True, control, paths[0])
+    test_loader = _loader([u0_test, xi_test, u_test], batch_size, False, control, paths[1])
 
     return train_loader, test_loader
 
@@ -122,7 +167,7 @@ def eval_nspde(model, test_dl, myloss, batch_size, device):
     ntest = len(test_dl.dataset)
     test_loss = 0.
     with torch.no_grad():
-        for u0_, xi_, u_ in test_dl:    
+        for u0_, xi_, u_, *_ in test_dl:    
             loss = 0.       
             u0_, xi_, u_ = u0_.to(device), xi_.to(device), u_.to(device)
             u_pred = model(u0_, xi_)
@@ -131,11 +176,14 @@ def eval_nspde(model, test_dl, myloss, batch_size, device):
     print('Test Loss: {:.6f}'.format(test_loss / ntest))
     return test_loss / ntest
 
-def train_nspde(model, train_loader, test_loader, device, myloss, batch_size=20, epochs=5000, learning_rate=0.001, scheduler_step=100, scheduler_gamma=0.5, print_every=20, plateau_patience=None, plateau_terminate=None, time_train=False, time_eval=False, checkpoint_file='checkpoint.pt'):
+def train_nspde(model, train_loader, test_loader, device, myloss, batch_size=20, epochs=5000, learning_rate=0.001, scheduler_step=100, scheduler_gamma=0.5, print_every=20, plateau_patience=None, plateau_terminate=None, time_train=False, time_eval=False, checkpoint_file='checkpoint.pt', jac_loss_weight=0.):
 
 
     optimizer = torch.optim.Adam(model.parameters(), lr=learning_rate, weight_decay=1e-4)
 
+    # loss scaling, needed when the model runs in float16 (see amp_dtype in NeuralSPDE)
+    scaler = torch.amp.GradScaler(torch.device(device).type, enabled=getattr(model, 'amp_dtype', None)==torch.float16)
+
     if plateau_patience is None:
         scheduler = torch.optim.lr_scheduler.StepLR(optimizer, step_size=scheduler_step, gamma=scheduler_gamma)
     else:
@@ -159,7 +207,7 @@ def train_nspde(model, train_loader, test_loader, device, myloss, batch_size=20,
             model.train()
             
             train_loss = 0.
-            for u0_, xi_, u_ in train_loader:
+            for u0_, xi_, u_, *ids in train_loader:
 
                 loss = 0.
 
@@ -168,19 +216,28 @@ def train_nspde(model, train_loader, test_loader, device, myloss, batch_size=20,
                 u_ = u_.to(device)
 
                 t1 = default_timer()
-                u_pred = model(u0_, xi_)
+                if ids: # dataset indices of the samples (see dataloader_nspde_1d with return_index=True)
+                    u_pred = model(u0_, xi_, sample_ids=ids[0])
+                else:
+                    u_pred = model(u0_, xi_)
                 loss = myloss(u_pred[..., 1:].reshape(batch_size, -1), u_[..., 1:].reshape(batch_size, -1))
-
                 train_loss += loss.item()
-                loss.backward()
-                optimizer.step()
+
+                # Jacobian penalty of the root find solver, when it has been computed at this step (see jac_loss_every in NeuralRootFind)
+                jac_loss = getattr(model.solver, 'jac_loss', None)
+                if jac_loss_weight and jac_loss is not None:
+                    loss = loss + jac_loss_weight * jac_loss
+
+                scaler.scale(loss).backward()
+                scaler.step(optimizer)
+                scaler.update()
                 optimizer.zero_grad()
 
                 times_train.append(default_timer()-t1)
 
             test_loss = 0.
             with torch.no_grad():
-                for u0_, xi_, u_ in test_loader:
+                for u0_, xi_, u_, *_ in test_loader:
                     
                     loss = 0.
                     
@@ -213,6 +270,8 @@ def train_nspde(model, train_loader, test_loader, device, myloss, batch_size=20,
                 losses_train.append(train_loss/ntrain)
                 losses_test.append(test_loss/ntest)
                 print('Epoch {:04d} | Total Train Loss {:.6f} | Total Test Loss {:.6f}'.format(ep, train_loss / ntrain, test_loss / ntest))
+                if getattr(model.solver, 'spectral_radius', None):
+                    print('Spectral radius of the Jacobian at step {}: {:.4f}'.format(*model.solver.spectral_radius[-1]))
 
         if time_train and time_eval:
             return model, losses_train, losses_test, times_train, times_eval 